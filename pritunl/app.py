@@ -3,6 +3,8 @@ from pritunl.exceptions import *
 from pritunl.descriptors import *
 from pritunl import logger
 from pritunl import settings
+from pritunl import messenger
+from pritunl import mongo
 
 import flask
 import cherrypy.wsgiserver
@@ -36,9 +38,14 @@ def before_request():
     flask.g.write_count = 0
     flask.g.query_time = 0
     flask.g.start = time.time()
+    flask.g.publish_buffer = messenger.PublishBuffer()
+    flask.g.publish_buffer.start()
+    flask.g.identity_map = mongo.IdentityMap()
+    flask.g.identity_map.start()
 
 @app.after_request
 def after_request(response):
+    flask.g.publish_buffer.flush()
     response.headers.add('Execution-Time',
         int((time.time() - flask.g.start) * 1000))
     response.headers.add('Query-Time',
@@ -47,6 +54,15 @@ def after_request(response):
     response.headers.add('Write-Count', flask.g.write_count)
     return response
 
+@app.teardown_request
+def teardown_request(exception):
+    publish_buffer = getattr(flask.g, 'publish_buffer', None)
+    if publish_buffer:
+        publish_buffer.stop()
+    identity_map = getattr(flask.g, 'identity_map', None)
+    if identity_map:
+        identity_map.stop()
+
 def _end_host():
     from pritunl import host
     host.deinit_host()
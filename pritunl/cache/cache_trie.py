@@ -5,12 +5,27 @@ from pritunl.exceptions import *
 from pritunl.descriptors import *
 
 import collections
+import heapq
 import re
 
-_keys = collections.defaultdict(
-    lambda: collections.defaultdict(lambda: collections.Counter()))
-_values = collections.defaultdict(
-    lambda: collections.defaultdict(lambda: set()))
+class CacheTrieNode(object):
+    # Radix tree node, label is the edge from the parent and children are
+    # indexed by the first character of their label
+    __slots__ = ('label', 'children', 'values')
+
+    def __init__(self, label=''):
+        self.label = label
+        self.children = {}
+        self.values = None
+
+_roots = collections.defaultdict(CacheTrieNode)
+
+def _common_len(x, y):
+    length = min(len(x), len(y))
+    for i in xrange(length):
+        if x[i] != y[i]:
+            return i
+    return length
 
 class CacheTrie(object):
     __slots__ = ('name', 'key')
@@ -20,18 +35,36 @@ class CacheTrie(object):
         self.key = key
 
     def clear_cache(self):
-        _keys.pop(self.name, None)
-        _values.pop(self.name, None)
+        _roots.pop(self.name, None)
 
     def add_key(self, key, value):
-        keys = _keys[self.name]
-        cur_key = self.key
-        new_key = cur_key
-        for char in key.lower():
-            new_key += char
-            keys[cur_key][new_key] += 1
-            cur_key = new_key
-        _values[self.name][cur_key].add(value)
+        node = _roots[self.name]
+        key = self.key + key.lower()
+
+        while key:
+            child = node.children.get(key[0])
+            if child is None:
+                child = CacheTrieNode(key)
+                node.children[key[0]] = child
+                node = child
+                break
+
+            label = child.label
+            common = _common_len(label, key)
+            if common < len(label):
+                # Split the edge at the end of the common prefix
+                split = CacheTrieNode(label[:common])
+                child.label = label[common:]
+                split.children[child.label[0]] = child
+                node.children[key[0]] = split
+                child = split
+
+            node = child
+            key = key[common:]
+
+        if node.values is None:
+            node.values = set()
+        node.values.add(value)
 
     def add_key_terms(self, key, value):
         for term in re.split('[^a-z0-9]', key.lower()):
@@ -39,45 +72,123 @@ class CacheTrie(object):
         self.add_key(key, value)
 
     def remove_key(self, key, value):
-        keys = _keys[self.name]
-        values = _values[self.name]
-        cur_key = self.key
-        new_key = cur_key
-        for char in key.lower():
-            new_key += char
-            keys[cur_key][new_key] -= 1
-            if not keys[cur_key][new_key]:
-                keys[cur_key].pop(new_key, None)
-                if not keys[cur_key]:
-                    keys.pop(cur_key, None)
-            cur_key = new_key
-        try:
-            values[cur_key].remove(value)
-        except KeyError:
-            pass
-        if not values[cur_key]:
-            values.pop(cur_key, None)
+        node = _roots.get(self.name)
+        if node is None:
+            return
+        key = self.key + key.lower()
+
+        path = []
+        while key:
+            child = node.children.get(key[0])
+            if child is None or not key.startswith(child.label):
+                return
+            path.append(node)
+            key = key[len(child.label):]
+            node = child
+
+        if node.values:
+            node.values.discard(value)
+            if not node.values:
+                node.values = None
+
+        # Remove empty nodes then merge a remaining single child into its
+        # parent to keep the tree compressed
+        while path and not node.values and not node.children:
+            parent = path.pop()
+            parent.children.pop(node.label[0], None)
+            node = parent
+
+        if path and not node.values and len(node.children) == 1:
+            child = node.children.values()[0]
+            child.label = node.label + child.label
+            path[-1].children[child.label[0]] = child
 
     def remove_key_terms(self, key, value):
         for term in re.split('[^a-z0-9]', key.lower()):
             self.remove_key(term, value)
         self.remove_key(key, value)
 
+    def _find(self, prefix):
+        node = _roots.get(self.name)
+        if node is None:
+            return None, None
+        key = prefix
+
+        while prefix:
+            child = node.children.get(prefix[0])
+            if child is None:
+                return None, None
+
+            label = child.label
+            if prefix.startswith(label):
+                prefix = prefix[len(label):]
+            elif label.startswith(prefix):
+                key += label[len(prefix):]
+                prefix = ''
+            else:
+                return None, None
+            node = child
+
+        return node, key
+
     def chain(self, node_values):
-        name = self.name
-        key = self.key
-        keys = _keys[name]
-        values = _values[name]
-        if key in keys:
-            for node_key in keys[key]:
-                CacheTrie(name, node_key).chain(node_values)
-        if key in values:
-            node_values.update(values[key])
+        node = self._find(self.key)[0]
+        if node is None:
+            return node_values
+
+        nodes = [node]
+        while nodes:
+            node = nodes.pop()
+            if node.values:
+                node_values.update(node.values)
+            nodes.extend(node.children.itervalues())
         return node_values
 
-    def get_prefix(self, prefix):
-        return CacheTrie(self.name, prefix.lower()).chain(set())
+    def get_prefix(self, prefix, limit=None):
+        return set(self.iter_prefix(prefix, limit))
+
+    def iter_prefix(self, prefix, limit=None):
+        node = self._find(self.key + prefix.lower())[0]
+        if node is None:
+            return
+
+        # Values are yielded once when stored under multiple keys
+        seen = set()
+        nodes = [node]
+        while nodes:
+            node = nodes.pop()
+            if node.values:
+                for value in node.values:
+                    if value in seen:
+                        continue
+                    seen.add(value)
+                    yield value
+                    if limit and len(seen) >= limit:
+                        return
+            nodes.extend(node.children.itervalues())
+
+    def get_top(self, prefix, count):
+        # Values with the shortest matching keys first then in key order
+        node, key = self._find(self.key + prefix.lower())
+        if node is None:
+            return []
+
+        values = []
+        seen = set()
+        nodes = [(len(key), key, node)]
+        while nodes:
+            _, key, node = heapq.heappop(nodes)
+            if node.values:
+                for value in sorted(node.values):
+                    if value in seen:
+                        continue
+                    seen.add(value)
+                    values.append(value)
+                    if len(values) >= count:
+                        return values
+
+            for child in node.children.itervalues():
+                child_key = key + child.label
+                heapq.heappush(nodes, (len(child_key), child_key, child))
 
-    def iter_prefix(self, prefix):
-        for value in CacheTrie(self.name, prefix.lower()).chain(set()):
-            yield value
+        return values
@@ -8,6 +8,10 @@ import copy
 import itertools
 import json
 import os
+import heapq
+import mmap
+import struct
+import random
 
 TRANSACTION_METHODS = {
     'set',
@@ -29,24 +33,287 @@ TRANSACTION_METHODS = {
 }
 CHANNEL_TTL = 120
 CHANNEL_BUFFER = 128
+EXPIRE_KEY = 0
+EXPIRE_CHANNEL = 1
+JOURNAL_COMPACT_SIZE = 4194304
+LRU = 'lru'
+LFU = 'lfu'
+ENTRY_OVERHEAD = 96
+ELEMENT_OVERHEAD = 48
+EVICTION_SAMPLES = 8
+LOCK_STRIPES = 64
+SNAPSHOT_MAGIC = 'TDB\x02'
+SNAPSHOT_NONE = 0
+SNAPSHOT_STR = 1
+SNAPSHOT_SET = 2
+SNAPSHOT_DEQUE = 3
+SNAPSHOT_DICT = 4
+SNAPSHOT_JSON = 5
+SNAPSHOT_NULL_LEN = 0xffffffff
+SNAPSHOT_UNICODE = 0x80
+_snapshot_len = struct.Struct('<I')
+_snapshot_record = struct.Struct('<BIqI')
+_snapshot_lens = {}
+
+def _snapshot_lens_struct(count):
+    lens_struct = _snapshot_lens.get(count)
+    if not lens_struct:
+        lens_struct = struct.Struct('<%dI' % count)
+        if count <= 256:
+            _snapshot_lens[count] = lens_struct
+    return lens_struct
+
+def _snapshot_encode(key, key_ttl, key_val):
+    # Record header with value count, value lengths, key then values.
+    # Strings are stored as utf-8 and flagged when not ascii so ascii
+    # only records can be loaded without decoding.
+    if key_val is None:
+        key_type = SNAPSHOT_NONE
+        values = []
+    elif isinstance(key_val, basestring):
+        key_type = SNAPSHOT_STR
+        values = [key_val]
+    elif isinstance(key_val, set):
+        key_type = SNAPSHOT_SET
+        values = list(key_val)
+    elif isinstance(key_val, collections.deque):
+        key_type = SNAPSHOT_DEQUE
+        values = list(key_val)
+    elif isinstance(key_val, dict):
+        key_type = SNAPSHOT_DICT
+        values = []
+        for field, value in key_val.items():
+            values.append(field)
+            values.append(value)
+    else:
+        key_type = SNAPSHOT_JSON
+        values = [json.dumps(key_val)]
+
+    lens = []
+    for i, value in enumerate(values):
+        if value is None:
+            lens.append(SNAPSHOT_NULL_LEN)
+            values[i] = ''
+            continue
+        elif isinstance(value, unicode):
+            try:
+                value = value.encode('ascii')
+            except UnicodeEncodeError:
+                key_type |= SNAPSHOT_UNICODE
+                value = value.encode('utf-8')
+        elif not key_type & SNAPSHOT_UNICODE:
+            try:
+                value.decode('ascii')
+            except UnicodeDecodeError:
+                key_type |= SNAPSHOT_UNICODE
+        values[i] = value
+        lens.append(len(value))
+
+    if isinstance(key, unicode):
+        try:
+            key = key.encode('ascii')
+        except UnicodeEncodeError:
+            key_type |= SNAPSHOT_UNICODE
+            key = key.encode('utf-8')
+
+    return _snapshot_record.pack(key_type, len(key), key_ttl or 0,
+        len(lens)) + _snapshot_lens_struct(len(lens)).pack(*lens) + \
+        key + ''.join(values)
+
+def _snapshot_decode(buf, offset):
+    # Returns key, ttl, value and offset of the next record
+    key_type, key_len, key_ttl, count = _snapshot_record.unpack_from(
+        buf, offset)
+    offset += _snapshot_record.size
+    lens = _snapshot_lens_struct(count).unpack_from(buf, offset)
+    offset += 4 * count
+    key = buf[offset:offset + key_len]
+    offset += key_len
+
+    values = []
+    for val_len in lens:
+        if val_len == SNAPSHOT_NULL_LEN:
+            values.append(None)
+        else:
+            values.append(buf[offset:offset + val_len])
+            offset += val_len
+
+    if key_type & SNAPSHOT_UNICODE:
+        key_type ^= SNAPSHOT_UNICODE
+        key = key.decode('utf-8')
+        values = [x.decode('utf-8') if x is not None else None
+            for x in values]
+
+    if key_type == SNAPSHOT_NONE:
+        key_val = None
+    elif key_type == SNAPSHOT_STR:
+        key_val = values[0]
+    elif key_type == SNAPSHOT_SET:
+        key_val = set(values)
+    elif key_type == SNAPSHOT_DEQUE:
+        key_val = collections.deque(values)
+    elif key_type == SNAPSHOT_DICT:
+        key_val = dict(itertools.izip(values[::2], values[1::2]))
+    else:
+        key_val = json.loads(values[0])
+
+    return key, key_ttl or None, key_val, offset
+
+class TunlDBEntry(object):
+    # Access is the last access time with lru or hit count with lfu.
+    # Shared is set when the value is referenced by an iterator or export
+    # snapshot, the value is then copied before the next mutation.
+    __slots__ = ('val', 'ttl', 'access', 'shared')
+
+    def __init__(self, val=None, ttl=None):
+        self.val = val
+        self.ttl = ttl
+        self.access = 0
+        self.shared = False
+
+class TunlDBChannel(object):
+    # Messages are stored in a ring indexed by sequence number, seq is the
+    # sequence of the next message and first is the oldest sequence that
+    # has not been cleared
+    __slots__ = ('cond', 'ring', 'seq', 'first', 'subs', 'ttl')
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.ring = [None] * CHANNEL_BUFFER
+        self.seq = 0
+        self.first = 0
+        self.subs = 0
+        self.ttl = None
+
+class TunlDBMissed(object):
+    # Yielded to subscribers that fell behind the channel buffer
+    __slots__ = ('count',)
+
+    def __init__(self, count):
+        self.count = count
+
+class TunlDBLocks(object):
+    # Acquires the stripes in index order to prevent deadlocks between
+    # multi key operations
+    def __init__(self, locks):
+        self._locks = locks
+
+    def __enter__(self):
+        for lock in self._locks:
+            lock.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for lock in reversed(self._locks):
+            lock.release()
 
 class TunlDB(object):
     def __init__(self):
         self._path = None
+        self._binary = False
         self._set_queue = Queue.Queue()
-        self._data = collections.defaultdict(
-            lambda: {'ttl': None, 'val': None})
-        self._timers = {}
-        self._channels = collections.defaultdict(
-            lambda: {'subs': set(), 'msgs': collections.deque(
-                maxlen=CHANNEL_BUFFER), 'timer': None})
-        self._commit_log = []
+        self._data = {}
+        self._channels = {}
+        self._channels_lock = threading.Lock()
+        self._commit_log = collections.OrderedDict()
         self._locks = collections.defaultdict(threading.Lock)
+        self._stripes = [threading.Lock() for _ in xrange(LOCK_STRIPES)]
+        self._trans_local = threading.local()
+        self._no_lock = TunlDBLocks([])
+        self._memory_lock = threading.RLock()
+        self._expire_heap = []
+        self._expire_cond = threading.Condition(threading.Lock())
+        self._expire_thread = None
+        self._journal_file = None
+        self._journal_id = None
+        self._journal_ids = []
+        self._journal_lines = []
+        self._journal_lock = threading.Lock()
+        self._journal_local = threading.local()
+        self._loading = False
+        self._max_memory = None
+        self._eviction = LRU
+        self._memory = 0
+        self._sizes = {}
+        self._pinned = set()
+        self._evictable = []
+        self._evictable_index = {}
+        self._stats = collections.Counter()
 
     def _put_queue(self):
         if self._path:
             self._set_queue.put('set')
 
+    def _journal_encode(self, *op):
+        # Ops are encoded before the data is changed so an op that can not
+        # be encoded will not leave the data and journal out of sync
+        if self._journal_file:
+            return json.dumps(op)
+
+    def _journal(self, op):
+        if not op or not self._journal_file:
+            return
+
+        # Ops from a transaction are written as a single record
+        ops = getattr(self._journal_local, 'ops', None)
+        if ops is not None:
+            ops.append(op)
+            return
+
+        line = '[' + op + ']'
+        with self._journal_lock:
+            self._journal_lines.append(line)
+
+    def _journal_open(self):
+        journal_path = self._path + '.journal'
+        self._journal_id = uuid.uuid4().hex
+        self._journal_file = open(journal_path, 'w')
+        os.chmod(journal_path, 0600)
+        self._journal_file.write(json.dumps({'id': self._journal_id}) + '\n')
+        self._journal_file.flush()
+
+    def _journal_flush(self):
+        with self._journal_lock:
+            lines = self._journal_lines
+            self._journal_lines = []
+            if lines:
+                self._journal_file.write('\n'.join(lines) + '\n')
+                self._journal_file.flush()
+            size = self._journal_file.tell()
+
+        if size > JOURNAL_COMPACT_SIZE:
+            self.compact()
+
+    def compact(self):
+        # Rotate the journal then build a snapshot from the last snapshot
+        # and rotated journal in a separate db. The live data is not used
+        # to keep the snapshot consistent with the journal cut.
+        if not self._journal_file:
+            return
+        compact_path = self._path + '.journal.compact'
+
+        with self._journal_lock:
+            if self._journal_lines:
+                self._journal_file.write(
+                    '\n'.join(self._journal_lines) + '\n')
+                self._journal_lines = []
+            self._journal_file.close()
+            os.rename(self._path + '.journal', compact_path)
+            self._journal_open()
+
+        compact_db = TunlDB()
+        compact_db._path = self._path
+        compact_db._binary = self._binary
+        compact_db._loading = True
+        compact_db._load_snapshot()
+        compact_db._load_journal(compact_path)
+        compact_db.export_data()
+        os.remove(compact_path)
+
+    def _replay(self, ops):
+        for op in ops:
+            getattr(self, op[0])(*op[1:])
+
     def _export_thread(self):
         while True:
             try:
@@ -59,17 +326,296 @@ class TunlDB(object):
                     self._set_queue.get(timeout=0.01)
                 except Queue.Empty:
                     pass
-            self.export_data()
+            if self._journal_file:
+                self._journal_flush()
+            else:
+                self.export_data()
+
+    def _get_data(self, key, locked=False):
+        # Expired keys are removed on access before the expire thread runs
+        # when the caller holds the key stripe
+        data = self._data.get(key)
+        if not data:
+            self._stats['misses'] += 1
+            return
+        if data.ttl and data.ttl <= int(time.time() * 1000):
+            self._stats['misses'] += 1
+            if locked:
+                self._delete(key)
+            return
+
+        self._stats['hits'] += 1
+        if self._max_memory:
+            if self._eviction == LFU:
+                data.access += 1
+            else:
+                data.access = time.time()
+        return data
+
+    def _entry(self, key):
+        data = self._data.get(key)
+        if data is None:
+            data = self._data[key] = TunlDBEntry()
+        return data
+
+    def _stripe(self, key):
+        # Keys in a transaction are already locked by the transaction
+        if getattr(self._trans_local, 'locked', False):
+            return self._no_lock
+        return self._stripes[hash(key) % LOCK_STRIPES]
+
+    def _stripes_lock(self, keys):
+        if getattr(self._trans_local, 'locked', False):
+            return self._no_lock
+        return TunlDBLocks([self._stripes[x] for x in sorted(
+            {hash(key) % LOCK_STRIPES for key in keys})])
+
+    def _writable(self, data):
+        # Copy on write for values shared with an iterator or snapshot
+        if data.shared:
+            data.val = copy.copy(data.val)
+            data.shared = False
+        return data.val
+
+    def _shared(self, key):
+        with self._stripe(key):
+            data = self._get_data(key, True)
+            if data:
+                data.shared = True
+                return data.val
+
+    def _value_size(self, value):
+        if value is None:
+            return 0
+        elif isinstance(value, basestring):
+            return len(value)
+        elif isinstance(value, dict):
+            return sum([len(x) + len(y or '') + ELEMENT_OVERHEAD
+                for x, y in value.items()])
+        try:
+            return sum([len(x or '') + ELEMENT_OVERHEAD for x in value])
+        except TypeError:
+            return ELEMENT_OVERHEAD
+
+    def _account(self, key, delta=None):
+        # Approximate size of each key, when delta is not set the size is
+        # calculated from the current value
+        if not self._max_memory:
+            return
+
+        data = self._data.get(key)
+        if not data:
+            return
+
+        with self._memory_lock:
+            cur_size = self._sizes.get(key)
+            if cur_size is None:
+                if self._eviction == LFU:
+                    data.access = 1
+                else:
+                    data.access = time.time()
+                if not data.ttl and key not in self._pinned:
+                    self._evictable_add(key)
+
+            if cur_size is None or delta is None:
+                size = ENTRY_OVERHEAD + len(key) + self._value_size(data.val)
+            else:
+                size = cur_size + delta
+
+            self._sizes[key] = size
+            self._memory += size - (cur_size or 0)
+            over_limit = self._memory > self._max_memory
+
+        if over_limit:
+            self._evict(key)
+
+    def _unaccount(self, key):
+        with self._memory_lock:
+            size = self._sizes.pop(key, None)
+            if size is not None:
+                self._memory -= size
+            self._evictable_remove(key)
+
+    def _evictable_add(self, key):
+        with self._memory_lock:
+            if key in self._evictable_index:
+                return
+            self._evictable_index[key] = len(self._evictable)
+            self._evictable.append(key)
+
+    def _evictable_remove(self, key):
+        with self._memory_lock:
+            index = self._evictable_index.pop(key, None)
+            if index is None:
+                return
+            last_key = self._evictable.pop()
+            if last_key != key:
+                self._evictable[index] = last_key
+                self._evictable_index[last_key] = index
+
+    def _evict_sample(self, exclude_key):
+        count = len(self._evictable)
+        evict_key = None
+        evict_access = None
+
+        for key in random.sample(self._evictable,
+                min(EVICTION_SAMPLES, count)):
+            if key == exclude_key:
+                continue
+            data = self._data.get(key)
+            if not data:
+                self._unaccount(key)
+                return
+            if evict_key is None or data.access < evict_access:
+                evict_key = key
+                evict_access = data.access
+
+        return evict_key
+
+    def _evict(self, exclude_key=None):
+        # Approximated eviction, the least recently or frequently used key
+        # from a random sample of keys without a ttl is removed. Keys locked
+        # by another thread are skipped, the caller may already hold a
+        # stripe and waiting could deadlock. The key being written is
+        # excluded, with lfu it would otherwise always be sampled first.
+        busy = 0
+        while busy < EVICTION_SAMPLES:
+            with self._memory_lock:
+                if self._memory <= self._max_memory or not self._evictable:
+                    return
+                evict_key = self._evict_sample(exclude_key)
+
+            if evict_key is None:
+                busy += 1
+                continue
+
+            lock = self._stripes[hash(evict_key) % LOCK_STRIPES]
+            if not lock.acquire(False):
+                busy += 1
+                continue
+            try:
+                if evict_key not in self._sizes:
+                    continue
+                self._stats['evictions'] += 1
+                self._stats['evicted_bytes'] += self._sizes.get(evict_key, 0)
+                self._delete(evict_key)
+            finally:
+                lock.release()
+
+    def _recount(self):
+        with self._memory_lock:
+            self._memory = 0
+            self._sizes = {}
+            self._evictable = []
+            self._evictable_index = {}
+
+            if self._max_memory:
+                for key in self._data.keys():
+                    self._account(key)
+
+    def set_memory_limit(self, max_memory, eviction=LRU):
+        if eviction not in (LRU, LFU):
+            raise ValueError('Unknown eviction policy')
+        self._max_memory = max_memory
+        self._eviction = eviction
+        self._recount()
+
+    def pin(self, key):
+        self._pinned.add(key)
+        self._evictable_remove(key)
+
+    def unpin(self, key):
+        self._pinned.discard(key)
+        data = self._data.get(key)
+        if data and not data.ttl and key in self._sizes:
+            self._evictable_add(key)
+
+    def get_stats(self):
+        return {
+            'keys': len(self._data),
+            'memory': self._memory,
+            'max_memory': self._max_memory,
+            'eviction': self._eviction,
+            'pinned': len(self._pinned),
+            'hits': self._stats['hits'],
+            'misses': self._stats['misses'],
+            'evictions': self._stats['evictions'],
+            'evicted_bytes': self._stats['evicted_bytes'],
+        }
+
+    def _schedule(self, ttl_time, expire_type, key):
+        # Keys are scheduled once loading is complete
+        if self._loading:
+            return
+
+        with self._expire_cond:
+            if not self._expire_thread:
+                self._expire_thread = threading.Thread(
+                    target=self._expire_thread_run)
+                self._expire_thread.daemon = True
+                self._expire_thread.start()
+
+            entry = (ttl_time, expire_type, key)
+            heapq.heappush(self._expire_heap, entry)
+            if self._expire_heap[0] is entry:
+                self._expire_cond.notify()
+
+    def _expire_thread_run(self):
+        while True:
+            with self._expire_cond:
+                while True:
+                    if not self._expire_heap:
+                        self._expire_cond.wait()
+                        continue
+
+                    delay = (self._expire_heap[0][0] -
+                        int(time.time() * 1000)) / 1000.0
+                    if delay <= 0:
+                        ttl_time, expire_type, key = heapq.heappop(
+                            self._expire_heap)
+                        break
+                    self._expire_cond.wait(delay)
+
+            # Heap entries are not removed when a ttl is changed, entries
+            # that do not match the current ttl are skipped or rescheduled
+            if expire_type == EXPIRE_KEY:
+                with self._stripe(key):
+                    data = self._data.get(key)
+                    if not data or not data.ttl:
+                        continue
+                    elif data.ttl > ttl_time:
+                        self._schedule(data.ttl, EXPIRE_KEY, key)
+                    else:
+                        self._delete(key)
+            else:
+                with self._channels_lock:
+                    channel = self._channels.get(key)
+                    if not channel or not channel.ttl:
+                        continue
+                    elif channel.ttl > ttl_time:
+                        self._schedule(channel.ttl, EXPIRE_CHANNEL, key)
+                    else:
+                        self._clear_channel(key)
 
     def _validate(self, value):
         if value is not None and not isinstance(value, basestring):
             raise TypeError('Value must be string')
 
-    def persist(self, path, auto_export=True):
+    def persist(self, path, auto_export=True, journal=False, binary=False):
         if self._path:
             raise ValueError('Persist is already set')
         self._path = path
+        self._binary = binary
         self.import_data()
+        if journal:
+            # Write the replayed state to a new snapshot and start an
+            # empty journal, mutations are then appended to the journal
+            self.export_data()
+            for journal_path in (path + '.journal.compact',
+                    path + '.journal'):
+                if os.path.isfile(journal_path):
+                    os.remove(journal_path)
+            self._journal_open()
         if auto_export:
             export_thread = threading.Thread(target=self._export_thread)
             export_thread.daemon = True
@@ -77,381 +623,468 @@ class TunlDB(object):
 
     def set(self, key, value):
         self._validate(value)
-        self._data[key]['val'] = value
-        self._put_queue()
+        op = self._journal_encode('set', key, value)
+        with self._stripe(key):
+            self._get_data(key, True)
+            self._entry(key).val = value
+            self._account(key)
+            self._journal(op)
+            self._put_queue()
 
     def get(self, key):
-        data = self._data.get(key)
+        data = self._get_data(key)
         if data:
-            return data['val']
+            return data.val
 
     def exists(self, key):
-        return key in self._data
+        return self._get_data(key) is not None
 
     def rename(self, key, new_key):
-        data = self._data.get(key)
-        if data:
-            self._data[new_key]['val'] = data['val']
-            self.remove(key)
-            self._put_queue()
+        op = self._journal_encode('rename', key, new_key)
+        with self._stripes_lock((key, new_key)):
+            data = self._get_data(key, True)
+            if data:
+                self._get_data(new_key, True)
+                new_data = self._entry(new_key)
+                new_data.val = data.val
+                new_data.shared = data.shared
+                self._data.pop(key, None)
+                self._unaccount(key)
+                self._account(new_key)
+                self._journal(op)
+                self._put_queue()
 
     def remove(self, key):
+        with self._stripe(key):
+            self._delete(key)
+
+    def _delete(self, key):
+        op = self._journal_encode('remove', key)
         self._data.pop(key, None)
+        self._unaccount(key)
+        self._journal(op)
         self._put_queue()
 
     def expire(self, key, ttl):
-        ttl_time = int(time.time() * 1000) + (ttl * 1000)
+        self._expire_at(key, int(time.time() * 1000) + int(ttl * 1000))
 
-        cur_timer = self._timers.pop(key, None)
-        if cur_timer:
-            cur_timer.cancel()
-        timer = threading.Timer(ttl, self.remove, (key,))
-        timer.daemon = True
-        self._timers[key] = timer
-        timer.start()
+    def _expire_at(self, key, ttl_time):
+        op = self._journal_encode('_expire_at', key, ttl_time)
+        with self._stripe(key):
+            # A later ttl will be rescheduled by the expire thread when the
+            # current heap entry is reached
+            data = self._get_data(key, True)
+            cur_ttl = data.ttl if data else None
+            self._entry(key).ttl = ttl_time
+            if not cur_ttl or ttl_time < cur_ttl:
+                self._schedule(ttl_time, EXPIRE_KEY, key)
 
-        self._data[key]['ttl'] = ttl_time
-        self._put_queue()
+            # Keys with a ttl are not evicted
+            self._account(key)
+            self._evictable_remove(key)
+
+            self._journal(op)
+            self._put_queue()
 
     def increment(self, key):
-        value = '1'
-        data = self._data.get(key)
-        if data:
-            try:
-                value = str(int(data['val']) + 1)
-                data['val'] = value
-            except (TypeError, ValueError):
-                data['val'] = value
-        else:
-            self._data[key]['val'] = value
-        self._put_queue()
-        return value
+        op = self._journal_encode('increment', key)
+        with self._stripe(key):
+            value = '1'
+            data = self._get_data(key, True)
+            if data:
+                try:
+                    value = str(int(data.val) + 1)
+                    data.val = value
+                except (TypeError, ValueError):
+                    data.val = value
+            else:
+                self._entry(key).val = value
+            self._account(key)
+            self._journal(op)
+            self._put_queue()
+            return value
 
     def decrement(self, key):
-        value = '-1'
-        data = self._data.get(key)
-        if data:
-            try:
-                value = str(int(data['val']) - 1)
-                data['val'] = value
-            except (TypeError, ValueError):
-                data['val'] = value
-        else:
-            self._data[key]['val'] = value
-        self._put_queue()
-        return value
+        op = self._journal_encode('decrement', key)
+        with self._stripe(key):
+            value = '-1'
+            data = self._get_data(key, True)
+            if data:
+                try:
+                    value = str(int(data.val) - 1)
+                    data.val = value
+                except (TypeError, ValueError):
+                    data.val = value
+            else:
+                self._entry(key).val = value
+            self._account(key)
+            self._journal(op)
+            self._put_queue()
+            return value
 
     def keys(self):
-        return set(self._data)
+        cur_time = int(time.time() * 1000)
+        return {x for x, y in self._data.items()
+            if not y.ttl or y.ttl > cur_time}
 
     def set_add(self, key, element):
         self._validate(element)
-        data = self._data.get(key)
-        if data:
-            try:
-                data['val'].add(element)
-            except AttributeError:
-                data['val'] = {element}
-        else:
-            self._data[key]['val'] = {element}
-        self._put_queue()
+        op = self._journal_encode('set_add', key, element)
+        with self._stripe(key):
+            data = self._get_data(key, True)
+            if data:
+                try:
+                    self._writable(data).add(element)
+                except AttributeError:
+                    data.val = {element}
+            else:
+                self._entry(key).val = {element}
+            self._account(key)
+            self._journal(op)
+            self._put_queue()
 
     def set_remove(self, key, element):
-        data = self._data.get(key)
-        if data:
-            try:
-                data['val'].remove(element)
-                self._put_queue()
-            except (KeyError, AttributeError):
-                pass
+        op = self._journal_encode('set_remove', key, element)
+        with self._stripe(key):
+            data = self._get_data(key, True)
+            if data:
+                try:
+                    self._writable(data).remove(element)
+                    self._account(key, -len(element or '') - ELEMENT_OVERHEAD)
+                    self._journal(op)
+                    self._put_queue()
+                except (KeyError, AttributeError):
+                    pass
 
     def set_pop(self, key):
-        value = None
-        data = self._data.get(key)
-        if data:
-            try:
-                value = data['val'].pop()
-                self._put_queue()
-            except (KeyError, AttributeError):
-                pass
-        return value
+        with self._stripe(key):
+            value = None
+            data = self._get_data(key, True)
+            if data:
+                try:
+                    value = self._writable(data).pop()
+                    # Element popped from set is random, replay as a remove
+                    self._account(key, -len(value or '') - ELEMENT_OVERHEAD)
+                    self._journal(self._journal_encode(
+                        'set_remove', key, value))
+                    self._put_queue()
+                except (KeyError, AttributeError):
+                    pass
+            return value
 
     def set_exists(self, key, element):
-        data = self._data.get(key)
+        data = self._get_data(key)
         if data:
             try:
-                return element in data['val']
+                return element in data.val
             except (TypeError, AttributeError):
                 pass
         return False
 
     def set_elements(self, key):
-        data = self._data.get(key)
+        data = self._get_data(key)
         if data:
             try:
-                return data['val'].copy()
+                return data.val.copy()
             except AttributeError:
                 pass
         return set()
 
     def set_iter(self, key):
-        data = self._data.get(key)
-        if data:
-            try:
-                for value in data['val'].copy():
-                    yield value
-            except AttributeError:
-                pass
+        value = self._shared(key)
+        if isinstance(value, set):
+            for element in value:
+                yield element
 
     def set_length(self, key):
-        data = self._data.get(key)
+        data = self._get_data(key)
         if data:
             try:
-                return len(data['val'])
+                return len(data.val)
             except TypeError:
                 pass
         return 0
 
     def list_lpush(self, key, value):
         self._validate(value)
-        data = self._data.get(key)
-        if data:
-            try:
-                data['val'].appendleft(value)
-            except AttributeError:
-                data['val'] = collections.deque([value])
-        else:
-            self._data[key]['val'] = collections.deque([value])
-        self._put_queue()
+        op = self._journal_encode('list_lpush', key, value)
+        with self._stripe(key):
+            data = self._get_data(key, True)
+            if data:
+                try:
+                    self._writable(data).appendleft(value)
+                except AttributeError:
+                    data.val = collections.deque([value])
+            else:
+                self._entry(key).val = collections.deque([value])
+            self._account(key, len(value or '') + ELEMENT_OVERHEAD)
+            self._journal(op)
+            self._put_queue()
 
     def list_rpush(self, key, value):
         self._validate(value)
-        data = self._data.get(key)
-        if data:
-            try:
-                data['val'].append(value)
-            except AttributeError:
-                data['val'] = collections.deque([value])
-        else:
-            self._data[key]['val'] = collections.deque([value])
-        self._put_queue()
+        op = self._journal_encode('list_rpush', key, value)
+        with self._stripe(key):
+            data = self._get_data(key, True)
+            if data:
+                try:
+                    self._writable(data).append(value)
+                except AttributeError:
+                    data.val = collections.deque([value])
+            else:
+                self._entry(key).val = collections.deque([value])
+            self._account(key, len(value or '') + ELEMENT_OVERHEAD)
+            self._journal(op)
+            self._put_queue()
 
     def list_lpop(self, key):
-        value = None
-        data = self._data.get(key)
-        if data:
-            try:
-                value = data['val'].popleft()
-                self._put_queue()
-            except (AttributeError, IndexError):
-                pass
-        return value
+        op = self._journal_encode('list_lpop', key)
+        with self._stripe(key):
+            value = None
+            data = self._get_data(key, True)
+            if data:
+                try:
+                    value = self._writable(data).popleft()
+                    self._account(key, -len(value or '') - ELEMENT_OVERHEAD)
+                    self._journal(op)
+                    self._put_queue()
+                except (AttributeError, IndexError):
+                    pass
+            return value
 
     def list_rpop(self, key):
-        value = None
-        data = self._data.get(key)
-        if data:
-            try:
-                value = data['val'].pop()
-                self._put_queue()
-            except (AttributeError, IndexError):
-                pass
-        return value
+        op = self._journal_encode('list_rpop', key)
+        with self._stripe(key):
+            value = None
+            data = self._get_data(key, True)
+            if data:
+                try:
+                    value = self._writable(data).pop()
+                    self._account(key, -len(value or '') - ELEMENT_OVERHEAD)
+                    self._journal(op)
+                    self._put_queue()
+                except (AttributeError, IndexError):
+                    pass
+            return value
 
     def list_index(self, key, index):
-        data = self._data.get(key)
+        data = self._get_data(key)
         if data:
             try:
-                return data['val'][index]
+                return data.val[index]
             except (AttributeError, IndexError):
                 pass
 
     def list_elements(self, key):
-        data = self._data.get(key)
+        data = self._get_data(key)
         if data:
             try:
-                return list(data['val'])
+                return list(data.val)
             except TypeError:
                 pass
         return []
 
     def list_iter(self, key):
-        data = self._data.get(key)
-        if data:
-            try:
-                for value in copy.copy(data['val']):
-                    yield value
-            except TypeError:
-                pass
+        value = self._shared(key)
+        if isinstance(value, collections.deque):
+            for element in value:
+                yield element
 
     def list_iter_range(self, key, start, stop=None):
-        data = self._data.get(key)
-        if data:
-            try:
-                for value in itertools.islice(
-                        copy.copy(data['val']), start, stop):
-                    yield value
-            except TypeError:
-                pass
+        value = self._shared(key)
+        if isinstance(value, collections.deque):
+            for element in itertools.islice(value, start, stop):
+                yield element
 
     def list_remove(self, key, value, count=1):
         self._validate(value)
-        data = self._data.get(key)
-        if data:
-            if count:
-                try:
-                    [data['val'].remove(value) for _ in xrange(count)]
-                except (AttributeError, ValueError):
-                    pass
-            else:
-                try:
-                    while True:
-                        data['val'].remove(value)
-                except (AttributeError, ValueError):
-                    pass
-            self._put_queue()
+        op = self._journal_encode('list_remove', key, value, count)
+        with self._stripe(key):
+            data = self._get_data(key, True)
+            if data:
+                if count:
+                    try:
+                        [self._writable(data).remove(value) for _ in xrange(count)]
+                    except (AttributeError, ValueError):
+                        pass
+                else:
+                    try:
+                        while True:
+                            self._writable(data).remove(value)
+                    except (AttributeError, ValueError):
+                        pass
+                self._account(key)
+                self._journal(op)
+                self._put_queue()
 
     def list_length(self, key):
-        data = self._data.get(key)
+        data = self._get_data(key)
         if data:
             try:
-                return len(data['val'])
+                return len(data.val)
             except TypeError:
                 pass
         return 0
 
     def dict_set(self, key, field, value):
         self._validate(value)
-        data = self._data.get(key)
-        if data:
-            try:
-                data['val'][field] = value
-            except TypeError:
-                data['val'] = {field: value}
-        else:
-            self._data[key]['val'] = {field: value}
-        self._put_queue()
+        op = self._journal_encode('dict_set', key, field, value)
+        with self._stripe(key):
+            data = self._get_data(key, True)
+            if data:
+                try:
+                    self._writable(data)[field] = value
+                except TypeError:
+                    data.val = {field: value}
+            else:
+                self._entry(key).val = {field: value}
+            self._account(key)
+            self._journal(op)
+            self._put_queue()
 
     def dict_get(self, key, field):
-        data = self._data.get(key)
+        data = self._get_data(key)
         if data:
             try:
-                return data['val'].get(field)
+                return data.val.get(field)
             except TypeError:
                 pass
 
     def dict_remove(self, key, field):
-        data = self._data.get(key)
-        if data:
-            try:
-                data['val'].pop(field, None)
-            except AttributeError:
-                pass
-            self._put_queue()
+        op = self._journal_encode('dict_remove', key, field)
+        with self._stripe(key):
+            data = self._get_data(key, True)
+            if data:
+                try:
+                    self._writable(data).pop(field, None)
+                except AttributeError:
+                    pass
+                self._account(key)
+                self._journal(op)
+                self._put_queue()
 
     def dict_keys(self, key):
-        data = self._data.get(key)
+        data = self._get_data(key)
         if data:
             try:
-                return set(data['val'])
+                return set(data.val)
             except AttributeError:
                 pass
         return set()
 
     def dict_values(self, key):
-        data = self._data.get(key)
+        data = self._get_data(key)
         if data:
             try:
-                return set(data['val'].values())
+                return set(data.val.values())
             except AttributeError:
                 pass
         return set()
 
     def dict_iter(self, key):
-        data = self._data.get(key)
-        if data:
-            data_copy = data['val'].copy()
-            try:
-                for field in data_copy:
-                    yield field, data_copy[field]
-            except (TypeError, AttributeError):
-                pass
+        value = self._shared(key)
+        if isinstance(value, dict):
+            for field in value:
+                yield field, value[field]
 
     def dict_get_all(self, key):
-        data = self._data.get(key)
+        data = self._get_data(key)
         if data:
             try:
-                return data['val'].copy()
+                return data.val.copy()
             except AttributeError:
                 pass
         return {}
 
     def _clear_channel(self, channel):
-        if not self._channels[channel]['subs']:
+        # Channels lock must be held
+        chan = self._channels[channel]
+        if not chan.subs:
             self._channels.pop(channel, None)
         else:
-            self._channels[channel]['timer'] = None
-            self._channels[channel]['msgs'] = collections.deque(
-                maxlen=CHANNEL_BUFFER)
+            with chan.cond:
+                chan.ttl = None
+                chan.ring = [None] * CHANNEL_BUFFER
+                chan.first = chan.seq
+
+    def _channel(self, channel, subscribe=False):
+        with self._channels_lock:
+            chan = self._channels.get(channel)
+            if chan is None:
+                chan = self._channels[channel] = TunlDBChannel()
+            if subscribe:
+                chan.subs += 1
+            return chan
 
-    def subscribe(self, channel, timeout=None):
-        event = threading.Event()
-        self._channels[channel]['subs'].add(event)
+    def subscribe(self, channel, timeout=None, missed=False):
+        chan = self._channel(channel, True)
         try:
-            try:
-                cursor = self._channels[channel]['msgs'][-1][0]
-            except IndexError:
-                cursor = None
+            with chan.cond:
+                cursor = chan.seq
+
             while True:
-                if not cursor:
-                    cursor_found = True
-                else:
-                    cursor_found = False
-                if not event.wait(timeout):
-                    break
-                event.clear()
-                messages = copy.copy(self._channels[channel]['msgs'])
+                with chan.cond:
+                    if cursor == chan.seq:
+                        chan.cond.wait(timeout)
+                        if cursor == chan.seq:
+                            break
+
+                    seq = chan.seq
+                    start = max(cursor, chan.first, seq - CHANNEL_BUFFER)
+                    messages = [chan.ring[x % CHANNEL_BUFFER]
+                        for x in xrange(start, seq)]
+
+                if missed and start > cursor:
+                    yield TunlDBMissed(start - cursor)
+                cursor = seq
+
                 for message in messages:
-                    if cursor_found:
-                        yield message[1]
-                    elif message[0] == cursor:
-                        cursor_found = True
-                if not cursor_found:
-                    for message in messages:
-                        yield message[1]
-                try:
-                    cursor = messages[-1][0]
-                except IndexError:
-                    cursor = None
+                    yield message
         finally:
-            try:
-                self._channels[channel]['subs'].remove(event)
-            except KeyError:
-                pass
+            with self._channels_lock:
+                chan.subs -= 1
 
     def publish(self, channel, message):
-        cur_timer = self._channels[channel]['timer']
-        if cur_timer:
-            cur_timer.cancel()
-        timer = threading.Timer(CHANNEL_TTL, self._clear_channel, (channel,))
-        timer.daemon = True
-        self._channels[channel]['timer'] = timer
-        timer.start()
-
-        self._channels[channel]['msgs'].append((uuid.uuid4().hex, message))
-        for subscriber in self._channels[channel]['subs'].copy():
-            subscriber.set()
+        ttl_time = int(time.time() * 1000) + CHANNEL_TTL * 1000
+        chan = self._channel(channel)
+
+        with chan.cond:
+            cur_ttl = chan.ttl
+            chan.ttl = ttl_time
+            chan.ring[chan.seq % CHANNEL_BUFFER] = message
+            chan.seq += 1
+            chan.cond.notify_all()
+
+        if not cur_ttl:
+            self._schedule(ttl_time, EXPIRE_CHANNEL, channel)
 
     def transaction(self):
         return TunlDBTransaction(self)
 
     def _apply_trans(self, trans):
+        # All keys in the transaction are locked until the transaction is
+        # removed from the commit log so exports see all or none of it
+        keys = set()
         for call in trans[1]:
-            getattr(self, call[0])(*call[1], **call[2])
-        try:
-            self._commit_log.remove(trans)
-        except ValueError:
-            pass
+            keys.update(call[1][:2] if call[0] == 'rename' else call[1][:1])
+
+        with self._stripes_lock(keys):
+            self._journal_local.ops = []
+            self._trans_local.locked = True
+            try:
+                for call in trans[1]:
+                    getattr(self, call[0])(*call[1], **call[2])
+            finally:
+                self._trans_local.locked = False
+                ops = self._journal_local.ops
+                self._journal_local.ops = None
+
+            if ops and self._journal_file:
+                line = '[' + ','.join(ops) + ']'
+                with self._journal_lock:
+                    self._journal_lines.append(line)
+
+            self._commit_log.pop(trans[0], None)
         self._put_queue()
 
     def lock_acquire(self, key):
@@ -468,22 +1101,39 @@ class TunlDB(object):
         self._locks.pop(key, None)
         return TunlDBTransaction(self)
 
+    def _snapshot(self):
+        # Consistent view of all keys taken with every stripe locked. Values
+        # are marked shared instead of copied, writers copy a shared value
+        # before the next mutation.
+        with TunlDBLocks(self._stripes):
+            items = []
+            for key, data in self._data.iteritems():
+                data.shared = True
+                items.append((key, data.ttl, data.val))
+            commit_log = self._commit_log.values()
+            journal_ids = list(self._journal_ids)
+
+        return items, commit_log, journal_ids
+
     def export_data(self):
         if not self._path:
             return
         temp_path = self._path + '_%s.tmp' % uuid.uuid4().hex
         try:
-            data = self._data.copy()
-            timers = self._timers.keys()
-            commit_log = copy.copy(self._commit_log)
+            items, commit_log, journal_ids = self._snapshot()
+            timers = [x[0] for x in items if x[1]]
+
+            if self._binary:
+                self._export_binary(temp_path, items, timers, commit_log,
+                    journal_ids)
+                os.rename(temp_path, self._path)
+                return
 
             with open(temp_path, 'w') as db_file:
                 os.chmod(temp_path, 0600)
                 export_data = []
 
-                for key in data:
-                    key_ttl = data[key]['ttl']
-                    key_val = data[key]['val']
+                for key, key_ttl, key_val in items:
                     key_type = type(key_val).__name__
                     if key_type == 'set' or key_type == 'deque':
                         key_val = list(key_val)
@@ -494,6 +1144,7 @@ class TunlDB(object):
                     'data': export_data,
                     'timers': timers,
                     'commit_log': commit_log,
+                    'journal': journal_ids,
                 }))
             os.rename(temp_path, self._path)
         except:
@@ -503,48 +1154,122 @@ class TunlDB(object):
                 pass
             raise
 
-    def import_data(self):
-        if os.path.isfile(self._path):
-            with open(self._path, 'r') as db_file:
+    def _export_binary(self, temp_path, items, timers, commit_log,
+            journal_ids):
+        # Magic, length prefixed json header then a count prefixed list of
+        # length prefixed records with typed values
+        header = json.dumps({
+            'timers': timers,
+            'commit_log': commit_log,
+            'journal': journal_ids,
+        })
+
+        with open(temp_path, 'wb') as db_file:
+            os.chmod(temp_path, 0600)
+            db_file.write(SNAPSHOT_MAGIC)
+            db_file.write(_snapshot_len.pack(len(header)))
+            db_file.write(header)
+            db_file.write(_snapshot_len.pack(len(items)))
+
+            records = []
+            for key, key_ttl, key_val in items:
+                records.append(_snapshot_encode(key, key_ttl, key_val))
+                if len(records) >= 1024:
+                    db_file.write(''.join(records))
+                    records = []
+            db_file.write(''.join(records))
+
+    def _load_binary(self, db_file):
+        buf = mmap.mmap(db_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            offset = len(SNAPSHOT_MAGIC)
+            header_len = _snapshot_len.unpack_from(buf, offset)[0]
+            offset += 4
+            header = json.loads(buf[offset:offset + header_len])
+            offset += header_len
+            count = _snapshot_len.unpack_from(buf, offset)[0]
+            offset += 4
+
+            for _ in xrange(count):
+                key, key_ttl, key_val, offset = _snapshot_decode(buf, offset)
+                self._data[key] = TunlDBEntry(key_val, key_ttl)
+        finally:
+            buf.close()
+
+        return header
+
+    def _load_snapshot(self):
+        if not os.path.isfile(self._path) or \
+                not os.path.getsize(self._path):
+            return
+
+        with open(self._path, 'rb') as db_file:
+            if db_file.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC:
+                import_data = self._load_binary(db_file)
+                import_data['data'] = []
+            else:
+                db_file.seek(0)
                 import_data = json.loads(db_file.read())
-                data = import_data['data']
-
-                for key_data in data:
-                    key = key_data[0]
-                    key_type = key_data[1]
-                    key_ttl = key_data[2]
-                    key_val = key_data[3]
-
-                    if key_type == 'set':
-                        key_val = set(key_val)
-                    elif key_type == 'deque':
-                        key_val = collections.deque(key_val)
-
-                    self._data[key] = {
-                        'ttl': key_ttl,
-                        'val': key_val,
-                    }
-
-                if 'timers' in import_data:
-                    for key in import_data['timers']:
-                        if key not in self._data:
-                            continue
-                        ttl = self._data[key]['ttl']
-                        if not ttl:
-                            continue
-                        ttl -= int(time.time() * 1000)
-                        ttl = ttl / 1000.0
-                        if ttl >= 0:
-                            timer = threading.Timer(ttl, self.remove, (key,))
-                            timer.daemon = True
-                            self._timers[key] = timer
-                            timer.start()
-                        else:
-                            self.remove(key)
-
-                if 'commit_log' in import_data:
-                    for tran in import_data['commit_log']:
-                        self._apply_trans(tran)
+            data = import_data['data']
+
+            for key_data in data:
+                key = key_data[0]
+                key_type = key_data[1]
+                key_ttl = key_data[2]
+                key_val = key_data[3]
+
+                if key_type == 'set':
+                    key_val = set(key_val)
+                elif key_type == 'deque':
+                    key_val = collections.deque(key_val)
+
+                self._data[key] = TunlDBEntry(key_val, key_ttl)
+
+            self._journal_ids = import_data.get('journal', [])
+
+            if 'commit_log' in import_data:
+                for tran in import_data['commit_log']:
+                    self._apply_trans(tran)
+
+    def _load_journal(self, journal_path):
+        if not os.path.isfile(journal_path):
+            return
+
+        with open(journal_path, 'r') as journal_file:
+            journal_id = json.loads(journal_file.readline())['id']
+            # Journal was already compacted into the snapshot
+            if journal_id in self._journal_ids:
+                return
+
+            for line in journal_file:
+                try:
+                    ops = json.loads(line)
+                except ValueError:
+                    # Incomplete last record
+                    break
+                self._replay(ops)
+
+        self._journal_ids = self._journal_ids[-7:] + [journal_id]
+
+    def import_data(self):
+        self._loading = True
+        try:
+            self._load_snapshot()
+            self._load_journal(self._path + '.journal.compact')
+            self._load_journal(self._path + '.journal')
+        finally:
+            self._loading = False
+        self._recount()
+
+        cur_time = int(time.time() * 1000)
+        for key, key_data in self._data.items():
+            ttl = key_data.ttl
+            if not ttl:
+                continue
+            elif ttl > cur_time:
+                self._schedule(ttl, EXPIRE_KEY, key)
+            else:
+                self.remove(key)
 
 class TunlDBTransaction(object):
     def __init__(self, cache):
@@ -560,6 +1285,6 @@ class TunlDBTransaction(object):
 
     def commit(self):
         trans = (uuid.uuid4().hex, self._trans)
-        self._cache._commit_log.append(trans)
+        self._cache._commit_log[trans[0]] = trans
         self._trans = []
         self._cache._apply_trans(trans)
@@ -22,6 +22,8 @@ ROLLBACK = 'rollback'
 COMPLETE = 'complete'
 ERROR = 'error'
 UPDATE = 'update'
+REMOVE = 'remove'
+RESYNC = 'resync'
 
 ONLINE = 'online'
 OFFLINE = 'offline'
@@ -93,6 +95,10 @@ VPN_OP_TIMEOUT = 30
 CLIENT_CONF_VER = 1
 MONGO_MESSAGES_SIZE = 100000
 MONGO_MESSAGES_MAX = 2048
+MESSENGER_BUFFER = 1024
+MESSENGER_GAP_GRACE = 2
+EVENT_STREAM_HEARTBEAT = 15
+EVENT_STREAM_RETRY_AFTER = 10
 MONGO_CONNECT_TIMEOUT = 2000
 AUTH_SIG_STRING_MAX_LEN = 10240
 RANDOM_ERROR_RATE = 0
@@ -353,6 +359,9 @@ USER_INVALID_MSG = 'User is not valid.'
 USER_TYPE_INVALID = 'user_type_invalid'
 USER_TYPE_INVALID_MSG = 'User type is not valid.'
 
+PAGE_TOKEN_INVALID = 'page_token_invalid'
+PAGE_TOKEN_INVALID_MSG = 'Page token is not valid.'
+
 OTP_CODE_INVALID = 'otp_code_invalid'
 OTP_CODE_INVALID_MSG = 'OTP code is not valid.'
 
@@ -371,6 +380,10 @@ SUBSCRIPTION_SERVER_ERROR = 'subscription_server_error'
 SUBSCRIPTION_SERVER_ERROR_MSG = 'Unable to connect to ' + \
     'subscription server, please try again later.'
 
+EVENT_STREAM_LIMIT = 'event_stream_limit'
+EVENT_STREAM_LIMIT_MSG = 'Too many event streams are open, ' + \
+    'use the event long poll.'
+
 RANDOM_ONE = (
     'snowy',
     'restless',
@@ -0,0 +1,168 @@
+from pritunl.constants import *
+from pritunl.exceptions import *
+from pritunl.descriptors import *
+from pritunl import mongo
+
+import collections
+import itertools
+import pymongo
+
+def _get_collection():
+    return mongo.get_collection('counters')
+
+def _get_users_id(org_id):
+    return 'users-' + org_id
+
+def inc_user_count(org_id, type, count=1):
+    _get_collection().update({
+        '_id': _get_users_id(org_id),
+    }, {
+        '$inc': {
+            'counts.' + type: count,
+            'version': 1,
+        },
+        '$setOnInsert': {
+            'type': 'users',
+            'org_id': org_id,
+        },
+    }, upsert=True)
+
+def change_user_type(org_id, old_type, new_type, count=1):
+    if old_type == new_type or not count:
+        return
+    _get_collection().update({
+        '_id': _get_users_id(org_id),
+    }, {'$inc': {
+        'counts.' + old_type: -count,
+        'counts.' + new_type: count,
+        'version': 1,
+    }})
+
+def remove_user_count(org_id):
+    _get_collection().remove({
+        '_id': _get_users_id(org_id),
+    })
+
+def get_user_count(org_id, type=CERT_CLIENT):
+    return get_user_count_multi(org_ids=[org_id], type=type)
+
+def get_user_count_multi(org_ids=None, type=CERT_CLIENT):
+    if org_ids is None:
+        org_ids = [str(x['_id']) for x in mongo.get_collection(
+            'organizations').find({}, {'_id': True})]
+
+    spec = {
+        'type': 'users',
+        '_id': {'$in': [_get_users_id(x) for x in org_ids]},
+    }
+
+    count = 0
+    found = set()
+    for doc in _get_collection().find(spec, {
+                'org_id': True,
+                'counts.' + type: True,
+            }):
+        found.add(doc['org_id'])
+        count += doc.get('counts', {}).get(type, 0)
+
+    # Orgs without a counter are counted from the users collection
+    missing = set(org_ids) - found
+    if missing:
+        counts = reconcile_user_count(org_ids=list(missing))
+        count += sum(x.get(type, 0) for x in counts.itervalues())
+
+    return count
+
+def _reconcile_user_count(org_ids=None):
+    # Counters are versioned and only replaced when the version has not
+    # changed since the counters were read before the aggregate, returns
+    # the counts and the org ids of the counters that changed
+    user_collection = mongo.get_collection('users')
+    collection = _get_collection()
+
+    spec = {
+        'type': 'users',
+    }
+    match = {}
+    if org_ids is not None:
+        spec['org_id'] = {'$in': org_ids}
+        match['org_id'] = {'$in': org_ids}
+
+    versions = {}
+    for doc in collection.find(spec, {
+                'org_id': True,
+                'version': True,
+            }):
+        versions[doc['org_id']] = doc.get('version')
+
+    response = user_collection.aggregate([
+        {'$match': match},
+        {'$project': {
+            'org_id': True,
+            'type': True,
+        }},
+        {'$group': {
+            '_id': {
+                'org_id': '$org_id',
+                'type': '$type',
+            },
+            'count': {'$sum': 1},
+        }},
+    ])['result']
+
+    counts = collections.defaultdict(dict)
+    for org_id in itertools.chain(org_ids or (), versions):
+        counts[org_id] = {}
+    for doc in response:
+        org_id = doc['_id'].get('org_id')
+        if org_id:
+            counts[org_id][doc['_id']['type']] = doc['count']
+
+    changed = []
+    for org_id, org_counts in counts.iteritems():
+        if org_id in versions:
+            response = collection.update({
+                '_id': _get_users_id(org_id),
+                'version': versions[org_id],
+            }, {
+                '$set': {'counts': org_counts},
+                '$inc': {'version': 1},
+            })
+            if not response['updatedExisting']:
+                changed.append(org_id)
+        else:
+            try:
+                collection.insert({
+                    '_id': _get_users_id(org_id),
+                    'type': 'users',
+                    'org_id': org_id,
+                    'counts': org_counts,
+                    'version': 0,
+                })
+            except pymongo.errors.DuplicateKeyError:
+                changed.append(org_id)
+
+    return counts, changed
+
+def reconcile_user_count(org_ids=None):
+    # Replace the counters with counts from the users collection, counters
+    # of orgs that no longer exist are removed when reconciling all orgs
+    counts, changed = _reconcile_user_count(org_ids)
+    for _ in xrange(2):
+        if not changed:
+            break
+        retry_counts, changed = _reconcile_user_count(changed)
+        counts.update(retry_counts)
+
+    if org_ids is None:
+        org_ids = [str(x['_id']) for x in mongo.get_collection(
+            'organizations').find({}, {'_id': True})]
+        _get_collection().remove({
+            'type': 'users',
+            'org_id': {'$nin': org_ids},
+        })
+        for org_id in counts.keys():
+            if org_id not in org_ids:
+                counts.pop(org_id)
+
+    return counts
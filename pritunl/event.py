@@ -1,15 +1,124 @@
 from pritunl.constants import *
 from pritunl.exceptions import *
 from pritunl.descriptors import *
+from pritunl import settings
 from pritunl import messenger
 
 import time
 import bson
+import json
+import threading
+import collections
+
+_windows = {}
+_windows_lock = threading.Lock()
+_coalesce_thread = None
+_stats = collections.Counter()
+_suppressed_types = collections.Counter()
+_streams = 0
+_streams_lock = threading.Lock()
 
 class Event(object):
     def __init__(self, type, resource_id=None):
+        window = settings.app.event_coalesce_window
+
+        # Duplicate events inside the window are suppressed, a single
+        # trailing event will be sent when the window ends
+        if window:
+            key = (type, resource_id)
+            cur_time = time.time()
+
+            with _windows_lock:
+                coalesce = _windows.get(key)
+                if coalesce and cur_time < coalesce[0]:
+                    coalesce[1] = True
+                    _stats['suppressed'] += 1
+                    _suppressed_types[type] += 1
+                    return
+                _windows[key] = [cur_time + window, False]
+                _stats['published'] += 1
+
+            _start_coalesce()
+        else:
+            with _windows_lock:
+                _stats['published'] += 1
+
         messenger.publish('events', (type, resource_id))
 
+def _coalesce_thread_run():
+    from pritunl import logger
+
+    while True:
+        try:
+            window = settings.app.event_coalesce_window or 0.5
+            time.sleep(window / 2)
+
+            cur_time = time.time()
+            events = []
+
+            with _windows_lock:
+                for key, coalesce in _windows.items():
+                    if cur_time < coalesce[0]:
+                        continue
+
+                    if coalesce[1]:
+                        events.append(key)
+                        _windows[key] = [cur_time + window, False]
+                        _stats['trailing'] += 1
+                    else:
+                        _windows.pop(key)
+
+            if events:
+                with messenger.PublishBuffer():
+                    for key in events:
+                        messenger.publish('events', key)
+        except:
+            logger.exception('Error in event coalesce thread')
+            time.sleep(0.5)
+
+def _start_coalesce():
+    global _coalesce_thread
+
+    if _coalesce_thread:
+        return
+
+    with _windows_lock:
+        if _coalesce_thread:
+            return
+        _coalesce_thread = threading.Thread(target=_coalesce_thread_run)
+        _coalesce_thread.daemon = True
+        _coalesce_thread.start()
+
+def get_stats():
+    with _windows_lock:
+        return {
+            'published': _stats['published'],
+            'suppressed': _stats['suppressed'],
+            'trailing': _stats['trailing'],
+            'suppressed_types': dict(_suppressed_types),
+            'windows': len(_windows),
+            'streams': _streams,
+            'streams_rejected': _stats['streams_rejected'],
+        }
+
+def acquire_stream():
+    # Each open stream holds a web server worker until the stream timeout,
+    # streams past the limit are rejected to leave workers for requests
+    global _streams
+
+    with _streams_lock:
+        if _streams >= settings.app.event_stream_limit:
+            _stats['streams_rejected'] += 1
+            return False
+        _streams += 1
+        return True
+
+def release_stream():
+    global _streams
+
+    with _streams_lock:
+        _streams -= 1
+
 def get_events(cursor=None):
     events = []
     events_dict = {}
@@ -37,3 +146,44 @@ def get_events(cursor=None):
         events.append(event)
 
     return events
+
+def _stream_resync():
+    # Events since the last event id may be lost, the client must reload
+    # all data. The id is not sent to keep the last event id unchanged.
+    return 'data: %s\n\n' % json.dumps({
+        'id': None,
+        'type': RESYNC,
+        'resource_id': None,
+        'timestamp': time.time(),
+    })
+
+def stream_events(cursor=None):
+    yield 'retry: 1000\n\n'
+
+    if cursor is not None:
+        try:
+            cursor = bson.ObjectId(cursor)
+        except bson.errors.InvalidId:
+            cursor = None
+            yield _stream_resync()
+
+    for event in messenger.subscribe('events', cursor_id=cursor,
+            timeout=settings.app.event_stream_timeout,
+            heartbeat=EVENT_STREAM_HEARTBEAT, resync=True):
+        if event is None:
+            yield ': ping\n\n'
+            continue
+
+        if event['_id'] is None:
+            yield _stream_resync()
+            continue
+
+        event_type, resource_id = event['message']
+        event_id = str(event['_id'])
+
+        yield 'id: %s\ndata: %s\n\n' % (event_id, json.dumps({
+            'id': event_id,
+            'type': event_type,
+            'resource_id': resource_id,
+            'timestamp': time.mktime(event['timestamp'].timetuple()),
+        }))
@@ -12,6 +12,9 @@ class UserError(BaseError):
 class KeyLinkError(UserError):
     pass
 
+class PageTokenInvalid(UserError):
+    pass
+
 
 class EmailError(BaseError):
     pass
@@ -15,3 +15,26 @@ import flask
 @auth.session_auth
 def event_get(cursor=None):
     return utils.jsonify(event.get_events(cursor=cursor))
+
+@app.app.route('/event/stream', methods=['GET'])
+@auth.session_auth
+def event_stream_get():
+    cursor = flask.request.headers.get('Last-Event-ID') or \
+        flask.request.args.get('cursor')
+
+    if not event.acquire_stream():
+        response = utils.jsonify({
+            'error': EVENT_STREAM_LIMIT,
+            'error_msg': EVENT_STREAM_LIMIT_MSG,
+        }, 503)
+        response.headers.add('Retry-After', EVENT_STREAM_RETRY_AFTER)
+        return response
+
+    response = flask.Response(event.stream_events(cursor=cursor),
+        mimetype='text/event-stream')
+    # Stream is released when the response is closed even if the
+    # generator was never started
+    response.call_on_close(event.release_stream)
+    response.headers.add('Cache-Control', 'no-cache')
+    response.headers.add('X-Accel-Buffering', 'no')
+    return response
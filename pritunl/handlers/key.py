@@ -19,7 +19,7 @@ import json
 
 def _get_key_archive(org_id, user_id):
     org = organization.get_org(id=org_id)
-    user = org.get_user(user_id)
+    user = org.get_user(user_id, prefetch=True)
     key_archive = user.build_key_archive()
     response = flask.Response(response=key_archive,
         mimetype='application/octet-stream')
@@ -112,7 +112,7 @@ def user_uri_key_page_get(short_id):
         return flask.abort(404)
 
     org = organization.get_org(id=doc['org_id'])
-    user = org.get_user(id=doc['user_id'])
+    user = org.get_user(id=doc['user_id'], prefetch=True)
 
     keys = {}
     for server in org.iter_servers():
@@ -133,7 +133,7 @@ def user_linked_key_conf_get(key_id, server_id):
         return flask.abort(404)
 
     org = organization.get_org(id=doc['org_id'])
-    user = org.get_user(id=doc['user_id'])
+    user = org.get_user(id=doc['user_id'], prefetch=True)
     key_conf = user.build_key_conf(server_id)
 
     response = flask.Response(response=key_conf['conf'],
@@ -1,3 +1,5 @@
+from pritunl.cache import cache_db
+
 from pritunl.constants import *
 from pritunl.exceptions import *
 from pritunl.descriptors import *
@@ -5,6 +7,9 @@ from pritunl import utils
 from pritunl import settings
 from pritunl import server
 from pritunl import organization
+from pritunl import event
+from pritunl import messenger
+from pritunl import listener
 from pritunl import app
 from pritunl import auth
 from pritunl import __version__
@@ -49,3 +54,13 @@ def status_get():
         'local_networks': local_networks,
         'notification': notification,
     })
+
+@app.app.route('/status/stats', methods=['GET'])
+@auth.session_auth
+def status_stats_get():
+    return utils.jsonify({
+        'event': event.get_stats(),
+        'messenger': messenger.get_stats(),
+        'listener': listener.get_stats(),
+        'cache': cache_db.get_stats(),
+    })
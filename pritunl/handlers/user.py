@@ -11,6 +11,7 @@ from pritunl import app
 from pritunl import auth
 
 import flask
+import json
 import math
 import time
 import collections
@@ -26,6 +27,7 @@ def user_get(org_id, user_id=None, page=None):
 
     page = flask.request.args.get('page', None)
     page = int(page) if page else page
+    page_token = flask.request.args.get('page_token', None)
     search = flask.request.args.get('search', None)
     limit = int(flask.request.args.get('limit', settings.user.page_count))
     otp_auth = False
@@ -62,8 +64,16 @@ def user_get(org_id, user_id=None, page=None):
         'otp_secret',
         'disabled',
     )
-    for user in org.iter_users(page=page, search=search,
-            search_limit=limit, fields=fields):
+    try:
+        org_users = list(org.iter_users(page=page, search=search,
+            search_limit=limit, fields=fields, page_token=page_token))
+    except PageTokenInvalid:
+        return utils.jsonify({
+            'error': PAGE_TOKEN_INVALID,
+            'error_msg': PAGE_TOKEN_INVALID_MSG,
+        }, 400)
+
+    for user in org_users:
         user_id = user.id
         users_id.append(user_id)
         is_client = user_id in clients
@@ -102,10 +112,18 @@ def user_get(org_id, user_id=None, page=None):
             if not user_server_data['remote_address']:
                 user_server_data['remote_address'] = remote_addr
 
-    if page is not None:
+    if search is None and page_token is not None:
+        return utils.jsonify({
+            'page_token': page_token,
+            'next_page_token': org.next_page_token,
+            'server_count': server_count,
+            'users': users,
+        })
+    elif page is not None:
         return utils.jsonify({
             'page': page,
             'page_total': org.page_total,
+            'next_page_token': org.next_page_token,
             'server_count': server_count,
             'users': users,
         })
@@ -126,32 +144,74 @@ def user_get(org_id, user_id=None, page=None):
 @auth.session_auth
 def user_post(org_id):
     org = organization.get_org(id=org_id)
-    users = []
 
     if isinstance(flask.request.json, list):
-        users_data = flask.request.json
-    else:
-        users_data = [flask.request.json]
+        users_data = []
+        for user_data in flask.request.json:
+            users_data.append({
+                'name': utils.filter_str(user_data['name']),
+                'email': utils.filter_str(user_data.get('email')),
+                'disabled': user_data.get('disabled'),
+            })
+
+        if flask.request.args.get('stream'):
+            response = flask.Response(_stream_new_users(org, users_data),
+                mimetype='application/x-ndjson')
+            response.headers.add('Cache-Control', 'no-cache')
+            response.headers.add('X-Accel-Buffering', 'no')
+            return response
+
+        users = []
+        for new_users in org.new_users(users_data, type=CERT_CLIENT):
+            users += [_new_user_dict(x) for x in new_users]
+        _new_users_event(org, users)
+
+        return utils.jsonify(users)
 
-    for user_data in users_data:
-        name = utils.filter_str(user_data['name'])
-        email = utils.filter_str(user_data.get('email'))
-        disabled = user_data.get('disabled')
-        user = org.new_user(type=CERT_CLIENT, name=name, email=email,
-            disabled=disabled)
-        users.append(user.dict())
+    name = utils.filter_str(flask.request.json['name'])
+    email = utils.filter_str(flask.request.json.get('email'))
+    disabled = flask.request.json.get('disabled')
+    user = org.new_user(type=CERT_CLIENT, name=name, email=email,
+        disabled=disabled)
 
     event.Event(type=ORGS_UPDATED)
     event.Event(type=USERS_UPDATED, resource_id=org.id)
     event.Event(type=SERVERS_UPDATED)
+    logger.LogEntry(message='Created new user "%s".' % user.name)
 
-    if isinstance(flask.request.json, list):
-        logger.LogEntry(message='Created %s new users.' % len(
-            flask.request.json))
-        return utils.jsonify(users)
-    else:
-        logger.LogEntry(message='Created new user "%s".' % users[0]['name'])
-        return utils.jsonify(users[0])
+    return utils.jsonify(user.dict())
+
+def _new_user_dict(user):
+    # Queued users are committed when the init queue item completes
+    user_dict = user.dict()
+    user_dict['pending'] = not user.exists
+    return user_dict
+
+def _new_users_event(org, users):
+    # Events for pending users are sent by the init queue item
+    count = len([x for x in users if not x['pending']])
+    pending = len(users) - count
+
+    if count:
+        event.Event(type=ORGS_UPDATED)
+        event.Event(type=USERS_UPDATED, resource_id=org.id)
+        event.Event(type=SERVERS_UPDATED)
+        logger.LogEntry(message='Created %s new users.' % count)
+    if pending:
+        logger.LogEntry(message='Queued %s new users.' % pending)
+
+def _stream_new_users(org, users_data):
+    # Newline delimited json with the users created by each batch
+    users = []
+    for new_users in org.new_users(users_data, type=CERT_CLIENT):
+        new_users = [_new_user_dict(x) for x in new_users]
+        users += new_users
+        yield json.dumps({
+            'count': len(users),
+            'total': len(users_data),
+            'users': new_users,
+        }) + '\n'
+    _new_users_event(org, users)
 
 @app.app.route('/user/<org_id>/<user_id>', methods=['PUT'])
 @auth.session_auth
@@ -10,7 +10,7 @@ from pritunl import utils
 import datetime
 
 def get_host(id):
-    return Host(id=id)
+    return Host.get_by_id(id)
 
 def iter_hosts():
     for doc in Host.collection.find().sort('name'):
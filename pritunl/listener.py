@@ -5,6 +5,14 @@ from pritunl.descriptors import *
 import collections
 
 channels = collections.defaultdict(set)
+resyncs = collections.defaultdict(set)
+executors = {}
 
 def add_listener(channel, callback):
     channels[channel].add(callback)
+
+def add_resync(channel, callback):
+    resyncs[channel].add(callback)
+
+def get_stats():
+    return {x: y.get_stats() for x, y in executors.items()}
@@ -8,9 +8,101 @@ import pymongo
 import time
 import datetime
 import bson
+import threading
+import collections
+import itertools
+
+_publish_local = threading.local()
+_seq_lock = threading.Lock()
+_seq_pub_id = bson.ObjectId()
+_seq_counters = collections.defaultdict(int)
+
+def _next_seq(channel):
+    with _seq_lock:
+        _seq_counters[channel] += 1
+        return _seq_counters[channel]
+
+class PublishBuffer(object):
+    # Collects messages published from the current thread and sends them
+    # with a single insert when stopped. Nested buffers on the same thread
+    # will defer to the outer buffer unless detached, a detached buffer
+    # sends its messages when stopped and then restores the outer buffer.
+    def __init__(self, detach=False):
+        self.docs = []
+        self._nested = False
+        self._detach = detach
+        self._outer = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        outer = getattr(_publish_local, 'buffer', None)
+        if outer and not self._detach:
+            self._nested = True
+        else:
+            self._outer = outer
+            _publish_local.buffer = self
+
+    def stop(self):
+        if self._nested:
+            return
+        try:
+            self.flush()
+        finally:
+            if getattr(_publish_local, 'buffer', None) is self:
+                _publish_local.buffer = self._outer
+
+    def flush(self):
+        if not self.docs:
+            return
+        docs = self.docs
+        self.docs = []
+        _insert(docs)
+
+def get_collection_name(channel):
+    # Channels configured in messages_partitions are stored in their own
+    # capped collection created during setup
+    name = 'messages_' + channel
+    if name in mongo.collections:
+        return name
+    return 'messages'
+
+def get_collection_names(channels):
+    if isinstance(channels, str):
+        return {get_collection_name(channels)}
+    return {get_collection_name(x) for x in channels}
+
+def _insert(docs):
+    collection_docs = collections.defaultdict(list)
+    for doc in docs:
+        collection_docs[get_collection_name(doc['channel'])].append(doc)
+
+    for name, docs in collection_docs.items():
+        # Each process publishes its own sequence for every channel, a
+        # skipped seq from a publisher will be seen by subscribers as a gap.
+        # Seqs are set at insert so buffered docs can not be passed by docs
+        # published later.
+        for doc in docs:
+            doc['pub_id'] = _seq_pub_id
+            doc['seq'] = _next_seq(doc['channel'])
+
+        collection = mongo.get_collection(name)
+        if len(docs) == 1:
+            collection.insert(docs[0], manipulate=False)
+        else:
+            collection.insert(docs, manipulate=False)
+
+def flush():
+    publish_buffer = getattr(_publish_local, 'buffer', None)
+    if publish_buffer:
+        publish_buffer.flush()
 
 def publish(channels, message, extra=None, transaction=None):
-    collection = mongo.get_collection('messages')
     doc = {
         'message': message,
         'timestamp': utils.now(),
@@ -27,10 +119,10 @@ def publish(channels, message, extra=None, transaction=None):
     # When using inserts manipulate=False must be set to prevent pymongo
     # from setting ObjectId locally.
     if transaction:
-        tran_collection = transaction.collection(collection.name_str)
-
         if isinstance(channels, str):
             doc['channel'] = channels
+            tran_collection = transaction.collection(
+                get_collection_name(channels))
             tran_collection.update({
                 'nonce': bson.ObjectId(),
             }, {
@@ -41,85 +133,485 @@ def publish(channels, message, extra=None, transaction=None):
                 doc_copy = doc.copy()
                 doc_copy['channel'] = channel
 
+                tran_collection = transaction.collection(
+                    get_collection_name(channel))
                 tran_collection.bulk().find({
                     'nonce': bson.ObjectId(),
                 }).upsert().update({
                     '$set': doc_copy,
                 })
-            tran_collection.bulk_execute()
+
+            for name in get_collection_names(channels):
+                transaction.collection(name).bulk_execute()
     else:
         if isinstance(channels, str):
             doc['channel'] = channels
-            collection.insert(doc, manipulate=False)
+            docs = [doc]
         else:
             docs = []
             for channel in channels:
                 doc_copy = doc.copy()
                 doc_copy['channel'] = channel
                 docs.append(doc_copy)
-            collection.insert(docs, manipulate=False)
+
+        publish_buffer = getattr(_publish_local, 'buffer', None)
+        if publish_buffer:
+            publish_buffer.docs.extend(docs)
+        else:
+            _insert(docs)
 
 def get_cursor_id(channels):
-    collection = mongo.get_collection('messages')
-    spec = {}
+    flush()
 
+    # Use the last id seen by the hub, docs inserted before this call that
+    # the hub has not tailed yet would be after that id. The latest newer
+    # id is found with the _id index, the channel is only queried before
+    # the hub has seen any messages.
+    hub.start()
+    cursor_id = hub.get_cursor_id(channels)
+    if cursor_id:
+        for name in get_collection_names(channels):
+            collection = mongo.get_collection(name)
+            for doc in collection.find({
+                        '_id': {'$gt': cursor_id},
+                    }, {
+                        '_id': True,
+                    }).sort('_id', pymongo.DESCENDING).limit(1):
+                cursor_id = doc['_id']
+        return cursor_id
+
+    spec = {}
     if isinstance(channels, str):
         spec['channel'] = channels
     else:
         spec['channel'] = {'$in': channels}
 
     for i in xrange(2):
-        try:
-            return collection.find(spec).sort(
-                '$natural', pymongo.DESCENDING)[0]['_id']
-        except IndexError:
-            if i:
-                raise
-            else:
-                publish(channels, None)
+        flush()
+        cursor_id = None
+        for name in get_collection_names(channels):
+            collection = mongo.get_collection(name)
+            for doc in collection.find(spec, {
+                        '_id': True,
+                    }).sort('$natural', pymongo.DESCENDING).limit(1):
+                if not cursor_id or doc['_id'] > cursor_id:
+                    cursor_id = doc['_id']
 
-def subscribe(channels, cursor_id=None, timeout=None, yield_delay=None):
-    collection = mongo.get_collection('messages')
-    start_time = time.time()
-    cursor_id = cursor_id or get_cursor_id(channels)
-    while True:
-        try:
-            spec = {}
+        if cursor_id:
+            return cursor_id
+        elif i:
+            raise IndexError('No messages in channel')
+        else:
+            publish(channels, None)
+
+class SubscriptionHub(object):
+    # Single tailable cursor per process on each messages collection, docs
+    # are buffered in memory and fanned out to local subscribers. Each
+    # subscriber keeps its own position in the buffer, timeout and channels.
+    def __init__(self, buffer_size=MESSENGER_BUFFER):
+        self._running = False
+        self._start_lock = threading.Lock()
+        self._cond = threading.Condition(threading.Lock())
+        self._buffer = collections.deque(maxlen=buffer_size)
+        self._buffer_ids = {}
+        self._seq = 0
+        self._cursor_id = None
+        self._tail_ids = {}
+        self._channel_ids = {}
+        self._subscribers = 0
+        self._stats = collections.Counter()
+        self._gap_stats = collections.Counter()
+        self._streams = {}
+        self._streams_lock = threading.Lock()
+        self._gap_check = 0
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        if self._running:
+            return
+
+        with self._start_lock:
+            if self._running:
+                return
+
+            names = [x for x in mongo.collections
+                if x == 'messages' or x.startswith('messages_')]
 
-            if isinstance(channels, str):
-                spec['channel'] = channels
+            for name in names:
+                collection = mongo.get_collection(name)
+                for doc in collection.find({}, {
+                            '_id': True,
+                        }).sort('$natural', pymongo.DESCENDING).limit(1):
+                    self._tail_ids[name] = doc['_id']
+                    if not self._cursor_id or doc['_id'] > self._cursor_id:
+                        self._cursor_id = doc['_id']
+
+            for name in names:
+                thread = threading.Thread(target=self._tail_thread,
+                    args=(name,))
+                thread.daemon = True
+                thread.start()
+            self._running = True
+
+    def _append(self, doc):
+        doc.pop('nonce', None)
+        self._check_seq(doc)
+
+        with self._cond:
+            if len(self._buffer) == self._buffer.maxlen:
+                self._buffer_ids.pop(self._buffer[0][1]['_id'], None)
+
+            self._seq += 1
+            self._buffer.append((self._seq, doc))
+            self._buffer_ids[doc['_id']] = self._seq
+            self._cursor_id = doc['_id']
+            self._channel_ids[doc['channel']] = doc['_id']
+            self._stats['received'] += 1
+            self._cond.notify_all()
+
+    def _append_gap(self, channel, missed):
+        # Gap markers have no _id and are only sent to resync subscribers
+        with self._cond:
+            if len(self._buffer) == self._buffer.maxlen:
+                self._buffer_ids.pop(self._buffer[0][1]['_id'], None)
+
+            self._seq += 1
+            self._buffer.append((self._seq, {
+                '_id': None,
+                'channel': channel,
+                'message': RESYNC,
+                'missed': missed,
+            }))
+            self._stats['gaps'] += 1
+            self._stats['missed'] += missed
+            self._gap_stats[channel] += missed
+            self._cond.notify_all()
+
+    def _check_seq(self, doc):
+        # Only called from the tail thread. Docs from one publisher can be
+        # inserted out of order by different threads so missing seqs are
+        # held for a grace period before being counted as lost.
+        seq = doc.pop('seq', None)
+        pub_id = doc.pop('pub_id', None)
+        if seq is None:
+            return
+
+        with self._streams_lock:
+            self._check_stream(pub_id, doc['channel'], seq)
+
+    def _check_stream(self, pub_id, channel, seq):
+        cur_time = time.time()
+        key = (pub_id, channel)
+        stream = self._streams.get(key)
+        if stream is None:
+            self._streams[key] = [seq, {}, cur_time]
+            return
+
+        last_seq, missing, _ = stream
+        stream[2] = cur_time
+
+        if seq > last_seq:
+            stream[0] = seq
+            if seq - last_seq - 1 > self._buffer.maxlen:
+                self._append_gap(channel, seq - last_seq - 1)
             else:
-                spec['channel'] = {'$in': channels}
+                for i in xrange(last_seq + 1, seq):
+                    missing[i] = cur_time
+        else:
+            missing.pop(seq, None)
 
+    def _check_gaps(self):
+        cur_time = time.time()
+        if cur_time - self._gap_check < MESSENGER_GAP_GRACE / 2.:
+            return
+        self._gap_check = cur_time
+
+        gaps = collections.Counter()
+        with self._streams_lock:
+            for key, stream in self._streams.items():
+                missing = stream[1]
+                for seq, timestamp in missing.items():
+                    if cur_time - timestamp >= MESSENGER_GAP_GRACE:
+                        missing.pop(seq)
+                        gaps[key[1]] += 1
+
+                if not missing and cur_time - stream[2] > 3600:
+                    self._streams.pop(key)
+
+        for channel, missed in gaps.items():
+            self._append_gap(channel, missed)
+
+    def _tail_thread(self, name):
+        from pritunl import logger
+        collection = mongo.get_collection(name)
+
+        while True:
+            try:
+                spec = {}
+                tail_id = self._tail_ids.get(name)
+                if tail_id:
+                    spec['_id'] = {'$gt': tail_id}
+
+                cursor = collection.find(spec, tailable=True,
+                    await_data=True).sort('$natural', pymongo.ASCENDING)
+                self._stats['cursors'] += 1
+
+                received = False
+                while cursor.alive:
+                    for doc in cursor:
+                        received = True
+                        self._tail_ids[name] = doc['_id']
+                        self._append(doc)
+                        self._check_gaps()
+                    self._check_gaps()
+
+                # Cursor will die immediately on an empty collection
+                if not received:
+                    time.sleep(0.1)
+            except pymongo.errors.AutoReconnect:
+                time.sleep(0.2)
+            except:
+                logger.exception('Error in messenger hub thread')
+                time.sleep(0.5)
+
+    def get_cursor_id(self, channels):
+        if isinstance(channels, str):
+            channels = (channels,)
+
+        with self._cond:
+            cursor_id = None
+            for channel in channels:
+                channel_id = self._channel_ids.get(channel)
+                if channel_id and channel_id in self._buffer_ids and (
+                        not cursor_id or channel_id > cursor_id):
+                    cursor_id = channel_id
+
+            # Any doc seen by the hub was published before this call so
+            # the latest id can be used if the channel is not buffered,
+            # newer docs that were not tailed are checked by the caller
+            cursor_id = cursor_id or self._cursor_id
             if cursor_id:
-                spec['_id'] = {'$gt': cursor_id}
+                self._stats['cursor_hits'] += 1
+            else:
+                self._stats['cursor_queries'] += 1
+            return cursor_id
 
-            cursor = collection.find(spec, tailable=True,
-                await_data=True).sort('$natural', pymongo.ASCENDING)
+    def _read(self, pos):
+        # Must be called with lock held, returns docs after pos and the
+        # number of docs that were dropped from the buffer before read
+        if not self._buffer:
+            return [], 0
 
-            while cursor.alive:
-                for doc in cursor:
-                    cursor_id = doc['_id']
-                    if doc.get('message') is not None:
-                        doc.pop('nonce', None)
-                        yield doc
+        first_seq = self._buffer[0][0]
+        missed = max(0, first_seq - pos - 1)
+        index = max(0, pos - first_seq + 1)
 
-                    if yield_delay:
-                        time.sleep(yield_delay)
+        return [x[1] for x in itertools.islice(
+            self._buffer, index, None)], missed
+
+    def _catch_up(self, channels, cursor_id):
+        with self._cond:
+            self._stats['catch_ups'] += 1
+
+        spec = {
+            'channel': {'$in': list(channels)},
+        }
+        if cursor_id:
+            spec['_id'] = {'$gt': cursor_id}
+
+        # Hosts running an older version write partitioned channels to the
+        # messages collection during a rolling upgrade
+        names = get_collection_names(channels)
+        names.add('messages')
 
-                        spec = spec.copy()
-                        spec['_id'] = {'$gt': cursor_id}
-                        cursor = collection.find(spec).sort(
-                            '$natural', pymongo.ASCENDING)
+        docs = []
+        for name in names:
+            collection = mongo.get_collection(name)
+            while True:
+                try:
+                    docs.extend(collection.find(spec).sort(
+                        '$natural', pymongo.ASCENDING))
+                    break
+                except pymongo.errors.AutoReconnect:
+                    time.sleep(0.2)
 
-                        for doc in cursor:
-                            if doc.get('message') is not None:
-                                doc.pop('nonce', None)
-                                yield doc
+        if len(docs) > 1:
+            docs.sort(key=lambda x: x['_id'])
 
-                        return
+        for doc in docs:
+            doc.pop('nonce', None)
+            doc.pop('seq', None)
+            doc.pop('pub_id', None)
+        return docs
+
+    def _catch_up_lost(self, channels, cursor_id):
+        # Collection wrapped past the cursor, docs after it may be lost
+        for name in get_collection_names(channels):
+            collection = mongo.get_collection(name)
+            for doc in collection.find({}, {
+                        '_id': True,
+                    }).sort('$natural', pymongo.ASCENDING).limit(1):
+                if doc['_id'] > cursor_id:
+                    with self._cond:
+                        self._stats['catch_up_lost'] += 1
+                    return True
+        return False
+
+    def subscribe(self, channels, cursor_id=None, timeout=None,
+            yield_delay=None, heartbeat=None, resync=False):
+        # When heartbeat is set None will be yielded after each heartbeat
+        # interval with no messages to allow callers to check connections.
+        # When resync is set a RESYNC message will be yielded for a channel
+        # when messages on that channel may have been lost.
+        if isinstance(channels, str):
+            channels = {channels}
+        else:
+            channels = set(channels)
+
+        self.start()
+        start_time = time.time()
+        catch_up = False
+        caught_up_id = None
+        delayed = False
+        last_yield = start_time
+
+        with self._cond:
+            self._subscribers += 1
+            pos = self._buffer_ids.get(cursor_id)
+            if pos is None and cursor_id and cursor_id == self._cursor_id:
+                pos = self._seq
+                last_id = cursor_id
+            elif pos is None:
+                # Cursor is older then the buffer, read the missing docs
+                # from the collection before reading from the buffer
+                pos = self._seq
+                catch_up = bool(cursor_id)
+                last_id = self._cursor_id
+            else:
+                last_id = cursor_id
+
+        try:
+            while True:
+                if catch_up:
+                    catch_up = False
+                    if resync and self._catch_up_lost(channels, cursor_id):
+                        for channel in channels:
+                            last_yield = time.time()
+                            yield {
+                                '_id': None,
+                                'channel': channel,
+                                'message': RESYNC,
+                                'missed': None,
+                            }
+
+                    # Docs up to the cursor may be tailed by the hub after
+                    # the catch up when the cursor is newer then the hub
+                    caught_up_id = max(caught_up_id, cursor_id)
+                    for doc in self._catch_up(channels, cursor_id):
+                        caught_up_id = last_id = doc['_id']
+                        if doc.get('message') is not None:
+                            last_yield = time.time()
+                            yield doc
+
+                            if yield_delay and not delayed:
+                                time.sleep(yield_delay)
+                                delayed = True
+
+                ping = False
+                with self._cond:
+                    docs, missed = self._read(pos)
+
+                    if missed:
+                        # Subscriber fell behind the buffer
+                        self._stats['overflows'] += 1
+                        pos = self._buffer[0][0] - 1
+                        cursor_id = last_id
+                        catch_up = True
+                        continue
+
+                    if not docs:
+                        if delayed:
+                            return
+
+                        wait_time = None
+                        if timeout:
+                            wait_time = timeout - (time.time() - start_time)
+                            if wait_time <= 0:
+                                return
+
+                        if heartbeat:
+                            idle = time.time() - last_yield
+                            if idle >= heartbeat:
+                                ping = True
+                            else:
+                                wait_time = min(wait_time or heartbeat,
+                                    heartbeat - idle)
+
+                        if not ping:
+                            self._cond.wait(wait_time)
+                            continue
+                    else:
+                        pos += len(docs)
+                        for doc in reversed(docs):
+                            if doc['_id']:
+                                last_id = doc['_id']
+                                break
+
+                if ping:
+                    last_yield = time.time()
+                    yield None
+                    continue
+
+                final = delayed
+                for doc in docs:
+                    if doc['channel'] not in channels or \
+                            doc.get('message') is None:
+                        continue
+
+                    if doc['_id'] is None:
+                        if resync:
+                            yield doc.copy()
+                        continue
+
+                    # Already read from collection during catch up
+                    if caught_up_id and doc['_id'] <= caught_up_id:
+                        continue
+
+                    last_yield = time.time()
+                    yield doc.copy()
+
+                    if yield_delay and not delayed:
+                        time.sleep(yield_delay)
+                        delayed = True
+
+                if final:
+                    return
 
                 if timeout and time.time() - start_time >= timeout:
                     return
-        except pymongo.errors.AutoReconnect:
-            time.sleep(0.2)
+        finally:
+            with self._cond:
+                self._subscribers -= 1
+
+    def get_stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats['subscribers'] = self._subscribers
+            stats['buffered'] = len(self._buffer)
+            stats['gap_channels'] = dict(self._gap_stats)
+        return stats
+
+hub = SubscriptionHub()
+
+def subscribe(channels, cursor_id=None, timeout=None, yield_delay=None,
+        heartbeat=None, resync=False):
+    # Buffered messages must be sent before waiting on a response
+    flush()
+    return hub.subscribe(channels, cursor_id=cursor_id, timeout=timeout,
+        yield_delay=yield_delay, heartbeat=heartbeat, resync=resync)
+
+def get_stats():
+    return hub.get_stats()
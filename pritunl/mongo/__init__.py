@@ -1,6 +1,7 @@
 from pritunl.mongo.dict import MongoDict
 from pritunl.mongo.list import MongoList
 from pritunl.mongo.object import MongoObject
+from pritunl.mongo.identity_map import IdentityMap, get_identity_map
 
 import pymongo
 
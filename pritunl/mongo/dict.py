@@ -26,7 +26,7 @@ class MongoDict(object):
         return repr(self.data)
 
     def __cmp__(self, dict):
-        if isinstance(dict, UserDict):
+        if isinstance(dict, MongoDict):
             return cmp(self.data, dict.data)
         else:
             return cmp(self.data, dict)
@@ -56,8 +56,8 @@ class MongoDict(object):
         self.data.clear()
 
     def copy(self):
-        if self.__class__ is UserDict:
-            return UserDict(self.data.copy())
+        if self.__class__ is MongoDict:
+            return MongoDict(self.data.copy())
         import copy
         data = self.data
         try:
@@ -93,7 +93,7 @@ class MongoDict(object):
         self.changed = True
         if dict is None:
             pass
-        elif isinstance(dict, UserDict):
+        elif isinstance(dict, MongoDict):
             self.data.update(dict.data)
         elif isinstance(dict, type({})) or not hasattr(dict, 'items'):
             self.data.update(dict)
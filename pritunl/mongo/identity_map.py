@@ -0,0 +1,47 @@
+from pritunl.constants import *
+from pritunl.exceptions import *
+from pritunl.descriptors import *
+
+import threading
+
+_identity_local = threading.local()
+
+class IdentityMap(object):
+    # Keeps objects loaded by id on the current thread so repeated loads
+    # of the same id return one object. Nested maps on the same thread
+    # will defer to the outer map.
+    def __init__(self):
+        self.objects = {}
+        self._nested = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        if getattr(_identity_local, 'map', None):
+            self._nested = True
+        else:
+            _identity_local.map = self
+
+    def stop(self):
+        if self._nested:
+            return
+        self.objects = {}
+        if getattr(_identity_local, 'map', None) is self:
+            _identity_local.map = None
+
+    def get(self, cls, id):
+        return self.objects.get((cls, id))
+
+    def add(self, obj):
+        self.objects[(obj.__class__, obj.id)] = obj
+
+    def remove(self, cls, id):
+        self.objects.pop((cls, id), None)
+
+def get_identity_map():
+    return getattr(_identity_local, 'map', None)
@@ -1,22 +1,150 @@
 from pritunl.constants import *
 from pritunl.exceptions import *
 from pritunl.descriptors import *
+from pritunl.mongo.dict import MongoDict
+from pritunl.mongo.list import MongoList
+from pritunl.mongo.identity_map import get_identity_map
 
 import bson
 import json
 import os
 import copy
 
+_missing = object()
+
+def _plain(value):
+    if isinstance(value, (MongoDict, MongoList)):
+        return value.data
+    return value
+
+def _path_key(key):
+    return isinstance(key, basestring) and key and \
+        '.' not in key and not key.startswith('$')
+
+def _object_id(id):
+    if len(id) == 24:
+        return bson.ObjectId(id)
+    return id
+
+def _diff(path, old, new, update_doc):
+    # Compare a loaded value with its current value and add the dotted
+    # path operations needed to update it, values that can not be
+    # updated in place are replaced
+    if isinstance(old, dict) and isinstance(new, dict):
+        if all(_path_key(x) for x in old.keys() + new.keys()):
+            for key, value in new.items():
+                if key not in old:
+                    update_doc['$set'][path + '.' + key] = _plain(value)
+                elif old[key] != value:
+                    _diff(path + '.' + key, old[key], value, update_doc)
+            for key in old.keys():
+                if key not in new:
+                    update_doc['$unset'][path + '.' + key] = ''
+            return
+    elif isinstance(old, list) and isinstance(new, list):
+        if len(new) > len(old) and list(new[:len(old)]) == old:
+            update_doc['$push'][path] = {
+                '$each': list(new[len(old):]),
+            }
+            return
+        elif len(new) == len(old):
+            for i, value in enumerate(new):
+                if old[i] != value:
+                    _diff('%s.%s' % (path, i), old[i], value, update_doc)
+            return
+    update_doc['$set'][path] = _plain(new)
+
+class MongoField(object):
+    # Values are stored in the instance dict under the field name, the
+    # descriptor marks fields changed when set and copies loaded list and
+    # dict values to the snapshot before they are first used
+    __slots__ = ('name', 'default')
+
+    def __init__(self, name, default=None):
+        self.name = name
+        self.default = default
+
+    def __get__(self, obj, objtype):
+        if obj is None:
+            return self.default
+        value = obj.__dict__.get(self.name, _missing)
+        if value is not _missing:
+            if self.name in obj.snapshot_pending:
+                obj.snapshot_pending.discard(self.name)
+                obj.snapshot[self.name] = copy.deepcopy(value)
+            return value
+
+        if obj.deferred and self.name in obj.deferred:
+            obj.load_deferred()
+            value = obj.__dict__.get(self.name, _missing)
+            if value is not _missing:
+                return value
+
+        value = self.default
+        if isinstance(value, list):
+            value = copy.copy(value)
+            setattr(obj, self.name, value)
+        elif isinstance(value, dict):
+            value = value.copy()
+            setattr(obj, self.name, value)
+        return value
+
+    def __set__(self, obj, value):
+        if self.name in obj.snapshot_pending:
+            # Replaced values are no longer referenced by the object and
+            # can be kept as the snapshot without a copy
+            obj.snapshot_pending.discard(self.name)
+            old_value = obj.__dict__[self.name]
+            obj.snapshot[self.name] = copy.deepcopy(old_value) \
+                if old_value is value else old_value
+        obj.changed.add(self.name)
+        obj.__dict__[self.name] = value
+
+class MongoObjectMeta(type):
+    # Generates a field descriptor for each field when the class is
+    # defined, class attributes with a field name are used as the default
+    def __new__(mcs, name, bases, attrs):
+        defaults = {}
+        for base in reversed(bases):
+            defaults.update(getattr(base, '_field_defaults', {}))
+        defaults.update(attrs.get('fields_default', {}))
+
+        fields = attrs.get('fields')
+        if fields is None:
+            for base in bases:
+                fields = getattr(base, 'fields', None)
+                if fields is not None:
+                    break
+
+        for field in fields or ():
+            if field in attrs:
+                value = attrs[field]
+                if hasattr(value, '__get__'):
+                    raise TypeError('Field %r conflicts with %r' % (
+                        field, value))
+                defaults[field] = value
+            attrs[field] = MongoField(field, defaults.get(field))
+        attrs['_field_defaults'] = defaults
+
+        return type.__new__(mcs, name, bases, attrs)
+
 class MongoObject(object):
+    __metaclass__ = MongoObjectMeta
     fields = set()
     fields_default = {}
     fields_required = {}
+    fields_deferred = frozenset()
+    deferred = frozenset()
 
     def __new__(cls, id=None, doc=None, spec=None, **kwargs):
         mongo_object = object.__new__(cls)
-        mongo_object.changed = set()
-        mongo_object.unseted = set()
-        mongo_object.id = id
+        mongo_object.__dict__.update({
+            'changed': set(),
+            'unseted': set(),
+            'snapshot': {},
+            'snapshot_pending': set(),
+            'id': id,
+        })
 
         if id or doc or spec:
             mongo_object.exists = True
@@ -29,32 +157,73 @@ class MongoObject(object):
             mongo_object.id = str(bson.ObjectId())
         return mongo_object
 
-    def __setattr__(self, name, value):
-        if name != 'fields' and name in self.fields:
-            self.changed.add(name)
-        object.__setattr__(self, name, value)
-
-    def __getattr__(self, name):
-        if name in self.fields:
-            if name in self.fields_default:
-                value = self.fields_default[name]
-                if isinstance(value, list):
-                    value = copy.copy(value)
-                    setattr(self, name, value)
-                elif isinstance(value, dict):
-                    value = value.copy()
-                    setattr(self, name, value)
-                return value
-            return
-        raise AttributeError(
-            'MongoObject instance has no attribute %r' % name)
-
     @property
     def _id(self):
-        id = self.id
-        if len(id) == 24:
-            return bson.ObjectId(id)
-        return id
+        return _object_id(self.id)
+
+    @classmethod
+    def get_multi(cls, ids, prefetch=False, **kwargs):
+        # Load objects for many ids with one query, objects already in the
+        # current identity map are reused and missing ids are left out,
+        # results are keyed by the string id
+        identity_map = get_identity_map()
+        objects = {}
+        missing = set()
+
+        for id in ids:
+            id = str(id)
+            obj = identity_map.get(cls, id) if identity_map else None
+            if obj is not None:
+                objects[id] = obj
+            else:
+                missing.add(id)
+
+        if missing:
+            for doc in cls.collection.find({
+                        '_id': {'$in': [_object_id(x) for x in missing]},
+                    }, None if prefetch else cls._get_projection()):
+                obj = cls(doc=doc, **kwargs)
+                if prefetch:
+                    obj.deferred = frozenset()
+                objects[obj.id] = obj
+                if identity_map:
+                    identity_map.add(obj)
+
+        if prefetch:
+            cls.prefetch(objects.values())
+
+        return objects
+
+    @classmethod
+    def get_by_id(cls, id, **kwargs):
+        if not id:
+            return None
+        id = str(id)
+        return cls.get_multi((id,), **kwargs).get(id)
+
+    @classmethod
+    def prefetch(cls, objects):
+        # Load the deferred fields of many objects with one query
+        objects = {x.id: x for x in objects if x.deferred}
+        if not objects:
+            return
+
+        fields = set()
+        for obj in objects.itervalues():
+            fields.update(obj.deferred)
+
+        for doc in cls.collection.find({
+                    '_id': {'$in': [_object_id(x) for x in objects]},
+                }, {x: True for x in fields}):
+            objects[str(doc['_id'])]._set_deferred(doc)
+
+        for obj in objects.itervalues():
+            obj._set_deferred({})
+
+    @classmethod
+    def _get_projection(cls):
+        if cls.fields_deferred:
+            return {x: False for x in cls.fields_deferred}
 
     @cached_static_property
     def collection(cls):
@@ -68,16 +237,63 @@ class MongoObject(object):
                 spec = {
                     '_id': self._id,
                 }
-            doc = self.collection.find_one(spec)
+            doc = self.collection.find_one(spec, self._get_projection())
             if not doc:
                 raise NotFound('Document not found', {
                     'spec': spec,
                 })
         doc['id'] = str(doc.pop('_id'))
-        for key, value in doc.iteritems():
-            setattr(self, key, value)
-        self.exists = True
-        self.changed = set()
+        doc['exists'] = True
+        doc['changed'] = set()
+        # List and dict values are copied to the snapshot on first use
+        doc['snapshot_pending'] = {x for x, y in doc.iteritems()
+            if isinstance(y, (list, dict))}
+        doc['snapshot'] = {}
+        if self.fields_deferred:
+            # Deferred fields missing from the doc are loaded on access,
+            # values from before the load are removed to be loaded again
+            deferred = self.fields_deferred.difference(doc)
+            for field in deferred:
+                self.__dict__.pop(field, None)
+            doc['deferred'] = deferred
+        self.__dict__.update(doc)
+
+    def load_deferred(self):
+        fields = self.deferred.difference(self.__dict__)
+        if not fields:
+            self.deferred = frozenset()
+            return
+        doc = self.collection.find_one({
+            '_id': self._id,
+        }, {x: True for x in fields})
+        self._set_deferred(doc or {})
+
+    def _set_deferred(self, doc):
+        deferred = self.deferred
+        self.deferred = frozenset()
+        for field in deferred:
+            if field in doc and field not in self.__dict__:
+                value = doc[field]
+                self.__dict__[field] = value
+                if isinstance(value, (list, dict)):
+                    self.snapshot_pending.add(field)
+
+    def _take_snapshot(self, fields):
+        # Copy list and dict values to find changes made in place
+        for field in fields:
+            self.snapshot_pending.discard(field)
+            value = self.__dict__.get(field)
+            if isinstance(value, (list, dict)):
+                self.snapshot[field] = copy.deepcopy(_plain(value))
+            else:
+                self.snapshot.pop(field, None)
+
+    def _get_changed(self):
+        changed = set(self.changed)
+        for field, value in self.snapshot.iteritems():
+            if field not in changed and self.__dict__.get(field) != value:
+                changed.add(field)
+        return changed
 
     def export(self):
         doc = self.fields_default.copy()
@@ -94,11 +310,11 @@ class MongoObject(object):
             if isinstance(fields, basestring):
                 fields = (fields,)
         elif self.exists:
-            fields = self.fields
+            fields = self._get_changed() & self.fields
 
         if fields or doc:
             for field in fields:
-                doc[field] = getattr(self, field)
+                doc[field] = _plain(getattr(self, field))
         elif not self.exists:
             doc = self.fields_default.copy()
             doc['_id'] = self._id
@@ -119,9 +335,31 @@ class MongoObject(object):
     def unset(self, field):
         self.unseted.add(field)
 
-    def commit(self, fields=None, transaction=None):
+    def get_update_doc(self, fields=None):
         doc = self.get_commit_doc(fields=fields)
-        unset = {x: '' for x in self.unseted}
+        update_doc = {
+            '$set': {},
+            '$unset': {},
+            '$push': {},
+        }
+
+        for field, value in doc.iteritems():
+            if field in self.snapshot:
+                _diff(field, self.snapshot[field], value, update_doc)
+            else:
+                update_doc['$set'][field] = value
+
+        for field in self.unseted:
+            for operator in ('$set', '$push'):
+                for path in update_doc[operator].keys():
+                    if path == field or path.startswith(field + '.'):
+                        update_doc[operator].pop(path)
+            update_doc['$unset'][field] = ''
+
+        return {x: y for x, y in update_doc.iteritems() if y}, doc
+
+    def commit(self, fields=None, transaction=None):
+        update_doc, doc = self.get_update_doc(fields=fields)
 
         if transaction:
             collection = transaction.collection(
@@ -129,27 +367,28 @@ class MongoObject(object):
         else:
             collection = self.collection
 
-        if doc or unset:
-            update_doc = {}
-
-            if doc:
-                for field in self.unseted:
-                    doc.pop(field, None)
-                update_doc['$set'] = doc
-
-            if unset:
-                update_doc['$unset'] = unset
-
-            collection.update({
+        response = None
+        if update_doc:
+            response = collection.update({
                 '_id': self._id,
             }, update_doc, upsert=True)
 
+        self._take_snapshot(doc)
+        for field in self.unseted:
+            self.snapshot.pop(field, None)
+            self.snapshot_pending.discard(field)
+
         self.exists = True
         self.changed = set()
         self.unseted = set()
 
+        return response
+
     def remove(self):
-        self.collection.remove(self._id)
+        identity_map = get_identity_map()
+        if identity_map:
+            identity_map.remove(self.__class__, self.id)
+        return self.collection.remove(self._id)
 
     def read_file(self, field, path):
         with open(path, 'r') as field_file:
@@ -5,18 +5,23 @@ from pritunl import settings
 from pritunl import app
 from pritunl import logger
 from pritunl import mongo
+from pritunl import counters
 from pritunl import queue
 from pritunl import pooler
 from pritunl import user
+from pritunl import user_index
 from pritunl import utils
 
 import uuid
 import logging
+import base64
 import random
 import json
 import math
 import pymongo
 import threading
+import bson
+import re
 
 class Organization(mongo.MongoObject):
     fields = {
@@ -25,6 +30,10 @@ class Organization(mongo.MongoObject):
         'ca_private_key',
         'ca_certificate',
     }
+    fields_deferred = frozenset((
+        'ca_private_key',
+        'ca_certificate',
+    ))
     fields_default = {
         'type': ORG_DEFAULT,
     }
@@ -37,6 +46,7 @@ class Organization(mongo.MongoObject):
     def __init__(self, name=None, type=None, **kwargs):
         mongo.MongoObject.__init__(self, **kwargs)
         self.last_search_count = None
+        self.next_page_token = None
         self.processes = []
         self.queue_com = queue.QueueCom()
 
@@ -133,22 +143,17 @@ class Organization(mongo.MongoObject):
             thread.daemon = True
             thread.start()
 
-    def get_user(self, id):
-        return user.get_user(org=self, id=id)
+    def get_user(self, id, prefetch=False):
+        return user.get_user(org=self, id=id, prefetch=prefetch)
 
     def find_user(self, name=None, type=None):
         return user.find_user(org=self, name=name, type=type)
 
     def _get_user_count(self, type=CERT_CLIENT):
-        return user.User.collection.find({
-            'org_id': self.id,
-            'type': type,
-        }, {
-            '_id': True,
-        }).count()
+        return counters.get_user_count(self.id, type=type)
 
     def iter_users(self, page=None, search=None, search_limit=None,
-            fields=None):
+            fields=None, page_token=None):
         spec = {
             'org_id': self.id,
             'type': {'$in': [CERT_CLIENT, CERT_SERVER]},
@@ -156,35 +161,96 @@ class Organization(mongo.MongoObject):
         limit = None
         skip = None
         page_count = settings.user.page_count
+        self.next_page_token = None
 
         if fields:
             fields = {key: True for key in fields}
+            fields.update({
+                'type': True,
+                'name': True,
+            })
+
+        sort = [
+            ('type', pymongo.ASCENDING),
+            ('name', pymongo.ASCENDING),
+            ('_id', pymongo.ASCENDING),
+        ]
 
         if search is not None:
-            spec['name'] = {'$regex': '.*%s.*' % search}
             limit = search_limit or page_count
+            docs = self._search_users(spec, sort, fields, search, limit)
+            if docs is not None:
+                for doc in docs:
+                    yield user.User(self, doc=doc)
+                return
+            spec['name'] = {
+                '$regex': re.escape(search),
+                '$options': 'i',
+            }
+        elif page_token is not None:
+            # Continue after the last user of the previous page using the
+            # sort key instead of skipping the previous pages
+            type, name, user_id = _decode_page_token(page_token)
+            spec['$or'] = [
+                {'type': {'$gt': type}},
+                # Null sorts before strings but $gt null only matches null
+                {'type': type, 'name': {'$gt': name} if name is not None
+                    else {'$ne': None}},
+                {'type': type, 'name': name, '_id': {'$gt': user_id}},
+            ]
+            limit = page_count
         elif page is not None:
             limit = page_count
             skip = page * page_count if page else 0
 
-        sort = [
-            ('type', pymongo.ASCENDING),
-            ('name', pymongo.ASCENDING),
-        ]
-
         cursor = user.User.collection.find(spec, fields).sort(sort)
 
+        if search is not None:
+            self.last_search_count = cursor.count()
+
         if skip is not None:
-            cursor = cursor.skip(page * page_count if page else 0)
+            cursor = cursor.skip(skip)
         if limit is not None:
             cursor = cursor.limit(limit)
 
-        if search:
-            self.last_search_count = cursor.count()
-
+        count = 0
+        last_doc = None
         for doc in cursor:
+            count += 1
+            last_doc = (doc.get('type'), doc.get('name'), doc['_id'])
             yield user.User(self, doc=doc)
 
+        if search is None and limit is not None and count == limit:
+            self.next_page_token = _encode_page_token(*last_doc)
+
+    def _search_users(self, spec, sort, fields, search, limit):
+        # Users from the index are loaded from mongodb to remove results
+        # for users that were removed or renamed since the index was
+        # updated, the search is run again after stale users are fixed
+        spec = spec.copy()
+        search_lower = search.lower()
+
+        for _ in xrange(2):
+            result = user_index.search(self.id, search, limit)
+            if result is None:
+                return
+            user_ids, self.last_search_count = result
+            if not user_ids:
+                return []
+
+            spec['_id'] = {'$in': [bson.ObjectId(x) for x in user_ids]}
+            docs = list(user.User.collection.find(spec, fields).sort(sort))
+
+            stale = user_index.check(self.id, search, user_ids, {
+                str(x['_id']): (x.get('type'), x.get('name')) for x in docs
+            })
+            if not stale:
+                return docs
+
+        self.last_search_count -= stale
+        return [x for x in docs
+            if search_lower in (x.get('name') or '').lower()]
+
     def create_user_key_link(self, user_id):
         success = False
         for _ in xrange(256):
@@ -269,6 +335,51 @@ class Organization(mongo.MongoObject):
 
         return usr
 
+    def new_users(self, users_data, type=CERT_CLIENT):
+        # Reserve pooled users in batches then queue the remaining users
+        # for init in batches, yields the users of each batch. Queued users
+        # do not exist until the queue item completes.
+        reserved = 0
+        for users in user.reserve_pooled_users(self, users_data, type=type):
+            reserved += len(users)
+            yield users
+
+        logger.debug('Reserved pooled users', 'organization',
+            org_id=self.id,
+            count=reserved,
+        )
+
+        org_doc = self.export()
+        batch_size = settings.user.bulk_batch_size
+        for i in xrange(reserved, len(users_data), batch_size):
+            users = []
+            items = []
+            for user_data in users_data[i:i + batch_size]:
+                usr = user.User(org=self, type=type,
+                    name=user_data.get('name'),
+                    email=user_data.get('email'),
+                    disabled=user_data.get('disabled'),
+                )
+                users.append(usr)
+                items.append({
+                    'org_doc': org_doc,
+                    'user_doc': usr.export(),
+                    'notify': True,
+                    'priority': HIGH,
+                })
+            queue.start_multi('init_user', items)
+
+            logger.debug('Queued user init', 'organization',
+                org_id=self.id,
+                count=len(users),
+            )
+
+            yield users
+
+        thread = threading.Thread(target=pooler.fill, args=('user',))
+        thread.daemon = True
+        thread.start()
+
     def remove(self):
         logger.debug('Remove org', 'organization',
             org_id=self.id,
@@ -283,6 +394,8 @@ class Organization(mongo.MongoObject):
         user.User.collection.remove({
             'org_id': self.id,
         })
+        counters.remove_user_count(self.id)
+        user_index.publish_remove(self.id)
 
 def new_pooled_org():
     thread = threading.Thread(target=new_org, kwargs={
@@ -351,8 +464,21 @@ def new_org(type=ORG_DEFAULT, block=True, **kwargs):
 
         return org
 
+def _encode_page_token(type, name, user_id):
+    return base64.urlsafe_b64encode(json.dumps([type, name, str(user_id)]))
+
+def _decode_page_token(page_token):
+    try:
+        type, name, user_id = json.loads(base64.urlsafe_b64decode(
+            str(page_token)))
+        return type, name, bson.ObjectId(user_id)
+    except (TypeError, ValueError, bson.errors.InvalidId):
+        raise PageTokenInvalid('Page token is not valid', {
+            'page_token': page_token,
+        })
+
 def get_org(id):
-    return Organization(id=id)
+    return Organization.get_by_id(id)
 
 def iter_orgs(type=ORG_DEFAULT):
     spec = {}
@@ -363,9 +489,4 @@ def iter_orgs(type=ORG_DEFAULT):
         yield Organization(doc=doc)
 
 def get_user_count_multi(org_ids=None, type=CERT_CLIENT):
-    spec = {
-        'type': type,
-    }
-    if org_ids is not None:
-        spec['org_id'] = {'$in': org_ids}
-    return user.User.collection.find(spec).count()
+    return counters.get_user_count_multi(org_ids=org_ids, type=type)
@@ -46,8 +46,6 @@ class Queue(mongo.MongoObject):
 
     def __init__(self, priority=None, retry=None, **kwargs):
         mongo.MongoObject.__init__(self, **kwargs)
-        self.type = self.type
-        self.reserve_id = self.reserve_id
         self.runner_id = bson.ObjectId()
         self.claimed = False
         self.queue_com = QueueCom()
@@ -138,10 +136,17 @@ class Queue(mongo.MongoObject):
             last_update = time.time()
             while True:
                 for msg in messenger.subscribe('queue', cursor_id=cursor_id,
-                        timeout=block_timeout):
-                    cursor_id = msg['_id']
+                        timeout=block_timeout, resync=True):
+                    cursor_id = msg['_id'] or cursor_id
                     try:
-                        if msg['message'] == [COMPLETE, self.id]:
+                        if msg['message'] == RESYNC:
+                            # Complete message may have been lost, queue
+                            # doc is removed when complete
+                            if not self.collection.find_one({
+                                        '_id': bson.ObjectId(self.id),
+                                    }, {'_id': True}):
+                                return
+                        elif msg['message'] == [COMPLETE, self.id]:
                             return
                         elif msg['message'] == [UPDATE, self.id]:
                             last_update = time.time()
@@ -207,9 +212,14 @@ class Queue(mongo.MongoObject):
 
         if block:
             for msg in messenger.subscribe('queue', cursor_id=cursor_id,
-                    timeout=block_timeout):
+                    timeout=block_timeout, resync=True):
                 try:
-                    if msg['message'] == [COMPLETE, str(doc['_id'])]:
+                    if msg['message'] == RESYNC:
+                        if not cls.collection.find_one({
+                                    '_id': doc['_id'],
+                                }, {'_id': True}):
+                            return doc
+                    elif msg['message'] == [COMPLETE, str(doc['_id'])]:
                         return doc
                     elif msg['message'] == [ERROR, str(doc['_id'])]:
                         raise QueueTaskError('Error occured running ' +
@@ -376,6 +386,33 @@ def start(queue_type, transaction=None, block=False, block_timeout=30,
         block_timeout=block_timeout)
     return que
 
+def start_multi(queue_type, items):
+    # Insert many queue items with one insert and send one pending message
+    # with the queue ids outside of any publish buffer, items are the
+    # keyword arguments for each queue. Runners load the queue docs.
+    ques = []
+    docs = []
+    for kwargs in items:
+        que = queue_types[queue_type](**kwargs)
+        que.ttl_timestamp = utils.now() + \
+            datetime.timedelta(seconds=que.ttl)
+        ques.append(que)
+        docs.append(que.get_commit_doc())
+
+    if not docs:
+        return ques
+
+    Queue.collection.insert(docs)
+
+    for que in ques:
+        que.exists = True
+        que.changed = set()
+
+    with messenger.PublishBuffer(detach=True):
+        messenger.publish('queue', [PENDING, [x.id for x in ques]])
+
+    return ques
+
 def iter_queues(spec=None):
     for doc in Queue.collection.find(spec or {}).sort('priority'):
         yield queue_types[doc['type']](doc=doc)
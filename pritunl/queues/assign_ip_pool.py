@@ -4,6 +4,7 @@ from pritunl.descriptors import *
 from pritunl import logger
 from pritunl import mongo
 from pritunl import event
+from pritunl import messenger
 from pritunl import server
 from pritunl import queue
 
@@ -100,5 +101,6 @@ class QueueAssignIpPool(queue.Queue):
         if not self.server:
             return
 
-        for org_id in self.server.organizations:
-            event.Event(type=USERS_UPDATED, resource_id=org_id)
+        with messenger.PublishBuffer():
+            for org_id in self.server.organizations:
+                event.Event(type=USERS_UPDATED, resource_id=org_id)
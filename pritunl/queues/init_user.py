@@ -4,6 +4,7 @@ from pritunl.descriptors import *
 from pritunl import app
 from pritunl import logger
 from pritunl import event
+from pritunl import messenger
 from pritunl import organization
 from pritunl import user
 from pritunl import queue
@@ -13,17 +14,20 @@ class QueueInitUser(queue.Queue):
     fields = {
         'org_doc',
         'user_doc',
+        'notify',
     } | queue.Queue.fields
     cpu_type = NORMAL_CPU
     type = 'init_user'
 
-    def __init__(self, org_doc=None, user_doc=None, **kwargs):
+    def __init__(self, org_doc=None, user_doc=None, notify=None, **kwargs):
         queue.Queue.__init__(self, **kwargs)
 
         if org_doc is not None:
             self.org_doc = org_doc
         if user_doc is not None:
             self.user_doc = user_doc
+        if notify is not None:
+            self.notify = notify
 
     @cached_property
     def org(self):
@@ -39,7 +43,14 @@ class QueueInitUser(queue.Queue):
         self.user.initialize()
         self.user.commit()
 
+        # Users queued in bulk are not sent as updated until committed
+        if self.notify:
+            event.Event(type=ORGS_UPDATED)
+            event.Event(type=USERS_UPDATED, resource_id=self.org.id)
+            event.Event(type=SERVERS_UPDATED)
+
     def repeat_task(self):
-        event.Event(type=ORGS_UPDATED)
-        event.Event(type=USERS_UPDATED, resource_id=self.org.id)
-        event.Event(type=SERVERS_UPDATED)
+        with messenger.PublishBuffer():
+            event.Event(type=ORGS_UPDATED)
+            event.Event(type=USERS_UPDATED, resource_id=self.org.id)
+            event.Event(type=SERVERS_UPDATED)
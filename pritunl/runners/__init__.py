@@ -7,6 +7,7 @@ from pritunl.runners.host import start_host
 from pritunl.runners.subscription import start_subscription
 from pritunl.runners.server import start_server
 from pritunl.runners.time_sync import start_time_sync
+from pritunl.runners.user_index import start_user_index
 from pritunl.runners.listener import start_listener
 
 def start_all():
@@ -19,5 +20,6 @@ def start_all():
     start_subscription()
     start_server()
     start_time_sync()
+    start_user_index()
 
     start_listener()
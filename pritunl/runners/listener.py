@@ -1,27 +1,153 @@
 from pritunl.constants import *
 from pritunl.exceptions import *
 from pritunl.descriptors import *
+from pritunl import settings
 from pritunl import listener
 from pritunl import logger
 from pritunl import messenger
 
+from Queue import Queue, Full
 import pymongo
 import random
 import bson
 import datetime
 import logging
 import threading
+import collections
 import time
 
+class ChannelExecutor(object):
+    # Runs the callbacks for one channel on a fixed set of worker threads.
+    # Messages with the same server or queue id are always sent to the
+    # same worker to keep ordering within the channel. Messages for a full
+    # worker are dropped and replaced with a single resync on that worker
+    # so a slow channel can not block the listener thread.
+    def __init__(self, channel, thread_count, queue_size):
+        self.channel = channel
+        self.run_queues = [Queue(queue_size) for _ in xrange(thread_count)]
+        self.dropped = [0] * thread_count
+        self.stats = collections.Counter()
+        self.stats_lock = threading.Lock()
+
+        for i, run_queue in enumerate(self.run_queues):
+            thread = threading.Thread(target=self._run_thread,
+                args=(i, run_queue))
+            thread.daemon = True
+            thread.start()
+
+    def _get_index(self, msg):
+        if len(self.run_queues) == 1:
+            return 0
+
+        key = msg.get('server_id')
+        if key is None:
+            message = msg['message']
+            if isinstance(message, list) and len(message) > 1:
+                key = message[1]
+
+        try:
+            return hash(key) % len(self.run_queues)
+        except TypeError:
+            return 0
+
+    def put(self, msg):
+        index = self._get_index(msg)
+        run_queue = self.run_queues[index]
+
+        try:
+            run_queue.put_nowait(msg)
+            dropped = False
+        except Full:
+            dropped = True
+
+        depth = run_queue.qsize()
+        with self.stats_lock:
+            if dropped:
+                self.dropped[index] += 1
+                self.stats['dropped'] += 1
+            else:
+                self.stats['dispatched'] += 1
+            if depth > self.stats['max_depth']:
+                self.stats['max_depth'] = depth
+
+    def _run_callbacks(self, msg):
+        errors = 0
+
+        if msg['message'] == RESYNC:
+            for lstnr in listener.resyncs[self.channel]:
+                try:
+                    lstnr(msg)
+                except:
+                    errors += 1
+                    logger.exception('Error in resync callback')
+        else:
+            for lstnr in listener.channels[self.channel]:
+                try:
+                    lstnr(msg)
+                except:
+                    errors += 1
+                    logger.exception('Error in listener callback')
+
+        with self.stats_lock:
+            self.stats['processed'] += 1
+            self.stats['errors'] += errors
+
+    def _run_thread(self, index, run_queue):
+        while True:
+            msg = run_queue.get()
+            self._run_callbacks(msg)
+
+            # Messages dropped while the queue was full are replaced with
+            # one resync after the messages queued before the drop
+            with self.stats_lock:
+                dropped = self.dropped[index]
+                self.dropped[index] = 0
+                if dropped:
+                    self.stats['resyncs'] += 1
+
+            if dropped:
+                logger.warning('Listener queue full, resyncing channel',
+                    'listener',
+                    channel=self.channel,
+                    missed=dropped,
+                )
+                self._run_callbacks({
+                    '_id': None,
+                    'channel': self.channel,
+                    'message': RESYNC,
+                    'missed': dropped,
+                })
+
+    def get_stats(self):
+        with self.stats_lock:
+            stats = {x: self.stats[x] for x in ('dispatched', 'processed',
+                'errors', 'dropped', 'resyncs', 'max_depth')}
+        stats['threads'] = len(self.run_queues)
+        stats['depth'] = sum(x.qsize() for x in self.run_queues)
+        return stats
+
+def get_executor(channel):
+    executor = listener.executors.get(channel)
+    if not executor:
+        executor = ChannelExecutor(channel,
+            settings.app.listener_thread_limits.get(channel, 1),
+            settings.app.listener_queue_size)
+        listener.executors[channel] = executor
+    return executor
+
 def listener_thread():
     while True:
         try:
-            for msg in messenger.subscribe(listener.channels.keys()):
-                for lstnr in listener.channels[msg['channel']]:
-                    try:
-                        lstnr(msg)
-                    except:
-                        logger.exception('Error in listener callback')
+            for msg in messenger.subscribe(listener.channels.keys(),
+                    resync=True):
+                if msg['message'] == RESYNC:
+                    logger.warning('Messages lost, resyncing channel',
+                        'listener',
+                        channel=msg['channel'],
+                        missed=msg['missed'],
+                    )
+
+                get_executor(msg['channel']).put(msg)
         except:
             logger.exception('Error in listener thread')
             time.sleep(0.3)
@@ -66,10 +66,38 @@ def _on_msg(msg):
 
     try:
         if msg['message'][0] == PENDING:
-            add_queue_item(queue.get(doc=msg['queue_doc']))
+            queue_doc = msg.get('queue_doc')
+            if queue_doc:
+                add_queue_item(queue.get(doc=queue_doc))
+                return
+
+            # Messages from start_multi contain a list of queue ids
+            queue_ids = msg['message'][1]
+            if isinstance(queue_ids, basestring):
+                queue_ids = [queue_ids]
+            queue_ids = [bson.ObjectId(x) for x in queue_ids
+                if x not in running_queues]
+            if not queue_ids:
+                return
+
+            for queue_item in queue.iter_queues({
+                        '_id': {'$in': queue_ids},
+                        'state': PENDING,
+                    }):
+                add_queue_item(queue_item)
     except TypeError:
         pass
 
+def _on_resync(msg):
+    from pritunl import queue
+
+    # Pending messages may have been lost, add any unclaimed queue items
+    for queue_item in queue.iter_queues({
+                'state': PENDING,
+                'runner_id': {'$exists': False},
+            }):
+        add_queue_item(queue_item)
+
 def run_timeout_queues():
     from pritunl import queue
 
@@ -145,3 +173,4 @@ def start_queue():
     thread.start()
 
     listener.add_listener('queue', _on_msg)
+    listener.add_resync('queue', _on_resync)
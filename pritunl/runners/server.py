@@ -20,6 +20,22 @@ import time
 import random
 import hashlib
 
+def _run_server(svr, prefered_host=None, send_events=False):
+    # When server start msg is received from check_thread it is
+    # possible for multiple servers to send the start message.
+    # Attempt to choose a random host based on the current time in
+    # seconds so that all servers will choose the same random host
+    # if selected in the same one second window
+    if not prefered_host:
+        rand_hash = hashlib.sha256(str(int(time.time()))).digest()
+        rand_gen = random.Random(rand_hash)
+        prefered_host = svr.hosts[rand_gen.randint(0, len(svr.hosts) - 1)]
+
+    if settings.local.host_id != prefered_host:
+        time.sleep(0.1)
+
+    svr.run(send_events=send_events)
+
 def _on_msg(msg):
     if msg['message'] != 'start':
         return
@@ -29,25 +45,32 @@ def _on_msg(msg):
         if settings.local.host_id not in svr.hosts:
             return
 
-        prefered_host = msg.get('prefered_host')
-
-        # When server start msg is received from check_thread it is
-        # possible for multiple servers to send the start message.
-        # Attempt to choose a random host based on the current time in
-        # seconds so that all servers will choose the same random host
-        # if selected in the same one second window
-        if not prefered_host:
-            rand_hash = hashlib.sha256(str(int(time.time()))).digest()
-            rand_gen = random.Random(rand_hash)
-            prefered_host = svr.hosts[rand_gen.randint(0, len(svr.hosts) - 1)]
-
-        if settings.local.host_id != prefered_host:
-            time.sleep(0.1)
-
-        svr.run(send_events=msg.get('send_events'))
+        _run_server(svr, prefered_host=msg.get('prefered_host'),
+            send_events=msg.get('send_events'))
     except:
         logger.exception('Failed to run server.')
 
+def _on_resync(msg):
+    # Start messages may have been lost, run any started servers on this
+    # host that are missing instances. Every host receives the resync so
+    # the same preferred host is chosen as for start messages.
+    for doc in server.Server.collection.find({
+                'status': True,
+                'hosts': settings.local.host_id,
+            }, {
+                '_id': True,
+                'replica_count': True,
+                'instances_count': True,
+            }):
+        if doc.get('instances_count', 0) >= doc.get('replica_count', 1):
+            continue
+
+        try:
+            svr = server.get_server(str(doc['_id']))
+            _run_server(svr, send_events=True)
+        except:
+            logger.exception('Failed to run server.')
+
 def _server_check_thread():
     checked_hosts = set()
     collection = mongo.get_collection('servers')
@@ -99,3 +122,4 @@ def start_server():
     thread.start()
 
     listener.add_listener('servers', _on_msg)
+    listener.add_resync('servers', _on_resync)
@@ -14,6 +14,9 @@ def _check():
         logger.exception('Auto settings check failed')
     _start_check_timer()
 
+def _on_resync(msg):
+    settings.load_mongo()
+
 def _start_check_timer():
     thread = threading.Timer(settings.app.settings_check_interval, _check)
     thread.daemon = True
@@ -21,4 +24,5 @@ def _start_check_timer():
 
 def start_settings():
     listener.add_listener('setting', settings.on_msg)
+    listener.add_resync('setting', _on_resync)
     _start_check_timer()
\ No newline at end of file
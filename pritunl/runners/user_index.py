@@ -0,0 +1,9 @@
+from pritunl.constants import *
+from pritunl.exceptions import *
+from pritunl.descriptors import *
+from pritunl import listener
+from pritunl import user_index
+
+def start_user_index():
+    listener.add_listener('users', user_index.on_msg)
+    listener.add_resync('users', user_index.on_resync)
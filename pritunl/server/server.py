@@ -57,6 +57,10 @@ class Server(mongo.MongoObject):
         'instances',
         'instances_count',
     }
+    fields_deferred = frozenset((
+        'ca_certificate',
+        'dh_params',
+    ))
     fields_default = {
         'dns_servers': [],
         'otp_auth': False,
@@ -301,9 +305,11 @@ class Server(mongo.MongoObject):
         self.generate_ca_cert()
         self._orgs_changed = True
 
-    def iter_orgs(self):
-        for org_id in self.organizations:
-            org = organization.get_org(id=org_id)
+    def iter_orgs(self, prefetch=False):
+        orgs = organization.Organization.get_multi(self.organizations,
+            prefetch=prefetch)
+        for org_id in list(self.organizations):
+            org = orgs.get(org_id)
             if org:
                 yield org
             else:
@@ -352,8 +358,9 @@ class Server(mongo.MongoObject):
         self.changed.add('hosts')
 
     def iter_hosts(self):
-        for host_id in self.hosts:
-            hst = host.get_host(id=host_id)
+        hosts = host.Host.get_multi(self.hosts)
+        for host_id in list(self.hosts):
+            hst = hosts.get(host_id)
             if hst:
                 yield hst
             else:
@@ -393,7 +400,7 @@ class Server(mongo.MongoObject):
 
     def generate_ca_cert(self):
         ca_certificate = ''
-        for org in self.iter_orgs():
+        for org in self.iter_orgs(prefetch=True):
             ca_certificate += org.ca_certificate
         self.ca_certificate = ca_certificate
 
@@ -619,9 +626,23 @@ class Server(mongo.MongoObject):
 
     def _sub_thread(self, semaphore, cursor_id, process):
         semaphore.release()
-        for msg in self.subscribe(cursor_id=cursor_id):
+        for msg in self.subscribe(cursor_id=cursor_id, resync=True):
             message = msg['message']
 
+            if message == RESYNC:
+                # Stop messages may have been lost, check server state
+                if process.poll() is not None:
+                    break
+
+                doc = self.collection.find_one({
+                    '_id': bson.ObjectId(self.id),
+                }, {
+                    'status': True,
+                })
+                if doc and doc.get('status'):
+                    continue
+                message = 'stop'
+
             try:
                 if message == 'stop':
                     self._state = False
@@ -748,10 +769,12 @@ class Server(mongo.MongoObject):
             self.publish('started')
 
             if send_events:
-                event.Event(type=SERVERS_UPDATED)
-                event.Event(type=SERVER_HOSTS_UPDATED, resource_id=self.id)
-                for org_id in self.organizations:
-                    event.Event(type=USERS_UPDATED, resource_id=org_id)
+                with messenger.PublishBuffer():
+                    event.Event(type=SERVERS_UPDATED)
+                    event.Event(type=SERVER_HOSTS_UPDATED,
+                        resource_id=self.id)
+                    for org_id in self.organizations:
+                        event.Event(type=USERS_UPDATED, resource_id=org_id)
 
             while True:
                 line = process.stdout.readline()
@@ -771,9 +794,10 @@ class Server(mongo.MongoObject):
             status_thread.join()
 
             if self._state:
-                event.Event(type=SERVERS_UPDATED)
-                logger.LogEntry(message='Server stopped unexpectedly "%s".' % (
-                    self.name))
+                with messenger.PublishBuffer():
+                    event.Event(type=SERVERS_UPDATED)
+                    logger.LogEntry(message='Server stopped ' +
+                        'unexpectedly "%s".' % self.name)
 
             logger.debug('Ovpn process has ended. %r' % {
                 'server_id': self.id,
@@ -813,10 +837,10 @@ class Server(mongo.MongoObject):
         messenger.publish('servers', message,
             extra=extra, transaction=transaction)
 
-    def subscribe(self, cursor_id=None, timeout=None):
+    def subscribe(self, cursor_id=None, timeout=None, resync=False):
         for msg in messenger.subscribe('servers', cursor_id=cursor_id,
-                timeout=timeout):
-            if msg.get('server_id') == self.id:
+                timeout=timeout, resync=resync):
+            if msg.get('server_id') == self.id or msg['message'] == RESYNC:
                 yield msg
 
     def run(self, send_events=False):
@@ -878,9 +902,17 @@ class Server(mongo.MongoObject):
                 'prefered_host': random.choice(self.hosts),
             })
 
-            for msg in self.subscribe(cursor_id=cursor_id, timeout=timeout):
+            for msg in self.subscribe(cursor_id=cursor_id, timeout=timeout,
+                    resync=True):
                 message = msg['message']
-                if message == 'started':
+                if message == RESYNC:
+                    # Started messages may have been lost, count the
+                    # instances that have been recorded
+                    self.load()
+                    started = max(started, self.instances_count - stopped)
+                    if started + stopped >= self.replica_count:
+                        break
+                elif message == 'started':
                     started += 1
                     if started + stopped >= self.replica_count:
                         break
@@ -932,9 +964,12 @@ class Server(mongo.MongoObject):
         instances_count = self.instances_count
         for _ in xrange(2):
             for msg in self.subscribe(cursor_id=cursor_id,
-                    timeout=(timeout / 2)):
+                    timeout=(timeout / 2), resync=True):
                 message = msg['message']
-                if message == 'stopped':
+                if message == RESYNC:
+                    # Stopped messages may have been lost, reload below
+                    break
+                elif message == 'stopped':
                     stopped += 1
 
                     if stopped >= instances_count:
@@ -1047,8 +1082,9 @@ class Server(mongo.MongoObject):
         }})
 
         if force or self._client_count != len(clients):
-            for org_id in self.organizations:
-                event.Event(type=USERS_UPDATED, resource_id=org_id)
-            if not force:
-                event.Event(type=SERVERS_UPDATED)
+            with messenger.PublishBuffer():
+                for org_id in self.organizations:
+                    event.Event(type=USERS_UPDATED, resource_id=org_id)
+                if not force:
+                    event.Event(type=SERVERS_UPDATED)
         self._client_count = len(clients)
@@ -22,7 +22,7 @@ def new_server(**kwargs):
     return server
 
 def get_server(id):
-    return Server(id=id)
+    return Server.get_by_id(id)
 
 def get_used_resources(ignore_server_id):
     used_resources = Server.collection.aggregate([
@@ -37,4 +37,12 @@ class SettingsApp(SettingsGroupMongo):
         'queue_med_thread_limit': 2,
         'queue_high_thread_limit': 1,
         'host_ttl': 40,
+        'event_coalesce_window': 0.5,
+        'event_stream_timeout': 600,
+        'event_stream_limit': 4,
+        'listener_queue_size': 512,
+        'listener_thread_limits': {
+            'servers': 4,
+            'queue': 2,
+        },
     }
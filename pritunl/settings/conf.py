@@ -12,6 +12,8 @@ class SettingsConf(SettingsGroupFile):
         'debug': False,
         'ssl': True,
         'static_cache': True,
+        'cache_memory_limit': None,
+        'cache_eviction': 'lru',
         'port': 9700,
         'pooler': True,
         'temp_path': 'tmp/pritunl',
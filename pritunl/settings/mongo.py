@@ -13,4 +13,14 @@ class SettingsMongo(SettingsGroupMongo):
         'queue_ttl': 15,
         'task_max_attempts': 3,
         'task_ttl': 30,
+        'messages_partitions': {
+            'events': {
+                'size': 100000,
+                'max': 1024,
+            },
+            'users': {
+                'size': 100000,
+                'max': 1024,
+            },
+        },
     }
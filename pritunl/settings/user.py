@@ -11,4 +11,6 @@ class SettingsUser(SettingsGroupMongo):
         'cert_key_bits': 4096,
         'otp_cache_ttl': 43200,
         'page_count': 10,
+        'bulk_batch_size': 500,
+        'search_index_limit': 100000,
     }
@@ -1,4 +1,5 @@
 from pritunl import __version__
+from pritunl.cache import cache_db
 
 from pritunl.constants import *
 from pritunl.exceptions import *
@@ -26,6 +27,10 @@ def setup_local():
         with open(settings.conf.uuid_path, 'w') as uuid_file:
             uuid_file.write(settings.local.host_id)
 
+    if settings.conf.cache_memory_limit:
+        cache_db.set_memory_limit(settings.conf.cache_memory_limit,
+            settings.conf.cache_eviction)
+
     settings.local.version = __version__
     settings.local.version_int = int(
         ''.join([x.zfill(2) for x in settings.local.version.split('.')]))
@@ -60,6 +60,7 @@ def setup_mongo():
         'auth_limiter': getattr(database, prefix + 'auth_limiter'),
         'otp': getattr(database, prefix + 'otp'),
         'otp_cache': getattr(database, prefix + 'otp_cache'),
+        'counters': getattr(database, prefix + 'counters'),
     })
 
     for collection_name, collection in mongo.collections.items():
@@ -79,6 +80,16 @@ def setup_mongo():
     })
     mongo.collections['log_entries'].name_str = 'log_entries'
 
+    for channel, partition in settings.mongo.messages_partitions.items():
+        collection_name = 'messages_' + channel
+        if prefix + collection_name not in cur_collections:
+            database.create_collection(prefix + collection_name,
+                capped=True, size=partition['size'], max=partition['max'])
+
+        mongo.collections[collection_name] = getattr(database,
+            prefix + collection_name)
+        mongo.collections[collection_name].name_str = collection_name
+
     mongo.collections['transaction'].ensure_index('lock_id', unique=True)
     mongo.collections['transaction'].ensure_index([
         ('ttl_timestamp', pymongo.ASCENDING),
@@ -102,6 +113,12 @@ def setup_mongo():
         ('org_id', pymongo.ASCENDING),
         ('name', pymongo.ASCENDING),
     ])
+    mongo.collections['users'].ensure_index([
+        ('org_id', pymongo.ASCENDING),
+        ('type', pymongo.ASCENDING),
+        ('name', pymongo.ASCENDING),
+        ('_id', pymongo.ASCENDING),
+    ])
     mongo.collections['users_key_link'].ensure_index('key_id')
     mongo.collections['users_key_link'].ensure_index('short_id', unique=True)
     mongo.collections['organizations'].ensure_index('type')
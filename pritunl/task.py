@@ -29,7 +29,6 @@ class Task(mongo.MongoObject):
 
     def __init__(self, **kwargs):
         mongo.MongoObject.__init__(self, **kwargs)
-        self.type = self.type
         self.runner_id = bson.ObjectId()
 
     @cached_static_property
@@ -67,7 +66,8 @@ class Task(mongo.MongoObject):
             if self.attempts <= settings.mongo.task_max_attempts:
                 if not self.claim_commit():
                     return
-                self.task()
+                with mongo.IdentityMap():
+                    self.task()
 
             self.complete()
         except:
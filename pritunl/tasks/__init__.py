@@ -1,4 +1,5 @@
 import pritunl.tasks.clean_ip_pool
 import pritunl.tasks.clean_users
 import pritunl.tasks.pooler
+import pritunl.tasks.reconcile_counters
 import pritunl.tasks.sync_ip_pool
@@ -0,0 +1,13 @@
+from pritunl.constants import *
+from pritunl.exceptions import *
+from pritunl.descriptors import *
+from pritunl import counters
+from pritunl import task
+
+class TaskReconcileCounters(task.Task):
+    type = 'reconcile_counters'
+
+    def task(self):
+        counters.reconcile_user_count()
+
+task.add_task(TaskReconcileCounters, minutes=xrange(11, 60, 15))
@@ -4,9 +4,11 @@ from pritunl.descriptors import *
 from pritunl import settings
 from pritunl import app
 from pritunl import mongo
+from pritunl import counters
 from pritunl import utils
 from pritunl import queue
 from pritunl import logger
+from pritunl import user_index
 
 import tarfile
 import os
@@ -31,6 +33,10 @@ class User(mongo.MongoObject):
         'private_key',
         'certificate',
     }
+    fields_deferred = frozenset((
+        'private_key',
+        'certificate',
+    ))
     fields_default = {
         'name': 'undefined',
         'disabled': False,
@@ -43,6 +49,7 @@ class User(mongo.MongoObject):
 
         self.org = org
         self.org_id = org.id
+        self._orig_type = self.type
 
         if name is not None:
             self.name = name
@@ -191,9 +198,38 @@ class User(mongo.MongoObject):
         if block:
             self.load()
 
+    def commit(self, *args, **kwargs):
+        exists = self.exists
+        if not exists:
+            index_changed = self.type in (CERT_CLIENT, CERT_SERVER)
+        else:
+            index_changed = 'name' in self.changed or \
+                'type' in self.changed
+
+        response = mongo.MongoObject.commit(self, *args, **kwargs)
+
+        # Retried queue commits of a new user update the existing doc
+        if not exists:
+            if not response or not response.get('updatedExisting'):
+                counters.inc_user_count(self.org_id, self.type)
+        elif self.type != self._orig_type:
+            counters.change_user_type(self.org_id, self._orig_type,
+                self.type)
+        self._orig_type = self.type
+
+        if index_changed:
+            user_index.publish_update(self.org_id, self.id, self.type,
+                self.name)
+
+        return response
+
     def remove(self):
         self.unassign_ip_addr()
-        mongo.MongoObject.remove(self)
+        response = mongo.MongoObject.remove(self)
+        # Users already removed are not counted again
+        if response and response.get('n'):
+            counters.inc_user_count(self.org_id, self.type, -1)
+        user_index.publish_remove(self.org_id, self.id)
 
     def get_cache_key(self, suffix=None):
         if not self.cache_prefix:
@@ -488,10 +524,111 @@ def reserve_pooled_user(org, name=None, email=None,
     })
 
     if doc:
+        counters.change_user_type(org.id, doc['type'], type)
+        user_index.publish_update(org.id, str(doc['_id']), type,
+            doc.get('name') if name is None else name)
         return User(org=org, doc=doc)
 
-def get_user(org, id):
-    return User(org=org, id=id)
+def reserve_pooled_users(org, users_data, type=CERT_CLIENT):
+    # Reserve pooled users for a list of user data dicts in order using a
+    # fixed number of queries for each batch. Stops at the first batch
+    # that can not be filled from the pool
+    pool_type = {
+        CERT_SERVER: CERT_SERVER_POOL,
+        CERT_CLIENT: CERT_CLIENT_POOL,
+    }[type]
+    batch_size = settings.user.bulk_batch_size
+    bulk_id = str(bson.ObjectId())
+
+    for i in xrange(0, len(users_data), batch_size):
+        batch = users_data[i:i + batch_size]
+
+        user_ids = [x['_id'] for x in User.collection.find({
+            'org_id': org.id,
+            'type': pool_type,
+        }, {
+            '_id': True,
+        }).limit(len(batch))]
+        if not user_ids:
+            return
+
+        # Users taken by another reservation since the find are skipped
+        User.collection.update({
+            '_id': {'$in': user_ids},
+            'type': pool_type,
+        }, {'$set': {
+            'type': type,
+            'bulk_id': bulk_id,
+        }}, multi=True)
+
+        counted = False
+        try:
+            docs = list(User.collection.find({
+                '_id': {'$in': user_ids},
+                'bulk_id': bulk_id,
+            }))
+            if not docs:
+                return
+            counters.change_user_type(org.id, pool_type, type, len(docs))
+            counted = True
+
+            if mongo.has_bulk:
+                bulk = User.collection.initialize_unordered_bulk_op()
+            else:
+                bulk = None
+
+            users = []
+            for doc, user_data in zip(docs, batch):
+                update_doc = {
+                    'name': user_data.get('name'),
+                    'email': user_data.get('email'),
+                }
+                if user_data.get('disabled') is not None:
+                    update_doc['disabled'] = user_data['disabled']
+
+                spec = {
+                    '_id': doc['_id'],
+                }
+                update = {
+                    '$set': update_doc,
+                    '$unset': {'bulk_id': ''},
+                }
+                if bulk:
+                    bulk.find(spec).update(update)
+                else:
+                    User.collection.update(spec, update)
+
+                doc.pop('bulk_id', None)
+                doc.update(update_doc)
+                users.append(User(org=org, doc=doc))
+
+            if bulk:
+                bulk.execute()
+        except:
+            # Return the reserved users that were not updated to the pool,
+            # users updated before the error keep their names
+            response = User.collection.update({
+                '_id': {'$in': user_ids},
+                'bulk_id': bulk_id,
+            }, {
+                '$set': {'type': pool_type},
+                '$unset': {'bulk_id': ''},
+            }, multi=True)
+            if counted and response['n']:
+                counters.change_user_type(org.id, type, pool_type,
+                    response['n'])
+            raise
+
+        user_index.publish_updates(org.id,
+            [(x.id, type, x.name) for x in users])
+
+        yield users
+
+        if len(docs) < len(batch):
+            return
+
+def get_user(org, id, prefetch=False):
+    return User.get_by_id(id, prefetch=prefetch, org=org)
 
 def find_user(org, name=None, type=None):
     spec = {
@@ -0,0 +1,222 @@
+from pritunl.constants import *
+from pritunl.exceptions import *
+from pritunl.descriptors import *
+from pritunl.cache import CacheTrie
+from pritunl import settings
+from pritunl import messenger
+from pritunl import counters
+from pritunl import mongo
+
+import threading
+import collections
+import heapq
+
+GRAM_LENGTH = 3
+INDEX_TYPES = (CERT_CLIENT, CERT_SERVER)
+
+# Indexes use about 1KB of memory for each user, mostly trie nodes for the
+# grams of each name. Indexes are dropped least recently used first when
+# the users indexed on this node exceed user.search_index_limit, orgs with
+# more users then the limit are not indexed and are searched in mongodb.
+_indexes = collections.OrderedDict()
+_indexes_lock = threading.Lock()
+
+def _grams(name):
+    # Grams at the end of the name are shorter so a prefix search of the
+    # trie matches any substring up to the gram length
+    return {name[i:i + GRAM_LENGTH] for i in xrange(len(name))}
+
+class UserIndex(object):
+    # Substring index of user names for one org, names are split into
+    # grams stored in a trie with the user id as the value
+    def __init__(self, org_id):
+        self.org_id = org_id
+        self.trie = CacheTrie('user_index-' + org_id)
+        self.users = {}
+        self.lock = threading.Lock()
+        self.loaded = False
+
+    @cached_static_property
+    def collection(cls):
+        return mongo.get_collection('users')
+
+    def load(self):
+        self.trie.clear_cache()
+        self.users = {}
+
+        for doc in self.collection.find({
+                    'org_id': self.org_id,
+                    'type': {'$in': INDEX_TYPES},
+                }, {
+                    '_id': True,
+                    'name': True,
+                    'type': True,
+                }):
+            self.add(str(doc['_id']), doc['type'], doc.get('name'))
+
+        self.loaded = True
+
+    def add(self, user_id, type, name):
+        self.remove(user_id)
+        if type not in INDEX_TYPES:
+            return
+
+        name = name or ''
+        name_lower = name.lower()
+        self.users[user_id] = (type, name, name_lower)
+        for gram in _grams(name_lower):
+            self.trie.add_key(gram, user_id)
+
+    def remove(self, user_id):
+        user = self.users.pop(user_id, None)
+        if user:
+            for gram in _grams(user[2]):
+                self.trie.remove_key(gram, user_id)
+
+    def search(self, query, limit=None):
+        query = query.lower()
+
+        if not query:
+            matches = self.users.keys()
+        elif len(query) <= GRAM_LENGTH:
+            matches = self.trie.get_prefix(query)
+        else:
+            # Candidates contain every gram of the query, the names are
+            # then checked to remove matches with grams out of order
+            postings = sorted([self.trie.get_prefix(query[i:i + GRAM_LENGTH])
+                for i in xrange(len(query) - GRAM_LENGTH + 1)], key=len)
+            matches = postings[0].intersection(*postings[1:])
+            matches = [x for x in matches if query in self.users[x][2]]
+
+        count = len(matches)
+        if limit is not None:
+            matches = heapq.nsmallest(limit, matches,
+                key=lambda x: self.users[x][:2])
+
+        return matches, count
+
+def get_index(org_id):
+    with _indexes_lock:
+        index = _indexes.pop(org_id, None)
+        if index is None:
+            index = UserIndex(org_id)
+        _indexes[org_id] = index
+    return index
+
+def drop_index(org_id):
+    with _indexes_lock:
+        index = _indexes.pop(org_id, None)
+    if index:
+        with index.lock:
+            index.trie.clear_cache()
+
+def _evict(org_id):
+    limit = settings.user.search_index_limit
+    drop = []
+
+    with _indexes_lock:
+        count = sum(len(x.users) for x in _indexes.itervalues())
+        for key, index in _indexes.items():
+            if count <= limit:
+                break
+            if key == org_id:
+                continue
+            count -= len(index.users)
+            drop.append(key)
+
+    for key in drop:
+        drop_index(key)
+
+def search(org_id, query, limit=None):
+    # Returns None when the org has too many users to be indexed
+    with _indexes_lock:
+        loaded = org_id in _indexes
+
+    if not loaded:
+        count = sum(counters.get_user_count(org_id, type=x)
+            for x in INDEX_TYPES)
+        if count > settings.user.search_index_limit:
+            return
+
+    index = get_index(org_id)
+    with index.lock:
+        loaded = index.loaded
+        if not loaded:
+            index.load()
+        result = index.search(query, limit)
+
+    if not loaded:
+        _evict(org_id)
+
+    return result
+
+def check(org_id, query, user_ids, users):
+    # Index is updated eventually from the users channel, search results
+    # are checked against the users found in mongodb. Users is a dict of
+    # user id to type and name, stale users are updated in the index and
+    # the number of stale users is returned.
+    query = query.lower()
+    stale = []
+
+    for user_id in user_ids:
+        user = users.get(user_id)
+        if not user or user[0] not in INDEX_TYPES or \
+                query not in (user[1] or '').lower():
+            stale.append(user_id)
+
+    if not stale:
+        return 0
+
+    with _indexes_lock:
+        index = _indexes.get(org_id)
+    if index:
+        with index.lock:
+            if index.loaded:
+                for user_id in stale:
+                    user = users.get(user_id)
+                    if user:
+                        index.add(user_id, user[0], user[1])
+                    else:
+                        index.remove(user_id)
+
+    return len(stale)
+
+def publish_update(org_id, user_id, type, name):
+    publish_updates(org_id, [(user_id, type, name)])
+
+def publish_updates(org_id, users):
+    # Changes to many users of an org are sent in one message, users is a
+    # list of user id, type and name
+    if users:
+        messenger.publish('users', [UPDATE, org_id,
+            [list(x) for x in users]])
+
+def publish_remove(org_id, user_id=None):
+    messenger.publish('users', [REMOVE, org_id, user_id])
+
+def on_msg(msg):
+    message = msg['message']
+    org_id = message[1]
+
+    if message[0] == REMOVE and message[2] is None:
+        drop_index(org_id)
+        return
+
+    # Indexes that are not loaded will read the change from the database
+    with _indexes_lock:
+        index = _indexes.get(org_id)
+    if not index:
+        return
+
+    with index.lock:
+        if not index.loaded:
+            return
+        if message[0] == UPDATE:
+            for user_id, type, name in message[2]:
+                index.add(user_id, type, name)
+        elif message[0] == REMOVE:
+            index.remove(message[2])
+
+def on_resync(msg):
+    for org_id in _indexes.keys():
+        drop_index(org_id)
@@ -27,6 +27,7 @@ AUTH_HANDLERS = [
     ('GET', '/auth'),
     ('GET', '/export'),
     ('GET', '/event'),
+    ('GET', '/event/stream'),
     ('GET', '/key/a1/a1.tar'),
     ('GET', '/key/a1/a1'),
     ('GET', '/log'),
@@ -49,6 +50,7 @@ AUTH_HANDLERS = [
     ('GET', '/server/a1/bandwidth'),
     ('GET', '/server/a1/bandwidth/1m'),
     ('GET', '/status'),
+    ('GET', '/status/stats'),
     ('GET', '/user/a1'),
     ('GET', '/user/a1/1'),
     ('GET', '/user/a1/a1'),
@@ -1087,6 +1089,16 @@ class Status(SessionTestCase):
         self.assertIn('local_networks', data)
         self.assertIn('notification', data)
 
+    @unittest.skipUnless(ENABLE_STANDARD_TESTS, 'Skipping test')
+    def test_status_stats_get(self):
+        response = self.session.get('/status/stats')
+        self.assertEqual(response.status_code, 200)
+
+        data = response.json()
+        self.assertIn('event', data)
+        self.assertIn('suppressed', data['event'])
+        self.assertIn('messenger', data)
+
 
 class User(SessionTestCase):
     @unittest.skipUnless(ENABLE_STANDARD_TESTS, 'Skipping test')
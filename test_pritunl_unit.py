@@ -0,0 +1,2107 @@
+import threading
+import unittest
+import tempfile
+import shutil
+import os
+import re
+import datetime
+import logging
+import copy
+import base64
+import time
+import random
+import bson
+import pymongo
+
+from pritunl.constants import *
+from pritunl.exceptions import *
+from pritunl.descriptors import *
+from pritunl import settings
+from pritunl.settings.settings import module_classes
+from pritunl import logger
+from pritunl import mongo
+
+COLLECTIONS = (
+    'messages',
+    'users',
+    'organizations',
+    'servers',
+    'hosts',
+    'queue',
+    'counters',
+    'log_entries',
+    'objects',
+)
+
+def _get_value(doc, key):
+    for name in key.split('.'):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(name)
+    return doc
+
+def _get_parent(doc, key):
+    names = key.split('.')
+    for name in names[:-1]:
+        if isinstance(doc, list):
+            doc = doc[int(name)]
+        else:
+            doc = doc.setdefault(name, {})
+    name = names[-1]
+    if isinstance(doc, list):
+        name = int(name)
+    return doc, name
+
+def _bracket(value):
+    # Comparison operators only match values of the same type
+    if value is None:
+        return 0
+    elif isinstance(value, (int, long, float)):
+        return 1
+    elif isinstance(value, basestring):
+        return 2
+    return type(value)
+
+def _match_value(value, cond):
+    if isinstance(cond, dict) and cond and \
+            all(x.startswith('$') for x in cond):
+        for op, arg in cond.items():
+            if op == '$in' and value not in arg:
+                return False
+            elif op == '$nin' and value in arg:
+                return False
+            elif op == '$ne' and value == arg:
+                return False
+            elif op in ('$gt', '$gte', '$lt') and \
+                    _bracket(value) != _bracket(arg):
+                return False
+            elif op == '$gt' and not value > arg:
+                return False
+            elif op == '$gte' and not value >= arg:
+                return False
+            elif op == '$lt' and not value < arg:
+                return False
+            elif op == '$exists' and (value is not None) != arg:
+                return False
+            elif op == '$regex' and not re.search(arg, value or '',
+                    re.I if 'i' in cond.get('$options', '') else 0):
+                return False
+        return True
+    elif isinstance(value, list) and not isinstance(cond, list):
+        return cond in value
+    return value == cond
+
+def _match(doc, spec):
+    for key, cond in (spec or {}).items():
+        if key == '$or':
+            if not any(_match(doc, x) for x in cond):
+                return False
+        elif not _match_value(_get_value(doc, key), cond):
+            return False
+    return True
+
+def _project(doc, fields):
+    doc = copy.deepcopy(doc)
+    if not fields:
+        return doc
+    if isinstance(fields, (list, tuple, set)):
+        fields = {x: True for x in fields}
+
+    if any(fields.values()):
+        projected = {'_id': doc['_id']} if '_id' in doc else {}
+        for key, include in fields.items():
+            if not include:
+                projected.pop(key, None)
+                continue
+            name = key.split('.')[0]
+            if name in doc:
+                projected[name] = doc[name]
+        return projected
+
+    for key in fields:
+        doc.pop(key, None)
+    return doc
+
+class Cursor(object):
+    def __init__(self, collection, docs):
+        self.collection = collection
+        self.docs = docs
+        self.alive = True
+
+    def sort(self, key, direction=pymongo.ASCENDING):
+        if isinstance(key, basestring):
+            key = [(key, direction)]
+        for field, direction in reversed(key):
+            if field == '$natural':
+                if direction == pymongo.DESCENDING:
+                    self.docs.reverse()
+                continue
+            self.docs.sort(key=lambda x: _get_value(x, field),
+                reverse=direction == pymongo.DESCENDING)
+        return self
+
+    def skip(self, skip):
+        self.docs = self.docs[skip:]
+        return self
+
+    def limit(self, limit):
+        if limit:
+            self.docs = self.docs[:limit]
+        return self
+
+    def count(self):
+        return len(self.docs)
+
+    def __getitem__(self, index):
+        return self.docs[index]
+
+    def __iter__(self):
+        docs = self.docs
+        self.docs = []
+        self.alive = False
+        return iter(docs)
+
+class Bulk(object):
+    def __init__(self, collection):
+        self.collection = collection
+        self.ops = []
+
+    def find(self, spec):
+        bulk = self
+
+        class BulkFind(object):
+            def update(self, doc):
+                bulk.ops.append((spec, doc))
+
+        return BulkFind()
+
+    def execute(self):
+        for i, (spec, doc) in enumerate(self.ops):
+            if i and self.collection.fail_bulk:
+                raise self.collection.fail_bulk
+            self.collection.update(spec, doc)
+
+class Collection(object):
+    # In memory collection implementing the subset of the pymongo api
+    # used by the modules under test, inserts can be set to fail with
+    # fail_insert and bulk ops to fail after the first op with fail_bulk
+    # for error handling tests
+    def __init__(self, name, max_docs=None):
+        self.name_str = name
+        self.max_docs = max_docs
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.docs = []
+            self.inserts = []
+            self.queries = 0
+            self.fail_insert = None
+            self.fail_bulk = None
+
+    def _apply(self, match, doc):
+        if not any(x.startswith('$') for x in doc):
+            doc_id = match['_id']
+            match.clear()
+            match.update(copy.deepcopy(doc))
+            match['_id'] = doc_id
+            return
+
+        for field, value in doc.get('$set', {}).items():
+            parent, name = _get_parent(match, field)
+            parent[name] = copy.deepcopy(value)
+        for field in doc.get('$unset', {}):
+            parent, name = _get_parent(match, field)
+            parent.pop(name, None)
+        for field, value in doc.get('$inc', {}).items():
+            parent, name = _get_parent(match, field)
+            parent[name] = parent.get(name, 0) + value
+        for field, value in doc.get('$push', {}).items():
+            parent, name = _get_parent(match, field)
+            if isinstance(value, dict) and '$each' in value:
+                parent.setdefault(name, []).extend(
+                    copy.deepcopy(value['$each']))
+            else:
+                parent.setdefault(name, []).append(copy.deepcopy(value))
+
+    def find(self, spec=None, fields=None, **kwargs):
+        with self.lock:
+            self.queries += 1
+            return Cursor(self, [_project(x, fields) for x in self.docs
+                if _match(x, spec)])
+
+    def find_one(self, spec=None, fields=None, **kwargs):
+        if spec is not None and not isinstance(spec, dict):
+            spec = {'_id': spec}
+        for doc in self.find(spec, fields).limit(1):
+            return doc
+
+    def find_and_modify(self, query=None, update=None, new=False,
+            fields=None, **kwargs):
+        with self.lock:
+            for match in self.docs:
+                if _match(match, query):
+                    orig = _project(match, fields)
+                    self._apply(match, update)
+                    return _project(match, fields) if new else orig
+
+    def insert(self, docs, **kwargs):
+        with self.lock:
+            if self.fail_insert:
+                raise self.fail_insert
+            for doc in docs if isinstance(docs, list) else [docs]:
+                doc = copy.deepcopy(doc)
+                doc.setdefault('_id', bson.ObjectId())
+                if any(x['_id'] == doc['_id'] for x in self.docs):
+                    raise pymongo.errors.DuplicateKeyError('duplicate')
+                self.docs.append(doc)
+                self.inserts.append(doc)
+            if self.max_docs:
+                del self.docs[:-self.max_docs]
+
+    def update(self, spec, doc, upsert=False, multi=False, **kwargs):
+        with self.lock:
+            matched = [x for x in self.docs if _match(x, spec)]
+            if not multi:
+                matched = matched[:1]
+
+            if not matched and upsert:
+                new_doc = {x: y for x, y in spec.items()
+                    if not x.startswith('$') and not isinstance(y, dict)}
+                new_doc.setdefault('_id', bson.ObjectId())
+                self.docs.append(new_doc)
+                self._apply(new_doc, doc)
+                for field, value in doc.get('$setOnInsert', {}).items():
+                    parent, name = _get_parent(new_doc, field)
+                    parent[name] = copy.deepcopy(value)
+                return {
+                    'n': 1,
+                    'updatedExisting': False,
+                    'upserted': new_doc['_id'],
+                }
+
+            for match in matched:
+                self._apply(match, doc)
+
+            return {
+                'n': len(matched),
+                'updatedExisting': bool(matched),
+            }
+
+    def remove(self, spec=None, **kwargs):
+        if spec is not None and not isinstance(spec, dict):
+            spec = {'_id': spec}
+        with self.lock:
+            count = len(self.docs)
+            self.docs = [x for x in self.docs if not _match(x, spec)]
+            return {
+                'n': count - len(self.docs),
+            }
+
+    def aggregate(self, pipeline):
+        # Only the $match and $group stages used for counting are supported
+        with self.lock:
+            docs = copy.deepcopy(self.docs)
+
+        for stage in pipeline:
+            if '$match' in stage:
+                docs = [x for x in docs if _match(x, stage['$match'])]
+            elif '$group' in stage:
+                groups = {}
+                for doc in docs:
+                    key = tuple((x, doc.get(y[1:])) for x, y in sorted(
+                        stage['$group']['_id'].items()))
+                    groups[key] = groups.get(key, 0) + 1
+                docs = [{'_id': dict(x), 'count': y}
+                    for x, y in groups.items()]
+
+        return {'result': docs}
+
+    def initialize_unordered_bulk_op(self):
+        return Bulk(self)
+
+class TestObject(mongo.MongoObject):
+    fields = {
+        'name',
+        'type',
+        'groups',
+        'data',
+        'private_key',
+    }
+    fields_default = {
+        'type': 'client',
+        'groups': [],
+        'data': {},
+    }
+    fields_deferred = frozenset((
+        'private_key',
+    ))
+
+    @cached_static_property
+    def collection(cls):
+        return mongo.get_collection('objects')
+
+def setUpModule():
+    for cls in module_classes:
+        if cls.type == GROUP_MONGO:
+            setattr(settings, cls.group, cls())
+    settings.local.mongo_time = datetime.datetime.utcnow()
+    settings.local.mongo_time_start = datetime.datetime.utcnow()
+
+    logger.log_handler = logging.NullHandler()
+    logger.log_filter = logger.LogFilter()
+
+    for name in COLLECTIONS:
+        mongo.collections[name] = Collection(name)
+
+class UnitTestCase(unittest.TestCase):
+    def setUp(self):
+        for name in COLLECTIONS:
+            mongo.collections[name].reset()
+
+    def get_collection(self, name):
+        return mongo.collections[name]
+
+    def insert_object(self, **kwargs):
+        doc = {
+            '_id': bson.ObjectId(),
+            'name': 'test',
+            'groups': ['a'],
+            'data': {'a': {'b': 1}},
+            'private_key': 'key',
+        }
+        doc.update(kwargs)
+        self.get_collection('objects').insert(doc)
+        return doc
+
+
+class Event(UnitTestCase):
+    def setUp(self):
+        from pritunl import messenger
+
+        UnitTestCase.setUp(self)
+        self.hub = messenger.hub
+        messenger.hub = messenger.SubscriptionHub()
+
+        # Messages are read from the collection by the subscriber catch up
+        # without starting the tail threads
+        messenger.hub._running = True
+
+    def tearDown(self):
+        from pritunl import messenger
+        messenger.hub = self.hub
+
+    def test_stream_limit(self):
+        from pritunl import event
+
+        settings.app.event_stream_limit = 2
+        try:
+            self.assertTrue(event.acquire_stream())
+            self.assertTrue(event.acquire_stream())
+            self.assertFalse(event.acquire_stream())
+            self.assertEqual(event.get_stats()['streams'], 2)
+
+            event.release_stream()
+            self.assertTrue(event.acquire_stream())
+        finally:
+            event.release_stream()
+            event.release_stream()
+            settings.app.event_stream_limit = 4
+
+        self.assertEqual(event.get_stats()['streams'], 0)
+
+    def get_events(self):
+        from pritunl import messenger
+
+        return [x['message'] for x in self.get_collection(
+            messenger.get_collection_name('events')).find({
+                'channel': 'events',
+            })]
+
+    def test_coalesce(self):
+        from pritunl import event
+
+        stats = event.get_stats()
+        settings.app.event_coalesce_window = 0.3
+        try:
+            # A burst publishes one leading event and one trailing event
+            # when the window ends, single events have no trailing event
+            for _ in xrange(5):
+                event.Event(USERS_UPDATED, 'org')
+            event.Event(USERS_UPDATED, 'other')
+            event.Event(SERVERS_UPDATED)
+            self.assertEqual(self.get_events(), [
+                (USERS_UPDATED, 'org'),
+                (USERS_UPDATED, 'other'),
+                (SERVERS_UPDATED, None),
+            ])
+
+            for _ in xrange(40):
+                if len(self.get_events()) > 3:
+                    break
+                time.sleep(0.05)
+            time.sleep(0.4)
+            self.assertEqual(self.get_events()[3:], [
+                (USERS_UPDATED, 'org'),
+            ])
+        finally:
+            settings.app.event_coalesce_window = 0
+            with event._windows_lock:
+                event._windows.clear()
+
+        new_stats = event.get_stats()
+        self.assertEqual(new_stats['published'] - stats['published'], 3)
+        self.assertEqual(new_stats['suppressed'] - stats['suppressed'], 4)
+        self.assertEqual(new_stats['trailing'] - stats['trailing'], 1)
+
+    def test_coalesce_suppressed(self):
+        from pritunl import event
+
+        settings.app.event_coalesce_window = 60
+        try:
+            # Events inside the window are only marked for a trailing event
+            event.Event(USERS_UPDATED, 'org')
+            self.assertEqual(event._windows[(USERS_UPDATED, 'org')][1],
+                False)
+            event.Event(USERS_UPDATED, 'org')
+            event.Event(USERS_UPDATED, 'org')
+            self.assertEqual(event._windows[(USERS_UPDATED, 'org')][1],
+                True)
+            self.assertEqual(self.get_events(), [
+                (USERS_UPDATED, 'org'),
+            ])
+
+            # Events after the window ends are published again
+            event._windows[(USERS_UPDATED, 'org')][0] = time.time()
+            event.Event(USERS_UPDATED, 'org')
+            self.assertEqual(self.get_events(), [
+                (USERS_UPDATED, 'org'),
+                (USERS_UPDATED, 'org'),
+            ])
+        finally:
+            settings.app.event_coalesce_window = 0
+            with event._windows_lock:
+                event._windows.clear()
+
+    def test_stream_invalid_cursor_resync(self):
+        from pritunl import event
+
+        stream = event.stream_events(cursor='invalid')
+        try:
+            self.assertEqual(stream.next(), 'retry: 1000\n\n')
+            self.assertIn('"type": "resync"', stream.next())
+        finally:
+            stream.close()
+
+    def test_stream_rotated_cursor_resync(self):
+        from pritunl import event
+        from pritunl import messenger
+
+        # Cursor is older then the oldest message in the capped collection
+        cursor_id = bson.ObjectId()
+        messenger.publish('events', (USERS_UPDATED, None))
+
+        stream = event.stream_events(cursor=str(cursor_id))
+        try:
+            self.assertEqual(stream.next(), 'retry: 1000\n\n')
+            self.assertIn('"type": "resync"', stream.next())
+            self.assertIn('"type": "%s"' % USERS_UPDATED, stream.next())
+        finally:
+            stream.close()
+
+
+class Messenger(UnitTestCase):
+    def _expire_missing(self, hub):
+        # Move missing seqs past the grace period
+        for stream in hub._streams.values():
+            for seq in stream[1]:
+                stream[1][seq] -= MESSENGER_GAP_GRACE
+        hub._gap_check = 0
+        hub._check_gaps()
+
+    def _get_gaps(self, hub):
+        return [x[1] for x in hub._buffer if x[1]['_id'] is None]
+
+    def test_publish_buffer_seq_order(self):
+        from pritunl import messenger
+
+        collection = self.get_collection('messages')
+
+        with messenger.PublishBuffer():
+            messenger.publish('test', 'buffered')
+
+            thread = threading.Thread(target=messenger.publish,
+                args=('test', 'unbuffered'))
+            thread.start()
+            thread.join()
+
+            self.assertEqual([x['message'] for x in collection.inserts],
+                ['unbuffered'])
+
+        docs = collection.inserts
+        self.assertEqual([x['message'] for x in docs],
+            ['unbuffered', 'buffered'])
+        self.assertEqual(docs[1]['seq'], docs[0]['seq'] + 1)
+
+        hub = messenger.SubscriptionHub()
+        for doc in docs:
+            hub._append(copy.deepcopy(doc))
+        self._expire_missing(hub)
+        self.assertEqual(self._get_gaps(hub), [])
+
+    def test_gap_detection(self):
+        from pritunl import messenger
+
+        hub = messenger.SubscriptionHub()
+        pub_id = bson.ObjectId()
+        for seq in (1, 2, 4, 6, 5):
+            hub._append({
+                '_id': bson.ObjectId(),
+                'channel': 'test',
+                'message': seq,
+                'pub_id': pub_id,
+                'seq': seq,
+            })
+
+        # Out of order seqs inside the grace period are not gaps
+        hub._gap_check = 0
+        hub._check_gaps()
+        self.assertEqual(self._get_gaps(hub), [])
+
+        self._expire_missing(hub)
+        gaps = self._get_gaps(hub)
+        self.assertEqual(len(gaps), 1)
+        self.assertEqual(gaps[0]['channel'], 'test')
+        self.assertEqual(gaps[0]['message'], RESYNC)
+        self.assertEqual(gaps[0]['missed'], 1)
+        self.assertEqual(hub.get_stats()['gap_channels'], {'test': 1})
+
+    def test_subscribe_resync_gap(self):
+        from pritunl import messenger
+
+        hub = messenger.SubscriptionHub()
+        hub._running = True
+        cursor_id = bson.ObjectId()
+        hub._append({
+            '_id': cursor_id,
+            'channel': 'test',
+            'message': 'first',
+        })
+        hub._append_gap('test', 3)
+        hub._append({
+            '_id': bson.ObjectId(),
+            'channel': 'test',
+            'message': 'second',
+        })
+
+        messages = [x['message'] for x in hub.subscribe('test',
+            cursor_id=cursor_id, timeout=0.01, resync=True)]
+        self.assertEqual(messages, [RESYNC, 'second'])
+
+        messages = [x['message'] for x in hub.subscribe('test',
+            cursor_id=cursor_id, timeout=0.01)]
+        self.assertEqual(messages, ['second'])
+
+    def test_cursor_id_untailed(self):
+        from pritunl import messenger
+
+        messages = self.get_collection('messages')
+        hub = messenger.hub
+        messenger.hub = messenger.SubscriptionHub()
+        messenger.hub._running = True
+        try:
+            doc = {
+                '_id': bson.ObjectId(),
+                'channel': 'test',
+                'message': 'seen',
+            }
+            messages.insert(doc)
+            messenger.hub._append(copy.deepcopy(doc))
+            self.assertEqual(messenger.get_cursor_id('test'), doc['_id'])
+
+            # Docs inserted but not yet tailed by the hub are before the
+            # returned cursor
+            messenger.publish('test', 'stale')
+            messenger.publish('other', 'stale')
+            cursor_id = messenger.get_cursor_id('test')
+            self.assertEqual(cursor_id, messages.inserts[-1]['_id'])
+            self.assertEqual([x['message'] for x in messages.find({
+                '_id': {'$gt': cursor_id},
+            })], [])
+
+            # Stale docs tailed after the subscribe are not delivered
+            def tail():
+                time.sleep(0.05)
+                messenger.publish('test', 'new')
+                for doc in messages.inserts[1:]:
+                    messenger.hub._append(copy.deepcopy(doc))
+
+            thread = threading.Thread(target=tail)
+            thread.start()
+            self.assertEqual([x['message'] for x in messenger.subscribe(
+                'test', cursor_id=cursor_id, timeout=0.3)], ['new'])
+            thread.join()
+        finally:
+            messenger.hub = hub
+
+    def test_partitions(self):
+        from pritunl import messenger
+
+        messages = self.get_collection('messages')
+        events = Collection('messages_events')
+        mongo.collections['messages_events'] = events
+        try:
+            self.assertEqual(messenger.get_collection_name('events'),
+                'messages_events')
+            self.assertEqual(messenger.get_collection_name('queue'),
+                'messages')
+            self.assertEqual(messenger.get_collection_names(
+                ['events', 'queue', 'test']),
+                {'messages_events', 'messages'})
+
+            cursor_id = bson.ObjectId()
+            messenger.publish('queue', 'first')
+            messenger.publish(['events', 'queue'], 'second')
+            with messenger.PublishBuffer():
+                messenger.publish('events', 'third')
+                messenger.publish('queue', 'fourth')
+
+            self.assertEqual([x['message'] for x in events.inserts],
+                ['second', 'third'])
+            self.assertEqual([x['message'] for x in messages.inserts],
+                ['first', 'second', 'fourth'])
+
+            # Catch up reads from both collections in _id order
+            hub = messenger.SubscriptionHub()
+            docs = hub._catch_up(('events', 'queue'), cursor_id)
+            self.assertEqual([x['_id'] for x in docs], sorted(
+                x['_id'] for x in events.inserts + messages.inserts))
+            self.assertEqual([x['message'] for x in docs
+                if x['channel'] == 'queue'], ['first', 'second', 'fourth'])
+            self.assertFalse(any('seq' in x for x in docs))
+
+            docs = hub._catch_up(('events',), events.inserts[0]['_id'])
+            self.assertEqual([x['message'] for x in docs], ['third'])
+
+            # Partitioned channels written to the messages collection by
+            # hosts without the partition are also read
+            messages.insert({
+                '_id': bson.ObjectId(),
+                'channel': 'events',
+                'message': 'legacy',
+            })
+            docs = hub._catch_up(('events',), events.inserts[0]['_id'])
+            self.assertEqual([x['message'] for x in docs],
+                ['third', 'legacy'])
+        finally:
+            mongo.collections.pop('messages_events')
+
+class Listener(UnitTestCase):
+    def setUp(self):
+        from pritunl import listener
+
+        UnitTestCase.setUp(self)
+        self.messages = []
+        self.resyncs = []
+        self.done = threading.Event()
+        self.release = threading.Event()
+
+        def on_msg(msg):
+            self.release.wait(5)
+            self.messages.append(msg['message'])
+
+        def on_resync(msg):
+            self.resyncs.append(msg['missed'])
+            self.done.set()
+
+        listener.add_listener('test', on_msg)
+        listener.add_resync('test', on_resync)
+
+    def tearDown(self):
+        from pritunl import listener
+        listener.channels.pop('test', None)
+        listener.resyncs.pop('test', None)
+
+    def test_executor_full_queue(self):
+        from pritunl.runners.listener import ChannelExecutor
+
+        executor = ChannelExecutor('test', 1, 2)
+
+        # Full queue must not block the listener thread
+        start = time.time()
+        for i in xrange(6):
+            executor.put({
+                '_id': bson.ObjectId(),
+                'channel': 'test',
+                'message': i,
+            })
+        self.assertLess(time.time() - start, 1)
+
+        self.release.set()
+        self.assertTrue(self.done.wait(5))
+
+        # First message is being processed, next two are queued and the
+        # rest are dropped and replaced with a resync
+        self.assertEqual(self.messages[0], 0)
+        self.assertEqual(sum(self.resyncs), 6 - len(self.messages))
+
+        stats = executor.get_stats()
+        self.assertEqual(stats['dropped'], sum(self.resyncs))
+        self.assertEqual(stats['resyncs'], 1)
+
+
+class TunlDB(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'tunldb')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def get_db(self, **kwargs):
+        from pritunl.cache.tunldb import TunlDB
+        db = TunlDB()
+        db.persist(self.path, auto_export=False, **kwargs)
+        return db
+
+    def test_journal_replay(self):
+        db = self.get_db(journal=True)
+        db.set('key', 'value')
+        db.set('remove', 'value')
+        db.remove('remove')
+        db.set_add('set', 'a')
+        db.set_add('set', 'b')
+        db.set_remove('set', 'a')
+        db.list_rpush('list', '1')
+        db.list_rpush('list', '2')
+        db.list_lpop('list')
+        db.dict_set('dict', 'field', 'value')
+        db.increment('count')
+        db.increment('count')
+        db.rename('key', 'renamed')
+        transaction = db.transaction()
+        transaction.set('tran', 'value')
+        transaction.dict_set('dict', 'tran', 'value')
+        transaction.commit()
+        db._journal_flush()
+
+        db = self.get_db(journal=True)
+        self.assertIsNone(db.get('key'))
+        self.assertEqual(db.get('renamed'), 'value')
+        self.assertFalse(db.exists('remove'))
+        self.assertEqual(db.set_elements('set'), {'b'})
+        self.assertEqual(db.list_elements('list'), ['2'])
+        self.assertEqual(db.dict_get_all('dict'), {
+            'field': 'value',
+            'tran': 'value',
+        })
+        self.assertEqual(db.get('count'), '2')
+        self.assertEqual(db.get('tran'), 'value')
+
+    def test_journal_invalid_value(self):
+        db = self.get_db(journal=True)
+        db.set('key', 'value')
+        db.dict_set('dict', 'field', 'value')
+
+        # Value that can not be journaled must not change the data
+        self.assertRaises(UnicodeDecodeError, db.set, 'key', '\xff')
+        self.assertRaises(UnicodeDecodeError, db.dict_set,
+            'dict', 'field', '\xff')
+        self.assertEqual(db.get('key'), 'value')
+        self.assertEqual(db.dict_get('dict', 'field'), 'value')
+
+        db.set('after', 'value')
+        db._journal_flush()
+
+        db = self.get_db(journal=True)
+        self.assertEqual(db.get('key'), 'value')
+        self.assertEqual(db.dict_get('dict', 'field'), 'value')
+        self.assertEqual(db.get('after'), 'value')
+
+    def _run_timeout(self, target, timeout=5):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        thread.join(timeout)
+        self.assertFalse(thread.is_alive(), 'Operation deadlocked')
+
+    def test_transaction_rename(self):
+        from pritunl.cache.tunldb import TunlDB
+        db = TunlDB()
+        db.set('a', 'value')
+        db.set('c', 'value2')
+
+        def commit():
+            transaction = db.transaction()
+            transaction.rename('a', 'b')
+            transaction.rename('c', 'a')
+            transaction.set('d', 'value3')
+            transaction.commit()
+        self._run_timeout(commit)
+
+        self.assertEqual(db.get('a'), 'value2')
+        self.assertEqual(db.get('b'), 'value')
+        self.assertIsNone(db.get('c'))
+        self.assertEqual(db.get('d'), 'value3')
+
+        # Stripe locks must be released after the transaction
+        self._run_timeout(lambda: db.rename('b', 'c'))
+        self.assertEqual(db.get('c'), 'value')
+
+    def test_striped_increment(self):
+        from pritunl.cache.tunldb import TunlDB
+        db = TunlDB()
+
+        def increment():
+            for _ in xrange(500):
+                db.increment('count')
+                db.list_rpush('list', 'value')
+
+        threads = [threading.Thread(target=increment) for _ in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(db.get('count'), '4000')
+        self.assertEqual(db.list_length('list'), 4000)
+
+    def test_export_during_iter(self):
+        from pritunl.cache.tunldb import TunlDB
+        db = TunlDB()
+        db._path = self.path
+        for i in xrange(10):
+            db.set_add('set', str(i))
+            db.dict_set('dict', str(i), str(i))
+
+        # Values shared with an iterator are copied before a mutation
+        elements = db.set_iter('set')
+        first = elements.next()
+        db.set_add('set', 'new')
+        self.assertNotIn('new', [first] + list(elements))
+
+        db.export_data()
+        db.dict_set('dict', 'after', 'value')
+
+        db = self.get_db()
+        self.assertIn('new', db.set_elements('set'))
+        self.assertEqual(len(db.dict_get_all('dict')), 10)
+
+    def wait_for(self, func, timeout=3):
+        end = time.time() + timeout
+        while not func():
+            if time.time() > end:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def test_expire(self):
+        from pritunl.cache import tunldb
+        db = tunldb.TunlDB()
+        for key in ('a', 'b', 'c', 'd'):
+            db.set(key, key)
+
+        db.expire('a', 0.05)
+        # Shorter ttl is scheduled again, longer ttl is rescheduled by the
+        # expire thread when the first entry is reached
+        db.expire('b', 30)
+        db.expire('b', 0.05)
+        db.expire('c', 0.05)
+        db.expire('c', 30)
+        db.expire('d', 0.05)
+        db.set('d', 'd')
+
+        self.assertTrue(self.wait_for(lambda: not db._data.get('a')))
+        self.assertTrue(self.wait_for(lambda: not db._data.get('b')))
+        self.assertTrue(self.wait_for(lambda: not db._data.get('d')))
+        self.assertEqual(db.get('c'), 'c')
+        self.assertTrue(self.wait_for(lambda: len(db._expire_heap) == 2))
+        self.assertEqual(sorted(x[2] for x in db._expire_heap),
+            ['b', 'c'])
+
+        expire_thread = db._expire_thread
+        db.expire('c', 0.01)
+        self.assertTrue(self.wait_for(lambda: not db._data.get('c')))
+        self.assertIs(db._expire_thread, expire_thread)
+
+        # Expired keys are not returned before the expire thread runs
+        db.set('e', 'e')
+        db._expire_at('e', int(time.time() * 1000) - 1)
+        self.assertIsNone(db.get('e'))
+
+        channel_ttl = tunldb.CHANNEL_TTL
+        tunldb.CHANNEL_TTL = 0.05
+        try:
+            db.publish('channel', 'message')
+            self.assertIn('channel', db._channels)
+            self.assertTrue(self.wait_for(
+                lambda: 'channel' not in db._channels))
+        finally:
+            tunldb.CHANNEL_TTL = channel_ttl
+
+    def test_expire_import(self):
+        db = self.get_db()
+        db.set('expired', 'value')
+        db.set('active', 'value')
+        db.expire('expired', 0.05)
+        db.expire('active', 30)
+        db.export_data()
+        time.sleep(0.1)
+
+        db = self.get_db()
+        self.assertNotIn('expired', db._data)
+        self.assertEqual(db.get('active'), 'value')
+        self.assertEqual([x[2] for x in db._expire_heap], ['active'])
+
+    def fill_db(self, db):
+        db.set('str', 'value')
+        db.set('empty', '')
+        db.set('none', None)
+        db.set(u'unicode_\xe9', u'caf\xe9')
+        db.set('ttl', 'value')
+        db.expire('ttl', 30)
+        for i in xrange(3):
+            db.set_add('set', str(i))
+            db.list_rpush('list', str(i))
+            db.dict_set('dict', str(i), str(i) * 3)
+        db.list_rpush('list', u'\u2603')
+        db.dict_set('dict', 'none', None)
+
+    def check_db(self, db):
+        self.assertEqual(db.get('str'), 'value')
+        self.assertEqual(db.get('empty'), '')
+        self.assertTrue(db.exists('none'))
+        self.assertIsNone(db.get('none'))
+        self.assertEqual(db.get(u'unicode_\xe9'), u'caf\xe9')
+        self.assertEqual(db.get('ttl'), 'value')
+        self.assertEqual(db._data['ttl'].ttl, self.ttl)
+        self.assertEqual(db.set_elements('set'), {'0', '1', '2'})
+        self.assertEqual(db.list_elements('list'),
+            ['0', '1', '2', u'\u2603'])
+        self.assertEqual(db.dict_get_all('dict'), {
+            '0': '000',
+            '1': '111',
+            '2': '222',
+            'none': None,
+        })
+        self.assertEqual([x[2] for x in db._expire_heap], ['ttl'])
+
+    def test_binary_snapshot(self):
+        from pritunl.cache import tunldb
+
+        db = self.get_db(binary=True)
+        self.fill_db(db)
+        self.ttl = db._data['ttl'].ttl
+        db.export_data()
+
+        with open(self.path, 'rb') as db_file:
+            self.assertEqual(db_file.read(len(tunldb.SNAPSHOT_MAGIC)),
+                tunldb.SNAPSHOT_MAGIC)
+
+        db = self.get_db(binary=True)
+        self.check_db(db)
+
+        # Binary snapshots can be loaded without the binary option and
+        # json snapshots with it
+        db = self.get_db()
+        self.check_db(db)
+        db.export_data()
+        with open(self.path, 'rb') as db_file:
+            self.assertEqual(db_file.read(1), '{')
+
+        db = self.get_db(binary=True)
+        self.check_db(db)
+
+    def test_binary_snapshot_journal(self):
+        db = self.get_db(binary=True, journal=True)
+        self.fill_db(db)
+        self.ttl = db._data['ttl'].ttl
+        db._journal_flush()
+
+        db = self.get_db(binary=True, journal=True)
+        self.check_db(db)
+        db.set('str', 'new')
+        db._journal_flush()
+
+        db = self.get_db(binary=True)
+        self.assertEqual(db.get('str'), 'new')
+
+    def test_eviction_lru(self):
+        from pritunl.cache import tunldb
+        db = tunldb.TunlDB()
+        value = 'x' * 100
+        size = tunldb.ENTRY_OVERHEAD + len('key00') + len(value)
+        db.set_memory_limit(size * 10)
+
+        db.set('pinned', value)
+        db.pin('pinned')
+        db.set('ttl', value)
+        db.expire('ttl', 30)
+        for i in xrange(40):
+            db.set('key%02d' % i, value)
+            time.sleep(0.001)
+
+        stats = db.get_stats()
+        self.assertLessEqual(stats['memory'], size * 10)
+        self.assertGreater(stats['evictions'], 0)
+        self.assertEqual(stats['memory'], sum(db._sizes.values()))
+        self.assertEqual(set(db._sizes), set(db._data))
+        self.assertEqual(db.get('pinned'), value)
+        self.assertEqual(db.get('ttl'), value)
+        self.assertEqual(db.get('key39'), value)
+        self.assertNotIn('pinned', db._evictable)
+        self.assertNotIn('ttl', db._evictable)
+
+        # Unpinned keys can be evicted again
+        db.unpin('pinned')
+        self.assertIn('pinned', db._evictable)
+
+        # Growing a value is accounted and evicts other keys
+        for i in xrange(10):
+            db.list_rpush('list', value)
+        self.assertLessEqual(db.get_stats()['memory'], size * 10)
+        self.assertEqual(len(db.list_elements('list')), 10)
+
+    def test_eviction_lfu(self):
+        from pritunl.cache import tunldb
+        db = tunldb.TunlDB()
+        value = 'x' * 100
+        size = tunldb.ENTRY_OVERHEAD + len('key00') + len(value)
+
+        db.set('hot', value)
+        for _ in xrange(100):
+            db.get('hot')
+        db.set_memory_limit(size * 5, eviction=tunldb.LFU)
+        for _ in xrange(100):
+            db.get('hot')
+
+        for i in xrange(40):
+            db.set('key%02d' % i, value)
+            db.get('key%02d' % i)
+
+        self.assertEqual(db.get('hot'), value)
+        self.assertLessEqual(db.get_stats()['memory'], size * 5)
+        self.assertEqual(db.get_stats()['eviction'], tunldb.LFU)
+
+        db.remove('hot')
+        self.assertNotIn('hot', db._sizes)
+        self.assertNotIn('hot', db._evictable)
+        self.assertEqual(db.get_stats()['memory'], sum(db._sizes.values()))
+
+        with self.assertRaises(ValueError):
+            db.set_memory_limit(size, eviction='fifo')
+
+    def publish_thread(self, db, channel, messages, start=None, done=None):
+        def publish():
+            self.wait_for(lambda: db._channels.get(channel) and
+                db._channels[channel].subs)
+            time.sleep(0.02)
+            for i, message in enumerate(messages):
+                db.publish(channel, message)
+                if not i and start:
+                    start.wait(3)
+            if done:
+                done.set()
+
+        thread = threading.Thread(target=publish)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def test_channel(self):
+        from pritunl.cache import tunldb
+        db = tunldb.TunlDB()
+
+        db.publish('channel', 'before')
+        thread = self.publish_thread(db, 'channel', ['a', 'b', 'c'])
+        messages = []
+        for message in db.subscribe('channel', timeout=0.3):
+            messages.append(message)
+            if len(messages) == 3:
+                break
+        thread.join()
+
+        self.assertEqual(messages, ['a', 'b', 'c'])
+        self.assertEqual(db._channels['channel'].subs, 0)
+        self.assertEqual(db._channels['channel'].seq, 4)
+
+        # Channels with subscribers are cleared instead of removed
+        chan = db._channel('channel', True)
+        with db._channels_lock:
+            db._clear_channel('channel')
+        self.assertIs(db._channels['channel'], chan)
+        self.assertEqual(chan.first, chan.seq)
+        self.assertIsNone(chan.ttl)
+        chan.subs -= 1
+        with db._channels_lock:
+            db._clear_channel('channel')
+        self.assertNotIn('channel', db._channels)
+
+    def test_channel_missed(self):
+        from pritunl.cache import tunldb
+        db = tunldb.TunlDB()
+        count = tunldb.CHANNEL_BUFFER * 2
+        start = threading.Event()
+        done = threading.Event()
+
+        thread = self.publish_thread(db, 'channel', range(count),
+            start=start, done=done)
+        messages = []
+        missed = []
+        for message in db.subscribe('channel', timeout=0.3, missed=True):
+            if isinstance(message, tunldb.TunlDBMissed):
+                missed.append(message.count)
+                continue
+            messages.append(message)
+            if len(messages) == 1:
+                # Fall behind the channel buffer
+                start.set()
+                self.assertTrue(done.wait(3))
+            if messages[-1] == count - 1:
+                break
+        thread.join()
+
+        self.assertEqual(len(missed), 1)
+        self.assertEqual(len(messages) + missed[0], count)
+        self.assertEqual(messages[-tunldb.CHANNEL_BUFFER:],
+            range(count - tunldb.CHANNEL_BUFFER, count))
+        self.assertEqual(messages, sorted(set(messages)))
+
+        # Missed messages are skipped without a marker by default
+        start.clear()
+        done.clear()
+        thread = self.publish_thread(db, 'channel', range(count),
+            start=start, done=done)
+        messages = []
+        for message in db.subscribe('channel', timeout=0.3):
+            messages.append(message)
+            if len(messages) == 1:
+                start.set()
+                self.assertTrue(done.wait(3))
+            if messages[-1] == count - 1:
+                break
+        thread.join()
+
+        self.assertLess(len(messages), count)
+        self.assertFalse(any(isinstance(x, tunldb.TunlDBMissed)
+            for x in messages))
+
+
+class CacheTrie(unittest.TestCase):
+    def tearDown(self):
+        from pritunl.cache import cache_trie
+        cache_trie._roots.clear()
+
+    def check_nodes(self, node, root=True):
+        for char, child in node.children.items():
+            self.assertTrue(child.label)
+            self.assertEqual(child.label[0], char)
+            # Nodes without values must branch to stay compressed
+            if not child.values:
+                self.assertGreaterEqual(len(child.children), 2)
+            self.check_nodes(child, False)
+
+    def check_trie(self, trie, keys):
+        from pritunl.cache import cache_trie
+
+        root = cache_trie._roots.get(trie.name)
+        if root is not None:
+            self.check_nodes(root)
+
+        for prefix in ('', 'a', 'b', 'ab', 'ba', 'aab', 'abab', 'bbbbb'):
+            matches = sorted((len(x), x) for x in keys if x.startswith(
+                prefix) and keys[x])
+            values = set()
+            for _, key in matches:
+                values.update(keys[key])
+            self.assertEqual(trie.get_prefix(prefix), values)
+            self.assertEqual(len(list(trie.iter_prefix(prefix))),
+                len(values))
+
+            top = []
+            for _, key in matches:
+                for value in sorted(keys[key]):
+                    if value not in top:
+                        top.append(value)
+            self.assertEqual(trie.get_top(prefix, 3), top[:3])
+
+    def test_random(self):
+        from pritunl.cache import cache_trie
+        from pritunl.cache.cache_trie import CacheTrie
+
+        rand = random.Random(4)
+        trie = CacheTrie('test')
+        keys = {}
+        for _ in xrange(600):
+            key = ''.join(rand.choice('ab') for _ in xrange(
+                rand.randint(1, 6)))
+            value = rand.randint(0, 1)
+            if rand.random() < 0.3 or not keys.get(key):
+                trie.add_key(key, value)
+                keys.setdefault(key, set()).add(value)
+            else:
+                trie.remove_key(key, value)
+                keys.get(key, set()).discard(value)
+            self.check_trie(trie, keys)
+
+        for key, values in keys.items():
+            for value in values:
+                trie.remove_key(key, value)
+        self.assertEqual(trie.get_prefix(''), set())
+        self.assertEqual(cache_trie._roots['test'].children, {})
+
+    def test_terms(self):
+        from pritunl.cache.cache_trie import CacheTrie
+
+        trie = CacheTrie('test', 'org1-')
+        other = CacheTrie('test', 'org2-')
+        trie.add_key_terms('John Smith', 'user1')
+        trie.add_key_terms('Jane Smithers', 'user2')
+        other.add_key_terms('John Smith', 'user3')
+
+        self.assertEqual(trie.get_prefix('smith'), {'user1', 'user2'})
+        self.assertEqual(trie.get_prefix('JOHN S'), {'user1'})
+        self.assertEqual(trie.get_prefix('smithers'), {'user2'})
+        self.assertEqual(trie.get_top('smith', 1), ['user1'])
+        self.assertEqual(len(trie.get_prefix('smith', limit=1)), 1)
+        self.assertEqual(trie.chain(set()), {'user1', 'user2'})
+        self.assertEqual(other.get_prefix('j'), {'user3'})
+
+        trie.remove_key_terms('John Smith', 'user1')
+        self.assertEqual(trie.get_prefix('smith'), {'user2'})
+        self.assertEqual(trie.get_prefix('john'), set())
+        self.assertEqual(other.get_prefix('john'), {'user3'})
+
+        trie.clear_cache()
+        self.assertEqual(other.get_prefix('john'), set())
+
+
+class UserIndex(UnitTestCase):
+    def setUp(self):
+        from pritunl import user_index
+
+        UnitTestCase.setUp(self)
+        for org_id in user_index._indexes.keys():
+            user_index.drop_index(org_id)
+
+    def tearDown(self):
+        settings.user.search_index_limit = 100000
+
+    def get_org(self, names):
+        from pritunl import organization
+
+        org_id = bson.ObjectId()
+        self.get_collection('organizations').insert({
+            '_id': org_id,
+            'name': 'test',
+            'type': ORG_DEFAULT,
+        })
+        self.get_collection('users').insert([{
+            'org_id': str(org_id),
+            'type': CERT_CLIENT,
+            'name': name,
+        } for name in names])
+
+        return organization.Organization(doc={
+            '_id': org_id,
+            'name': 'test',
+        })
+
+    def search(self, org, query, limit=None):
+        return [x.name for x in org.iter_users(search=query,
+            search_limit=limit, fields=('name',))]
+
+    def test_search(self):
+        org = self.get_org(['alice', 'Bob', 'alicia', 'malik', 'carol'])
+
+        self.assertEqual(self.search(org, 'ali'), ['alice', 'alicia', 'malik'])
+        self.assertEqual(org.last_search_count, 3)
+        self.assertEqual(self.search(org, 'ALIC'), ['alice', 'alicia'])
+        self.assertEqual(self.search(org, 'b'), ['Bob'])
+        self.assertEqual(self.search(org, 'xyz'), [])
+        self.assertEqual(org.last_search_count, 0)
+
+        self.assertEqual(self.search(org, 'li', 2), ['alice', 'alicia'])
+        self.assertEqual(org.last_search_count, 3)
+
+    def test_search_stale(self):
+        from pritunl import user_index
+
+        org = self.get_org(['alice', 'alicia', 'malik'])
+        self.assertEqual(len(self.search(org, 'ali')), 3)
+
+        # Changes not yet received from the users channel
+        collection = self.get_collection('users')
+        collection.remove({'name': 'alicia'})
+        collection.update({'name': 'malik'}, {'$set': {'name': 'mark'}})
+
+        self.assertEqual(self.search(org, 'ali'), ['alice'])
+        self.assertEqual(org.last_search_count, 1)
+        self.assertEqual(self.search(org, 'mar'), ['mark'])
+
+        index = user_index.get_index(org.id)
+        self.assertEqual(len(index.users), 2)
+
+    def test_search_evict(self):
+        from pritunl import user_index
+
+        settings.user.search_index_limit = 5
+        org = self.get_org(['alice', 'alicia', 'malik'])
+        org2 = self.get_org(['bob', 'bobby', 'rob'])
+
+        self.assertEqual(len(self.search(org, 'ali')), 3)
+        self.assertEqual(len(self.search(org2, 'ob')), 3)
+        self.assertNotIn(org.id, user_index._indexes)
+        self.assertIn(org2.id, user_index._indexes)
+
+        # Orgs over the limit are searched in the database
+        org3 = self.get_org(['user%s' % i for i in xrange(6)])
+        self.assertEqual(self.search(org3, 'USER', 2), ['user0', 'user1'])
+        self.assertEqual(org3.last_search_count, 6)
+        self.assertNotIn(org3.id, user_index._indexes)
+
+    def test_on_msg(self):
+        from pritunl import user_index
+
+        org = self.get_org(['alice'])
+        self.assertEqual(self.search(org, 'ali'), ['alice'])
+
+        user_id = bson.ObjectId()
+        self.get_collection('users').insert({
+            '_id': user_id,
+            'org_id': org.id,
+            'type': CERT_CLIENT,
+            'name': 'alison',
+        })
+        user_index.on_msg({
+            'message': [UPDATE, org.id, [
+                [str(user_id), CERT_CLIENT, 'alison'],
+            ]],
+        })
+        self.assertEqual(self.search(org, 'ali'), ['alice', 'alison'])
+
+        # Bulk changes are sent in one message
+        messages = self.get_collection('messages')
+        user_ids = [bson.ObjectId() for _ in xrange(3)]
+        self.get_collection('users').insert([{
+            '_id': x,
+            'org_id': org.id,
+            'type': CERT_CLIENT,
+            'name': 'malik%d' % i,
+        } for i, x in enumerate(user_ids)])
+        user_index.publish_updates(org.id, [(str(x), CERT_CLIENT,
+            'malik%d' % i) for i, x in enumerate(user_ids)])
+        self.assertEqual(len(messages.inserts), 1)
+        user_index.on_msg(messages.inserts[0])
+        self.assertEqual(self.search(org, 'mal'),
+            ['malik0', 'malik1', 'malik2'])
+        self.get_collection('users').remove({'_id': {'$in': user_ids}})
+
+        self.get_collection('users').remove(user_id)
+        user_index.on_msg({
+            'message': [REMOVE, org.id, str(user_id)],
+        })
+        self.assertEqual(self.search(org, 'ali'), ['alice'])
+
+        user_index.on_msg({
+            'message': [REMOVE, org.id, None],
+        })
+        self.assertNotIn(org.id, user_index._indexes)
+
+
+class PageToken(UnitTestCase):
+    def setUp(self):
+        from pritunl import organization
+
+        UnitTestCase.setUp(self)
+        settings.user.page_count = 3
+
+        self.org = organization.Organization(doc={
+            '_id': bson.ObjectId(),
+            'name': 'test',
+        })
+        for type, name in ((CERT_SERVER, 'server1'), (CERT_CLIENT, 'dup'),
+                (CERT_CLIENT, 'bob'), (CERT_CLIENT, 'dup'),
+                (CERT_SERVER, 'server0'), (CERT_CLIENT, 'alice'),
+                (CERT_CLIENT, 'dup'), (CERT_CLIENT_POOL, 'pool')):
+            self.insert_user(type, name)
+
+    def tearDown(self):
+        settings.user.page_count = 10
+
+    def insert_user(self, type, name):
+        self.get_collection('users').insert({
+            '_id': bson.ObjectId(),
+            'org_id': self.org.id,
+            'type': type,
+            'name': name,
+        })
+
+    def get_pages(self):
+        # First page is requested by page number then continued with tokens
+        pages = []
+        page = 0
+        page_token = None
+        while True:
+            users = list(self.org.iter_users(page=page,
+                page_token=page_token, fields=('name',)))
+            page = None
+            pages.append([(x.type, x.name) for x in users])
+            page_token = self.org.next_page_token
+            if not page_token:
+                return pages
+
+    def test_page_token(self):
+        users = [(x.type, x.name, x.id) for x in self.org.iter_users()]
+        self.assertIsNone(self.org.next_page_token)
+        self.assertEqual([x[:2] for x in users], [
+            (CERT_CLIENT, 'alice'),
+            (CERT_CLIENT, 'bob'),
+            (CERT_CLIENT, 'dup'),
+            (CERT_CLIENT, 'dup'),
+            (CERT_CLIENT, 'dup'),
+            (CERT_SERVER, 'server0'),
+            (CERT_SERVER, 'server1'),
+        ])
+        self.assertEqual([x[2] for x in users[2:5]],
+            sorted(x[2] for x in users[2:5]))
+
+        pages = self.get_pages()
+        self.assertEqual([len(x) for x in pages], [3, 3, 1])
+        self.assertEqual(sum(pages, []), [x[:2] for x in users])
+
+        # Full last page returns a token for an empty page
+        self.insert_user(CERT_SERVER, 'server2')
+        self.insert_user(CERT_SERVER, 'server3')
+        pages = self.get_pages()
+        self.assertEqual([len(x) for x in pages], [3, 3, 3, 0])
+
+    def test_page_token_null_name(self):
+        self.insert_user(CERT_CLIENT, None)
+        self.insert_user(CERT_CLIENT, None)
+        settings.user.page_count = 1
+
+        names = [x[0][1] for x in self.get_pages() if x]
+        self.assertEqual(names, [None, None, 'alice', 'bob', 'dup', 'dup',
+            'dup', 'server0', 'server1'])
+
+    def test_page_token_insert(self):
+        first = list(self.org.iter_users(page=0))
+        page_token = self.org.next_page_token
+        self.assertEqual([x.name for x in first], ['alice', 'bob', 'dup'])
+
+        # Users added before the token do not shift the next page
+        self.insert_user(CERT_CLIENT, 'aaron')
+        users = list(self.org.iter_users(page_token=page_token))
+        self.assertEqual([x.name for x in users],
+            ['dup', 'dup', 'server0'])
+
+        users = list(self.org.iter_users(page=1))
+        self.assertEqual([x.name for x in users], ['dup', 'dup', 'dup'])
+
+    def test_page_token_invalid(self):
+        from pritunl import organization
+
+        for page_token in ('invalid', base64.urlsafe_b64encode('[1, 2]'),
+                base64.urlsafe_b64encode('["client", "a", "invalid"]')):
+            with self.assertRaises(PageTokenInvalid):
+                list(self.org.iter_users(page_token=page_token))
+
+        self.assertEqual(organization._decode_page_token(
+            organization._encode_page_token(CERT_CLIENT, u'\xe9',
+                '5ff8c1a2b3c4d5e6f7a8b9c0')),
+            (CERT_CLIENT, u'\xe9',
+                bson.ObjectId('5ff8c1a2b3c4d5e6f7a8b9c0')))
+
+
+class MongoObject(UnitTestCase):
+    def test_fields(self):
+        obj = TestObject()
+        self.assertFalse(obj.exists)
+        self.assertIsNone(obj.name)
+        self.assertEqual(obj.type, 'client')
+        self.assertEqual(obj.changed, set())
+
+        # Mutable defaults are copied for each object
+        obj.groups.append('a')
+        self.assertEqual(TestObject().groups, [])
+        self.assertEqual(TestObject.fields_default['groups'], [])
+
+        obj.name = 'name'
+        obj.other = 'other'
+        self.assertEqual(obj.name, 'name')
+        self.assertEqual(obj.changed, {'name', 'groups'})
+
+        # Fields are stored in the instance dict and other attributes are
+        # set without tracking
+        self.assertFalse('__setattr__' in mongo.MongoObject.__dict__)
+        self.assertEqual(obj.__dict__['name'], 'name')
+        self.assertEqual(obj.__dict__['other'], 'other')
+
+    def test_field_conflict(self):
+        def define():
+            class ConflictObject(mongo.MongoObject):
+                fields = {'name'}
+
+                @property
+                def name(self):
+                    return 'name'
+        self.assertRaises(TypeError, define)
+
+        class DefaultObject(mongo.MongoObject):
+            fields = {'type'}
+            type = 'default'
+        self.assertEqual(DefaultObject().type, 'default')
+
+    def test_update_doc(self):
+        doc = self.insert_object()
+        obj = TestObject(doc=copy.deepcopy(doc))
+
+        self.assertEqual(obj.get_update_doc()[0], {})
+
+        obj.name = 'new'
+        self.assertEqual(obj.get_update_doc()[0], {
+            '$set': {'name': 'new'},
+        })
+
+        obj = TestObject(doc=copy.deepcopy(doc))
+        obj.groups.append('b')
+        obj.data['a']['b'] = 2
+        obj.data['a']['c'] = 3
+        obj.data['d'] = 4
+        self.assertEqual(obj.get_update_doc()[0], {
+            '$push': {'groups': {'$each': ['b']}},
+            '$set': {'data.a.b': 2, 'data.a.c': 3, 'data.d': 4},
+        })
+
+        obj = TestObject(doc=copy.deepcopy(doc))
+        obj.groups.remove('a')
+        obj.data.pop('a')
+        obj.unset('name')
+        self.assertEqual(obj.get_update_doc()[0], {
+            '$set': {'groups': []},
+            '$unset': {'data.a': '', 'name': ''},
+        })
+
+    def test_snapshot(self):
+        doc = self.insert_object()
+        obj = TestObject(doc=copy.deepcopy(doc))
+        self.assertEqual(obj.snapshot, {})
+        self.assertEqual(obj.snapshot_pending, {'groups', 'data'})
+
+        # Values are copied on first use and replaced values are kept
+        obj.groups.append('b')
+        self.assertEqual(obj.snapshot, {'groups': ['a']})
+        obj.data = {'a': {'b': 1, 'c': 2}}
+        self.assertEqual(obj.snapshot['data'], {'a': {'b': 1}})
+        self.assertEqual(obj.snapshot_pending, set())
+        self.assertEqual(obj.get_update_doc()[0], {
+            '$push': {'groups': {'$each': ['b']}},
+            '$set': {'data.a.c': 2},
+        })
+
+        obj = TestObject(doc=copy.deepcopy(doc))
+        obj.data = obj.data
+        obj.data['d'] = 1
+        self.assertEqual(obj.get_update_doc()[0], {
+            '$set': {'data.d': 1},
+        })
+
+    def test_commit(self):
+        collection = self.get_collection('objects')
+
+        obj = TestObject(name='name')
+        obj.name = 'name'
+        obj.commit()
+        self.assertTrue(obj.exists)
+        self.assertEqual(collection.find_one(obj._id)['name'], 'name')
+        self.assertEqual(collection.find_one(obj._id)['type'], 'client')
+
+        obj.groups.append('a')
+        obj.data['key'] = 'value'
+        obj.commit()
+        self.assertEqual(obj.changed, set())
+        self.assertIsNone(obj.commit())
+
+        doc = collection.find_one(obj._id)
+        self.assertEqual(doc['groups'], ['a'])
+        self.assertEqual(doc['data'], {'key': 'value'})
+
+        # Values changed after a commit are compared to the committed value
+        obj.groups.append('b')
+        self.assertEqual(obj.get_update_doc()[0], {
+            '$push': {'groups': {'$each': ['b']}},
+        })
+        obj.commit('groups')
+        self.assertEqual(collection.find_one(obj._id)['groups'], ['a', 'b'])
+
+    def test_deferred(self):
+        collection = self.get_collection('objects')
+        doc = self.insert_object()
+
+        obj = TestObject(id=str(doc['_id']))
+        self.assertNotIn('private_key', obj.__dict__)
+        self.assertEqual(obj.deferred, {'private_key'})
+
+        queries = collection.queries
+        self.assertEqual(obj.private_key, 'key')
+        self.assertEqual(obj.private_key, 'key')
+        self.assertEqual(collection.queries, queries + 1)
+        self.assertEqual(obj.deferred, set())
+
+        # Deferred values must not survive a reload
+        collection.update({'_id': doc['_id']}, {'$set': {
+            'private_key': 'new_key',
+        }})
+        obj.load()
+        self.assertEqual(obj.private_key, 'new_key')
+
+        obj.private_key = 'local'
+        obj.load()
+        self.assertEqual(obj.private_key, 'new_key')
+
+        # Deferred fields are only written when changed
+        obj.name = 'name'
+        self.assertEqual(obj.get_update_doc()[0], {
+            '$set': {'name': 'name'},
+        })
+
+    def test_prefetch(self):
+        collection = self.get_collection('objects')
+        ids = [str(self.insert_object(private_key=str(i))['_id'])
+            for i in xrange(3)]
+
+        objects = TestObject.get_multi(ids).values()
+        queries = collection.queries
+        TestObject.prefetch(objects)
+        self.assertEqual(collection.queries, queries + 1)
+        self.assertEqual(sorted(x.private_key for x in objects),
+            ['0', '1', '2'])
+        self.assertEqual(collection.queries, queries + 1)
+
+        queries = collection.queries
+        objects = TestObject.get_multi(ids, prefetch=True)
+        self.assertEqual(objects[ids[1]].private_key, '1')
+        self.assertEqual(collection.queries, queries + 1)
+
+
+class IdentityMap(UnitTestCase):
+    def test_get_by_id(self):
+        collection = self.get_collection('objects')
+        doc = self.insert_object()
+        obj_id = str(doc['_id'])
+
+        obj = TestObject.get_by_id(obj_id)
+        self.assertEqual(obj.name, 'test')
+        self.assertIsNot(TestObject.get_by_id(obj_id), obj)
+        self.assertIsNone(TestObject.get_by_id(str(bson.ObjectId())))
+        self.assertIsNone(TestObject.get_by_id(None))
+        self.assertIsNone(TestObject.get_by_id(''))
+
+        # ObjectId ids are normalized to string ids
+        self.assertEqual(TestObject.get_by_id(doc['_id']).id, obj_id)
+        self.assertEqual(TestObject.get_multi([doc['_id']]).keys(),
+            [obj_id])
+
+        with mongo.IdentityMap():
+            queries = collection.queries
+            obj = TestObject.get_by_id(obj_id)
+            self.assertIs(TestObject.get_by_id(obj_id), obj)
+            self.assertEqual(collection.queries, queries + 1)
+
+            # Nested maps defer to the outer map
+            with mongo.IdentityMap():
+                self.assertIs(TestObject.get_by_id(obj_id), obj)
+            self.assertIs(TestObject.get_by_id(obj_id), obj)
+
+            obj.remove()
+            self.assertIsNone(TestObject.get_by_id(obj_id))
+
+        self.assertIsNone(mongo.get_identity_map())
+
+    def test_get_multi(self):
+        collection = self.get_collection('objects')
+        ids = [str(self.insert_object(name=str(i))['_id'])
+            for i in xrange(5)]
+        missing_id = str(bson.ObjectId())
+
+        with mongo.IdentityMap():
+            first = TestObject.get_by_id(ids[0])
+
+            queries = collection.queries
+            objects = TestObject.get_multi(ids + [missing_id])
+            self.assertEqual(collection.queries, queries + 1)
+            self.assertEqual(set(objects), set(ids))
+            self.assertIs(objects[ids[0]], first)
+            self.assertEqual(objects[ids[3]].name, '3')
+
+            queries = collection.queries
+            TestObject.get_multi(ids)
+            self.assertEqual(collection.queries, queries)
+
+
+class Counters(UnitTestCase):
+    def insert_org(self, client=0, server=0):
+        org_id = bson.ObjectId()
+        self.get_collection('organizations').insert({
+            '_id': org_id,
+            'name': 'test',
+            'type': ORG_DEFAULT,
+        })
+        self.get_collection('users').insert(
+            [{'org_id': str(org_id), 'type': CERT_CLIENT}] * client +
+            [{'org_id': str(org_id), 'type': CERT_SERVER}] * server)
+        return str(org_id)
+
+    def test_inc_user_count(self):
+        from pritunl import counters
+
+        org_id = self.insert_org()
+        counters.inc_user_count(org_id, CERT_CLIENT)
+        counters.inc_user_count(org_id, CERT_CLIENT)
+        counters.inc_user_count(org_id, CERT_SERVER)
+        counters.change_user_type(org_id, CERT_CLIENT, CERT_SERVER)
+        counters.inc_user_count(org_id, CERT_SERVER, -1)
+
+        doc = self.get_collection('counters').find_one({
+            '_id': 'users-' + org_id,
+        })
+        self.assertEqual(doc['type'], 'users')
+        self.assertEqual(doc['org_id'], org_id)
+        self.assertEqual(doc['counts'], {
+            CERT_CLIENT: 1,
+            CERT_SERVER: 1,
+        })
+        self.assertEqual(counters.get_user_count(org_id), 1)
+        self.assertEqual(counters.get_user_count(org_id,
+            type=CERT_SERVER), 1)
+
+    def test_get_user_count_missing(self):
+        from pritunl import counters
+
+        org_ids = [self.insert_org(client=2, server=1),
+            self.insert_org(client=3), self.insert_org()]
+
+        self.assertEqual(counters.get_user_count_multi(
+            org_ids=org_ids[:1]), 2)
+        self.assertEqual(len(self.get_collection('counters').docs), 1)
+
+        # Orgs without a counter must still be counted when all orgs are
+        # requested
+        self.assertEqual(counters.get_user_count_multi(), 5)
+        self.assertEqual(counters.get_user_count_multi(
+            type=CERT_SERVER), 1)
+        self.assertEqual(len(self.get_collection('counters').docs), 3)
+
+        counters.inc_user_count(org_ids[2], CERT_CLIENT)
+        self.assertEqual(counters.get_user_count_multi(), 6)
+
+    def test_reconcile_user_count(self):
+        from pritunl import counters
+
+        org_id = self.insert_org(client=2)
+        counters.inc_user_count(org_id, CERT_CLIENT, 5)
+        self.get_collection('counters').insert({
+            '_id': 'users-removed',
+            'type': 'users',
+            'org_id': 'removed',
+            'counts': {CERT_CLIENT: 1},
+        })
+
+        self.assertEqual(counters.get_user_count_multi(), 5)
+        counters.reconcile_user_count()
+        self.assertEqual(counters.get_user_count_multi(), 2)
+        self.assertEqual([x['_id'] for x in
+            self.get_collection('counters').docs], ['users-' + org_id])
+
+    def test_reconcile_user_count_race(self):
+        from pritunl import counters
+
+        org_ids = [self.insert_org(client=2), self.insert_org(client=1)]
+        counters.reconcile_user_count()
+        users = self.get_collection('users')
+
+        # Users created while the users are counted must not be lost
+        def aggregate(pipeline):
+            response = Collection.aggregate(users, pipeline)
+            if len(users.docs) < 5:
+                users.insert({'org_id': org_ids[0], 'type': CERT_CLIENT})
+                counters.inc_user_count(org_ids[0], CERT_CLIENT)
+            return response
+
+        users.aggregate = aggregate
+        try:
+            counters.reconcile_user_count()
+        finally:
+            del users.aggregate
+        self.assertEqual(counters.get_user_count(org_ids[0]), 4)
+        self.assertEqual(counters.get_user_count(org_ids[1]), 1)
+
+        # Counters of orgs created during the reconcile are kept
+        new_org_id = str(bson.ObjectId())
+        def aggregate(pipeline):
+            response = Collection.aggregate(users, pipeline)
+            if not self.get_collection('organizations').find_one({
+                        '_id': bson.ObjectId(new_org_id)}):
+                self.get_collection('organizations').insert({
+                    '_id': bson.ObjectId(new_org_id),
+                    'name': 'new',
+                    'type': ORG_DEFAULT,
+                })
+                users.insert({'org_id': new_org_id, 'type': CERT_CLIENT})
+                counters.inc_user_count(new_org_id, CERT_CLIENT)
+            return response
+
+        users.aggregate = aggregate
+        try:
+            counters.reconcile_user_count()
+        finally:
+            del users.aggregate
+        self.assertEqual(counters.get_user_count(new_org_id), 1)
+        self.assertEqual(counters.get_user_count_multi(), 6)
+
+    def test_user_remove(self):
+        from pritunl import counters
+        from pritunl import organization
+        from pritunl import user
+
+        org_id = self.insert_org(client=2)
+        self.assertEqual(counters.get_user_count(org_id), 2)
+        org = organization.get_org(org_id)
+        usr = user.User(org=org, doc=self.get_collection('users').find_one(
+            {'org_id': org_id}))
+
+        usr.remove()
+        usr.remove()
+        self.assertEqual(counters.get_user_count(org_id), 1)
+
+
+class BulkUsers(UnitTestCase):
+    def setUp(self):
+        UnitTestCase.setUp(self)
+        settings.user.bulk_batch_size = 2
+
+    def tearDown(self):
+        settings.user.bulk_batch_size = 500
+
+    def get_org(self, pooled=0):
+        from pritunl import organization
+
+        org_id = bson.ObjectId()
+        self.get_collection('organizations').insert({
+            '_id': org_id,
+            'name': 'test',
+            'type': ORG_DEFAULT,
+        })
+        self.get_collection('users').insert([{
+            'org_id': str(org_id),
+            'type': CERT_CLIENT_POOL,
+        } for _ in xrange(pooled)])
+
+        return organization.Organization(doc={
+            '_id': org_id,
+            'name': 'test',
+            'type': ORG_DEFAULT,
+        })
+
+    def get_users(self, org_id):
+        return sorted((x['type'], x.get('name'), 'bulk_id' in x)
+            for x in self.get_collection('users').docs
+            if x['org_id'] == org_id)
+
+    def test_reserve_pooled_users(self):
+        from pritunl import user
+        from pritunl import counters
+
+        org = self.get_org(pooled=3)
+        users_data = [{'name': 'user%d' % i} for i in xrange(5)]
+
+        batches = [[x.name for x in users] for users in
+            user.reserve_pooled_users(org, users_data)]
+        self.assertEqual(batches, [['user0', 'user1'], ['user2']])
+        self.assertEqual(self.get_users(org.id), [
+            (CERT_CLIENT, 'user0', False),
+            (CERT_CLIENT, 'user1', False),
+            (CERT_CLIENT, 'user2', False),
+        ])
+        self.assertEqual(counters.get_user_count(org.id), 3)
+        self.assertEqual(counters.get_user_count(org.id,
+            type=CERT_CLIENT_POOL), 0)
+
+    def test_reserve_pooled_users_error(self):
+        from pritunl import user
+        from pritunl import counters
+
+        org = self.get_org(pooled=4)
+        users_data = [{'name': 'user%d' % i} for i in xrange(4)]
+        self.assertEqual(counters.get_user_count(org.id,
+            type=CERT_CLIENT_POOL), 4)
+
+        collection = self.get_collection('users')
+        collection.fail_bulk = pymongo.errors.OperationFailure('test')
+        has_bulk = mongo.has_bulk
+        mongo.has_bulk = True
+        try:
+            with self.assertRaises(pymongo.errors.OperationFailure):
+                list(user.reserve_pooled_users(org, users_data))
+        finally:
+            mongo.has_bulk = has_bulk
+
+        # The user updated before the error keeps its name, the rest of the
+        # batch is returned to the pool
+        self.assertEqual(self.get_users(org.id), [
+            (CERT_CLIENT, 'user0', False),
+            (CERT_CLIENT_POOL, None, False),
+            (CERT_CLIENT_POOL, None, False),
+            (CERT_CLIENT_POOL, None, False),
+        ])
+        self.assertEqual(counters.get_user_count(org.id), 1)
+        self.assertEqual(counters.get_user_count(org.id,
+            type=CERT_CLIENT_POOL), 3)
+
+    def test_start_multi(self):
+        from pritunl import messenger
+        from pritunl import queue
+        from pritunl.queues import init_user
+        from pritunl.runners import queue as queue_runner
+
+        org = self.get_org()
+        messages = self.get_collection('messages')
+        items = [{
+            'org_doc': org.export(),
+            'user_doc': {'name': 'user%d' % i},
+            'priority': HIGH,
+        } for i in xrange(3)]
+
+        with messenger.PublishBuffer():
+            messenger.publish('test', 'buffered')
+            ques = queue.start_multi('init_user', items)
+
+            # One pending message with the queue ids is sent without
+            # waiting for the request buffer
+            self.assertEqual([x['message'] for x in messages.inserts],
+                [[PENDING, [x.id for x in ques]]])
+            self.assertNotIn('queue_doc', messages.inserts[0])
+
+        self.assertEqual(messages.inserts[-1]['message'], 'buffered')
+        self.assertEqual(len(self.get_collection('queue').docs), 3)
+
+        collection = self.get_collection('queue')
+        try:
+            queries = collection.queries
+            queue_runner._on_msg(messages.inserts[0])
+            self.assertEqual(collection.queries, queries + 1)
+
+            # Queue items that are already running are not loaded again
+            queue_runner._on_msg(messages.inserts[0])
+            self.assertEqual(collection.queries, queries + 1)
+
+            self.assertEqual(set(queue_runner.running_queues),
+                {x.id for x in ques})
+            que = queue_runner.running_queues[ques[1].id]
+            self.assertIsInstance(que, init_user.QueueInitUser)
+            self.assertEqual(que.user_doc, {'name': 'user1'})
+            self.assertEqual(que.priority, HIGH)
+        finally:
+            queue_runner.running_queues.clear()
+            for runner_queue in queue_runner.runner_queues:
+                while not runner_queue.empty():
+                    runner_queue.get()
+
+    def test_new_users_event(self):
+        from pritunl import user
+        from pritunl.handlers import user as user_handler
+
+        org = self.get_org(pooled=1)
+        users = list(user.reserve_pooled_users(org, [{'name': 'user0'}]))[0]
+        users += [user.User(org=org, type=CERT_CLIENT, name='user%d' % i)
+            for i in xrange(1, 3)]
+
+        users = [user_handler._new_user_dict(x) for x in users]
+        self.assertEqual([(x['name'], x['pending']) for x in users], [
+            ('user0', False),
+            ('user1', True),
+            ('user2', True),
+        ])
+
+        # Events are only sent for committed users
+        window = settings.app.event_coalesce_window
+        settings.app.event_coalesce_window = 0
+        try:
+            messages = self.get_collection('messages')
+            messages.inserts = []
+            user_handler._new_users_event(org, users)
+            events = [x['message'] for x in messages.inserts
+                if x['channel'] == 'events']
+            self.assertIn((USERS_UPDATED, org.id), events)
+            self.assertEqual(sorted(x['message'] for x in
+                self.get_collection('log_entries').docs), [
+                'Created 1 new users.',
+                'Queued 2 new users.',
+            ])
+
+            messages.inserts = []
+            self.get_collection('log_entries').reset()
+            user_handler._new_users_event(org, users[1:])
+            self.assertNotIn((USERS_UPDATED, org.id), [x['message']
+                for x in messages.inserts if x['channel'] == 'events'])
+        finally:
+            settings.app.event_coalesce_window = window
+
+
+class ServerRunner(UnitTestCase):
+    def test_on_resync(self):
+        from pritunl import server
+        from pritunl.runners import server as server_runner
+
+        class FakeServer(object):
+            hosts = ['other', 'local']
+            runs = 0
+
+            def run(self, send_events=False):
+                self.runs += 1
+
+        class FakeTime(object):
+            cur_time = 0
+            sleeps = 0
+
+            def time(self):
+                return self.cur_time
+
+            def sleep(self, seconds):
+                self.sleeps += 1
+
+        svr = FakeServer()
+        fake_time = FakeTime()
+        self.get_collection('servers').insert({
+            'status': True,
+            'hosts': ['other', 'local'],
+            'replica_count': 1,
+        })
+
+        host_id = getattr(settings.local, 'host_id', None)
+        get_server = server.get_server
+        settings.local.host_id = 'local'
+        server.get_server = lambda x: svr
+        server_runner.time = fake_time
+        try:
+            # Hosts that are not the preferred host wait before running
+            # so every host does not start the server at once
+            for cur_time in xrange(8):
+                fake_time.cur_time = cur_time
+                server_runner._on_resync({})
+        finally:
+            if host_id is None:
+                del settings.local.host_id
+            else:
+                settings.local.host_id = host_id
+            server.get_server = get_server
+            server_runner.time = time
+
+        self.assertEqual(svr.runs, 8)
+        self.assertTrue(0 < fake_time.sleeps < 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import os
+import sys
+import json
+import time
+import random
+import resource
+import subprocess
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pritunl.cache.cache_trie import CacheTrie
+
+SYLLABLES = ['an', 'ba', 'ce', 'da', 'el', 'fi', 'go', 'ha', 'in', 'jo',
+    'ka', 'li', 'ma', 'ne', 'or', 'pa', 'qu', 'ri', 'sa', 'te', 'ul', 'vi',
+    'wa', 'xe', 'yo', 'za']
+
+def get_max_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def gen_name(rand):
+    first = ''.join([rand.choice(SYLLABLES)
+        for _ in xrange(rand.randint(2, 4))])
+    last = ''.join([rand.choice(SYLLABLES)
+        for _ in xrange(rand.randint(2, 4))])
+    return '%s.%s%d' % (first, last, rand.randint(0, 99))
+
+def time_queries(func, prefixes):
+    start = time.time()
+    results = 0
+    for prefix in prefixes:
+        results += len(func(prefix))
+    elapsed = time.time() - start
+    return {
+        'ms_per_query': elapsed * 1000 / len(prefixes),
+        'results_per_query': float(results) / len(prefixes),
+    }
+
+def child_run(options):
+    rand = random.Random(options.seed)
+    names = [gen_name(rand) for _ in xrange(options.names)]
+    trie = CacheTrie('bench')
+    base_rss = get_max_rss()
+
+    start = time.time()
+    for i, name in enumerate(names):
+        trie.add_key_terms(name, 'user_%s' % i)
+    build_elapsed = time.time() - start
+    peak_rss = get_max_rss()
+
+    results = {
+        'names': options.names,
+        'build_seconds': build_elapsed,
+        'bytes_per_name': (peak_rss - base_rss) * 1024.0 / options.names,
+        'queries': {},
+    }
+
+    for length in (1, 2, 4):
+        prefixes = [rand.choice(names)[:length]
+            for _ in xrange(options.queries)]
+        results['queries'][length] = {
+            'get_prefix': time_queries(trie.get_prefix, prefixes),
+            'get_prefix_limit': time_queries(
+                lambda x: trie.get_prefix(x, options.limit), prefixes),
+            'get_top': time_queries(
+                lambda x: trie.get_top(x, options.limit), prefixes),
+        }
+
+    start = time.time()
+    for i, name in enumerate(names):
+        trie.remove_key_terms(name, 'user_%s' % i)
+    results['remove_seconds'] = time.time() - start
+
+    return results
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--names-list', type='string',
+        default='100000,1000000', help='Comma separated name counts')
+    parser.add_option('--queries', type='int', default=50,
+        help='Queries per prefix length')
+    parser.add_option('--limit', type='int', default=50,
+        help='Result limit for limited and top queries')
+    parser.add_option('--seed', type='int', default=1,
+        help='Random seed for generated names')
+    parser.add_option('--output', type='string',
+        help='Write JSON results to file')
+    parser.add_option('--child', action='store_true',
+        help=optparse.SUPPRESS_HELP)
+    parser.add_option('--names', type='int', help=optparse.SUPPRESS_HELP)
+    (options, args) = parser.parse_args()
+
+    if options.child:
+        print json.dumps(child_run(options))
+        return
+
+    results = {
+        'timestamp': time.time(),
+        'runs': [],
+    }
+    for count in options.names_list.split(','):
+        print 'Cache trie %s names...' % count
+        output = subprocess.check_output([sys.executable,
+            os.path.abspath(__file__), '--child', '--names', count,
+            '--queries', str(options.queries), '--limit', str(options.limit),
+            '--seed', str(options.seed)])
+        results['runs'].append(json.loads(output.splitlines()[-1]))
+
+    output = json.dumps(results, indent=4, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            output_file.write(output)
+    print output
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,356 @@
+import os
+import sys
+import json
+import time
+import datetime
+import threading
+import collections
+import subprocess
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pritunl.constants import *
+from pritunl import settings
+from pritunl.settings.settings import module_classes
+from pritunl import mongo
+from pritunl import messenger
+
+import pymongo
+import bson
+
+class LocalCursor(object):
+    # Supports the subset of cursor features used by messenger, tailable
+    # cursors die when the position is overwritten like a capped collection
+    def __init__(self, collection, spec, tailable):
+        self.collection = collection
+        self.spec = spec
+        self.tailable = tailable
+        self.alive = True
+        self._descending = False
+        self._limit = None
+        self._pos = None
+
+    def sort(self, key, direction=pymongo.ASCENDING):
+        self._descending = direction == pymongo.DESCENDING
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def _match(self, doc):
+        for key, val in self.spec.items():
+            if key == '_id':
+                if doc['_id'] <= val['$gt']:
+                    return False
+            elif isinstance(val, dict):
+                if doc.get(key) not in val['$in']:
+                    return False
+            elif doc.get(key) != val:
+                return False
+        return True
+
+    def __getitem__(self, index):
+        return list(self)[index]
+
+    def __iter__(self):
+        if self.tailable:
+            return self._tail()
+
+        with self.collection.cond:
+            docs = [x.copy() for x in self.collection.docs if self._match(x)]
+        if self._descending:
+            docs.reverse()
+        if self._limit:
+            docs = docs[:self._limit]
+        self.alive = False
+        return iter(docs)
+
+    def _tail(self):
+        coll = self.collection
+
+        with coll.cond:
+            first = coll.total - len(coll.docs)
+
+            if self._pos is None:
+                if not coll.docs:
+                    self.alive = False
+                    return
+                self._pos = coll.total
+                for i, doc in enumerate(coll.docs):
+                    if self._match(doc):
+                        self._pos = first + i
+                        break
+
+            if self._pos < first:
+                self.alive = False
+                return
+
+            if self._pos == coll.total:
+                coll.cond.wait(1)
+                first = coll.total - len(coll.docs)
+                if self._pos < first:
+                    self.alive = False
+                    return
+
+            docs = [x.copy() for x in list(coll.docs)[self._pos - first:]
+                if self._match(x)]
+            self._pos = coll.total
+
+        for doc in docs:
+            yield doc
+
+class LocalCapped(object):
+    # In process stand-in for a capped collection
+    def __init__(self, max_docs):
+        self.name_str = 'messages'
+        self.docs = collections.deque(maxlen=max_docs)
+        self.total = 0
+        self.cond = threading.Condition()
+
+    def insert(self, docs, manipulate=True):
+        if isinstance(docs, dict):
+            docs = [docs]
+
+        with self.cond:
+            for doc in docs:
+                doc = doc.copy()
+                doc['_id'] = bson.ObjectId()
+                self.docs.append(doc)
+                self.total += 1
+            self.cond.notify_all()
+
+    def find(self, spec=None, fields=None, tailable=False, await_data=False):
+        return LocalCursor(self, spec or {}, tailable)
+
+def setup(options):
+    for cls in module_classes:
+        if cls.type == GROUP_MONGO:
+            setattr(settings, cls.group, cls())
+    settings.local.mongo_time = datetime.datetime.utcnow()
+    settings.local.mongo_time_start = datetime.datetime.utcnow()
+
+    if options.mongodb_url:
+        client = pymongo.MongoClient(options.mongodb_url)
+        database = client.get_default_database()
+        database.drop_collection('bench_messages')
+        database.create_collection('bench_messages', capped=True,
+            size=options.size, max=options.max)
+        collection = database.bench_messages
+        collection.name_str = 'messages'
+    else:
+        collection = LocalCapped(options.max)
+
+    mongo.collections['messages'] = collection
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    count = len(values)
+    return {
+        'count': count,
+        'mean': sum(values) / count,
+        'p50': values[int(count * 0.5)],
+        'p90': values[int(count * 0.9)],
+        'p99': values[min(count - 1, int(count * 0.99))],
+        'max': values[-1],
+    }
+
+def publish_paced(channel, count, rate):
+    interval = 1. / rate if rate else 0
+    start = time.time()
+    for i in xrange(count):
+        if interval:
+            delay = start + i * interval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        messenger.publish(channel, i, extra={
+            'bench_time': time.time(),
+        })
+
+def bench_publish(options):
+    results = {}
+
+    # Publish buffers are not available on older revisions
+    modes = [('single', False)]
+    if hasattr(messenger, 'PublishBuffer'):
+        modes.append(('buffered', True))
+
+    for name, buffered in modes:
+        start = time.time()
+        if buffered:
+            with messenger.PublishBuffer() as publish_buffer:
+                for i in xrange(options.messages):
+                    messenger.publish('bench', i)
+                    if i % 100 == 99:
+                        publish_buffer.flush()
+        else:
+            for i in xrange(options.messages):
+                messenger.publish('bench', i)
+        elapsed = time.time() - start
+
+        results[name] = {
+            'messages': options.messages,
+            'seconds': elapsed,
+            'rate': options.messages / elapsed,
+        }
+
+    return results
+
+def bench_latency(options, yield_delay=None):
+    messenger.publish('bench', None)
+    latencies = []
+    batches = []
+    ready = threading.Event()
+
+    def subscriber():
+        cursor_id = messenger.get_cursor_id('bench')
+        ready.set()
+        received = 0
+        while received < options.messages:
+            batch = []
+            for msg in messenger.subscribe('bench', cursor_id=cursor_id,
+                    timeout=options.timeout, yield_delay=yield_delay):
+                cursor_id = msg['_id']
+                batch.append(msg['bench_time'])
+                if not yield_delay:
+                    latencies.append(time.time() - msg['bench_time'])
+                    if received + len(batch) >= options.messages:
+                        break
+            if not batch:
+                break
+            if yield_delay:
+                recv_time = time.time()
+                latencies.extend([recv_time - x for x in batch])
+            batches.append(len(batch))
+            received += len(batch)
+
+    thread = threading.Thread(target=subscriber)
+    thread.daemon = True
+    thread.start()
+    ready.wait()
+    time.sleep(0.2)
+
+    publish_paced('bench', options.messages, options.rate)
+    thread.join(options.timeout)
+
+    result = {
+        'yield_delay': yield_delay,
+        'latency': percentiles(latencies),
+        'lost': options.messages - len(latencies),
+    }
+    if yield_delay:
+        result['batch'] = percentiles([float(x) for x in batches])
+    return result
+
+def bench_fan_out(options, subscribers):
+    messenger.publish('bench', None)
+    latencies = []
+    latencies_lock = threading.Lock()
+    cursor_id = messenger.get_cursor_id('bench')
+    threads = []
+
+    def subscriber():
+        received = []
+        for msg in messenger.subscribe('bench', cursor_id=cursor_id,
+                timeout=options.timeout):
+            received.append(time.time() - msg['bench_time'])
+            if len(received) >= options.fan_out_messages:
+                break
+        with latencies_lock:
+            latencies.extend(received)
+
+    for _ in xrange(subscribers):
+        thread = threading.Thread(target=subscriber)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    time.sleep(0.2)
+
+    start = time.time()
+    publish_paced('bench', options.fan_out_messages, options.rate)
+    for thread in threads:
+        thread.join(options.timeout)
+    elapsed = time.time() - start
+
+    expected = subscribers * options.fan_out_messages
+    return {
+        'subscribers': subscribers,
+        'messages': options.fan_out_messages,
+        'seconds': elapsed,
+        'deliveries_per_second': len(latencies) / elapsed,
+        'latency': percentiles(latencies),
+        'lost': expected - len(latencies),
+    }
+
+def get_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.PIPE).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--mongodb-url', type='string',
+        help='Run against mongodb instead of the in process stand-in')
+    parser.add_option('--messages', type='int', default=5000,
+        help='Messages for publish and latency benchmarks')
+    parser.add_option('--fan-out-messages', type='int', default=200,
+        help='Messages for fan out benchmarks')
+    parser.add_option('--fan-out', type='string', default='1,10,100,500',
+        help='Comma separated subscriber counts')
+    parser.add_option('--yield-delay', type='string', default='0.02,0.1',
+        help='Comma separated yield delays')
+    parser.add_option('--rate', type='int', default=2000,
+        help='Publish rate for latency benchmarks, 0 for unlimited')
+    parser.add_option('--size', type='int', default=MONGO_MESSAGES_SIZE,
+        help='Capped collection size')
+    parser.add_option('--max', type='int', default=MONGO_MESSAGES_MAX,
+        help='Capped collection max docs')
+    parser.add_option('--timeout', type='int', default=30,
+        help='Subscriber timeout')
+    parser.add_option('--output', type='string',
+        help='Write JSON results to file')
+    (options, args) = parser.parse_args()
+
+    setup(options)
+
+    results = {
+        'revision': get_revision(),
+        'timestamp': time.time(),
+        'backend': 'mongodb' if options.mongodb_url else 'local',
+        'options': options.__dict__,
+    }
+
+    print 'Publish...'
+    results['publish'] = bench_publish(options)
+
+    print 'Latency...'
+    results['latency'] = bench_latency(options)
+
+    results['yield_delay'] = []
+    for yield_delay in options.yield_delay.split(','):
+        print 'Yield delay %s...' % yield_delay
+        results['yield_delay'].append(
+            bench_latency(options, yield_delay=float(yield_delay)))
+
+    results['fan_out'] = []
+    for subscribers in options.fan_out.split(','):
+        print 'Fan out %s...' % subscribers
+        results['fan_out'].append(bench_fan_out(options, int(subscribers)))
+
+    if hasattr(messenger, 'get_stats'):
+        results['messenger'] = messenger.get_stats()
+
+    output = json.dumps(results, indent=4, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            output_file.write(output)
+    print output
+
+if __name__ == '__main__':
+    main()
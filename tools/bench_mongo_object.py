@@ -0,0 +1,110 @@
+import os
+import sys
+import json
+import time
+import timeit
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pritunl import mongo
+
+import bson
+
+class BenchUser(mongo.MongoObject):
+    fields = {
+        'org_id',
+        'name',
+        'email',
+        'otp_secret',
+        'type',
+        'disabled',
+        'private_key',
+        'certificate',
+        'groups',
+    }
+    fields_default = {
+        'name': 'undefined',
+        'disabled': False,
+        'type': 'client',
+        'groups': [],
+    }
+    fields_deferred = frozenset((
+        'private_key',
+        'certificate',
+    ))
+
+def get_doc():
+    return {
+        '_id': bson.ObjectId(),
+        'org_id': str(bson.ObjectId()),
+        'name': 'user',
+        'email': 'user@example.com',
+        'otp_secret': 'OTPSECRET',
+        'type': 'client',
+        'private_key': 'K' * 1700,
+        'certificate': 'C' * 4500,
+    }
+
+def get_bson(deferred=False):
+    doc = get_doc()
+    if deferred:
+        for field in BenchUser.fields_deferred:
+            doc.pop(field, None)
+    return bson.BSON.encode(doc)
+
+def bench(stmt, setup, number):
+    timer = timeit.Timer(stmt, setup)
+    return min(timer.repeat(3, number)) / number * 1000000
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--number', type='int', default=200000,
+        help='Iterations per measurement')
+    parser.add_option('--output', type='string',
+        help='Write JSON results to file')
+    (options, args) = parser.parse_args()
+
+    setup = 'from __main__ import BenchUser, get_doc, get_bson; ' + \
+        'usr = BenchUser(doc=get_doc()); doc = get_doc(); ' + \
+        'full_bson = get_bson(); deferred_bson = get_bson(True)'
+    cases = (
+        ('construct_doc', 'BenchUser(doc=dict(doc))'),
+        ('construct_new', 'BenchUser()'),
+        ('get_field', 'usr.name'),
+        ('get_default', 'usr.disabled'),
+        ('get_list_default', 'BenchUser(doc=dict(doc)).groups'),
+        ('set_field', 'usr.name = "name"'),
+        ('set_attribute', 'usr.other = "other"'),
+        ('commit_doc', 'usr.get_commit_doc()'),
+        ('update_doc', 'usr.name = "name"; usr.get_update_doc()'),
+        ('decode_full', 'BenchUser(doc=full_bson.decode())'),
+        ('decode_deferred', 'BenchUser(doc=deferred_bson.decode())'),
+    )
+
+    results = {
+        'timestamp': time.time(),
+        'usec': {},
+    }
+    for name, stmt in cases:
+        print 'Bench %s...' % name
+        results['usec'][name] = bench(stmt, setup, options.number)
+
+    usr = BenchUser(doc=get_doc())
+    usr.name = 'name'
+    update_doc = usr.get_update_doc()[0]
+    results['rename_update_bytes'] = len(bson.BSON.encode(update_doc))
+    results['full_doc_bytes'] = len(get_bson())
+    results['deferred_doc_bytes'] = len(get_bson(True))
+    results['full_update_bytes'] = len(bson.BSON.encode({
+        '$set': usr.get_commit_doc(usr.fields),
+    }))
+
+    output = json.dumps(results, indent=4, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            output_file.write(output)
+    print output
+
+if __name__ == '__main__':
+    main()
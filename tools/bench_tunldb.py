@@ -0,0 +1,366 @@
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import resource
+import tempfile
+import subprocess
+import collections
+import optparse
+import random
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pritunl.cache.tunldb import TunlDB, TunlDBEntry, TunlDBMissed
+
+def get_max_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def fill_db(db, count):
+    value = uuid.uuid4().hex * 2
+    ttl = int(time.time() * 1000) + 86400000
+
+    for i in xrange(count):
+        key = 'key_%s' % i
+        kind = i % 10
+
+        if kind == 7:
+            db._entry(key).val = set(['%s_%s' % (value[:16], x)
+                for x in xrange(8)])
+        elif kind == 8:
+            db.list_rpush(key, value)
+            for _ in xrange(7):
+                db.list_rpush(key, value)
+        elif kind == 9:
+            db._entry(key).val = {'field_%s' % x: value
+                for x in xrange(8)}
+        else:
+            db._entry(key).val = value
+
+        if i % 20 == 0:
+            db._entry(key).ttl = ttl
+
+def child_generate(options):
+    db = TunlDB()
+    fill_db(db, options.keys)
+
+    results = {}
+    for name, binary in (('json', False), ('binary', True)):
+        db._path = os.path.join(options.path, name)
+        db._binary = binary
+
+        start = time.time()
+        db.export_data()
+        results[name] = {
+            'export_seconds': time.time() - start,
+            'bytes': os.path.getsize(db._path),
+        }
+
+    return results
+
+def child_load(options):
+    base_rss = get_max_rss()
+    db = TunlDB()
+    db._path = os.path.join(options.path, options.format)
+
+    start = time.time()
+    db._loading = True
+    db._load_snapshot()
+    elapsed = time.time() - start
+
+    return {
+        'keys': len(db._data),
+        'load_seconds': elapsed,
+        'base_rss_kb': base_rss,
+        'peak_rss_kb': get_max_rss(),
+    }
+
+def memory_value(kind, i):
+    value = 'value_%032d' % i
+
+    if kind == 'str':
+        return value
+    elif kind == 'set':
+        return set(['%s_%s' % (value, x) for x in xrange(4)])
+    elif kind == 'deque':
+        return collections.deque([value] * 4)
+    elif kind == 'dict':
+        return {'field_%s' % x: value for x in xrange(4)}
+
+def child_memory(options):
+    # Values are built before measuring so only the per key structures
+    # are compared between layouts
+    values = [memory_value(options.kind, i) for i in xrange(options.keys)]
+    keys = ['key_%s' % i for i in xrange(options.keys)]
+    base_rss = get_max_rss()
+
+    if options.layout == 'dict':
+        # Previous representation of a key in TunlDB
+        data = collections.defaultdict(lambda: {'ttl': None, 'val': None})
+        for key, value in zip(keys, values):
+            data[key]['val'] = value
+    else:
+        data = {}
+        for key, value in zip(keys, values):
+            data[key] = TunlDBEntry(value)
+
+    peak_rss = get_max_rss()
+
+    return {
+        'keys': len(data),
+        'bytes_per_key': (peak_rss - base_rss) * 1024.0 / options.keys,
+    }
+
+def run_child(*args):
+    output = subprocess.check_output([sys.executable,
+        os.path.abspath(__file__), '--child'] + list(args))
+    return json.loads(output.splitlines()[-1])
+
+def bench_snapshot(options):
+    results = []
+
+    for count in options.keys_list.split(','):
+        count = int(count)
+        path = tempfile.mkdtemp(prefix='bench_tunldb_')
+        try:
+            print 'Snapshot %s keys...' % count
+            result = {
+                'keys': count,
+                'export': run_child('generate', '--keys', str(count),
+                    '--path', path),
+            }
+            for name in ('json', 'binary'):
+                result[name] = run_child('load', '--format', name,
+                    '--path', path)
+            results.append(result)
+        finally:
+            shutil.rmtree(path)
+
+    return results
+
+def stress_worker(db, options, increments, errors):
+    try:
+        for i in xrange(options.ops):
+            key = 'key_%s' % random.randrange(options.stress_keys)
+            kind = i % 8
+
+            if kind == 0:
+                db.increment('counter_%s' % (i % 16))
+                increments[0] += 1
+            elif kind == 1:
+                db.set_add(key + '_set', str(random.randrange(64)))
+            elif kind == 2:
+                db.set_remove(key + '_set', str(random.randrange(64)))
+            elif kind == 3:
+                db.list_rpush(key + '_list', str(i))
+            elif kind == 4:
+                db.list_lpop(key + '_list')
+            elif kind == 5:
+                db.dict_set(key + '_dict', str(random.randrange(16)), str(i))
+            elif kind == 6:
+                for _ in db.set_iter(key + '_set'):
+                    pass
+            else:
+                for _ in db.dict_iter(key + '_dict'):
+                    pass
+    except:
+        errors.append(repr(sys.exc_info()[1]))
+
+def bench_stress(options):
+    # Concurrent mutations and iteration with exports running in the
+    # background, the export is then reloaded and compared. Thread switches
+    # are forced more often to expose races.
+    results = []
+    check_interval = sys.getcheckinterval()
+    sys.setcheckinterval(10)
+
+    for thread_count in options.threads_list.split(','):
+        thread_count = int(thread_count)
+        path = tempfile.mkdtemp(prefix='bench_tunldb_')
+        try:
+            print 'Stress %s threads...' % thread_count
+            db = TunlDB()
+            db._path = os.path.join(path, 'stress')
+            increments = [[0] for _ in xrange(thread_count)]
+            errors = []
+            running = [True]
+            exports = [0]
+
+            def exporter():
+                while running[0]:
+                    try:
+                        db.export_data()
+                    except:
+                        errors.append(repr(sys.exc_info()[1]))
+                    exports[0] += 1
+
+            export_thread = threading.Thread(target=exporter)
+            export_thread.start()
+
+            threads = [threading.Thread(target=stress_worker,
+                args=(db, options, increments[x], errors))
+                for x in xrange(thread_count)]
+            start = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.time() - start
+
+            running[0] = False
+            export_thread.join()
+
+            counters = sum([int(db.get('counter_%s' % x) or 0)
+                for x in xrange(16)])
+
+            db.export_data()
+            loaded_db = TunlDB()
+            loaded_db._path = db._path
+            loaded_db.import_data()
+            export_match = sorted(db.keys()) == sorted(loaded_db.keys()) \
+                and all([db.get(x) == loaded_db.get(x) for x in db.keys()])
+
+            ops = thread_count * options.ops
+            results.append({
+                'threads': thread_count,
+                'ops': ops,
+                'seconds': elapsed,
+                'ops_per_second': ops / elapsed,
+                'exports': exports[0],
+                'errors': errors[:10],
+                'counters_match': counters == sum(
+                    [x[0] for x in increments]),
+                'export_match': export_match,
+            })
+        finally:
+            shutil.rmtree(path)
+
+    sys.setcheckinterval(check_interval)
+    return results
+
+def bench_pubsub(options):
+    results = []
+
+    for sub_count in options.subscribers_list.split(','):
+        sub_count = int(sub_count)
+        print 'Pub/sub %s subscribers...' % sub_count
+        db = TunlDB()
+        received = [[0, 0] for _ in xrange(sub_count)]
+
+        def subscriber(counts):
+            for msg in db.subscribe('bench', timeout=1, missed=True):
+                if isinstance(msg, TunlDBMissed):
+                    counts[1] += msg.count
+                    continue
+                counts[0] += 1
+                if msg == options.pubsub_messages - 1:
+                    break
+
+        threads = [threading.Thread(target=subscriber, args=(x,))
+            for x in received]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2)
+
+        start = time.time()
+        for i in xrange(options.pubsub_messages):
+            db.publish('bench', i)
+            if i % 64 == 63:
+                time.sleep(0.001)
+        publish_elapsed = time.time() - start
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+        delivered = sum([x[0] for x in received])
+        results.append({
+            'subscribers': sub_count,
+            'messages': options.pubsub_messages,
+            'publish_seconds': publish_elapsed,
+            'seconds': elapsed,
+            'deliveries_per_second': delivered / elapsed,
+            'delivered': delivered,
+            'missed': sum([x[1] for x in received]),
+        })
+
+    return results
+
+def bench_memory(options):
+    results = []
+
+    for count in options.keys_list.split(','):
+        count = int(count)
+        for kind in ('str', 'set', 'deque', 'dict'):
+            print 'Memory %s %s keys...' % (kind, count)
+            result = {
+                'keys': count,
+                'kind': kind,
+            }
+            for layout in ('dict', 'entry'):
+                result[layout] = run_child('memory', '--keys', str(count),
+                    '--kind', kind, '--layout', layout)['bytes_per_key']
+            result['saved_bytes_per_key'] = result['dict'] - result['entry']
+            results.append(result)
+
+    return results
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--bench', type='string', default='snapshot',
+        help='Comma separated benchmarks to run')
+    parser.add_option('--keys-list', type='string',
+        default='10000,100000,1000000',
+        help='Comma separated key counts')
+    parser.add_option('--threads-list', type='string', default='1,4,16',
+        help='Comma separated thread counts for stress benchmark')
+    parser.add_option('--ops', type='int', default=20000,
+        help='Operations per thread for stress benchmark')
+    parser.add_option('--stress-keys', type='int', default=1000,
+        help='Key count for stress benchmark')
+    parser.add_option('--subscribers-list', type='string',
+        default='1,10,100', help='Comma separated subscriber counts')
+    parser.add_option('--pubsub-messages', type='int', default=20000,
+        help='Messages for pub/sub benchmark')
+    parser.add_option('--output', type='string',
+        help='Write JSON results to file')
+    parser.add_option('--child', action='store_true',
+        help=optparse.SUPPRESS_HELP)
+    parser.add_option('--keys', type='int', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--path', type='string', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--format', type='string', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--kind', type='string', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--layout', type='string', help=optparse.SUPPRESS_HELP)
+    (options, args) = parser.parse_args()
+
+    if options.child:
+        if args[0] == 'generate':
+            print json.dumps(child_generate(options))
+        elif args[0] == 'load':
+            print json.dumps(child_load(options))
+        elif args[0] == 'memory':
+            print json.dumps(child_memory(options))
+        return
+
+    results = {
+        'timestamp': time.time(),
+    }
+    benches = {
+        'snapshot': bench_snapshot,
+        'memory': bench_memory,
+        'stress': bench_stress,
+        'pubsub': bench_pubsub,
+    }
+    for name in options.bench.split(','):
+        results[name] = benches[name](options)
+
+    output = json.dumps(results, indent=4, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            output_file.write(output)
+    print output
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,345 @@
+import os
+import sys
+import json
+import time
+import copy
+import datetime
+import threading
+import subprocess
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pritunl.constants import *
+from pritunl import settings
+from pritunl.settings.settings import module_classes
+from pritunl import mongo
+from pritunl import logger
+
+import logging
+import pymongo
+import bson
+
+class LocalCursor(object):
+    def __init__(self, collection, docs):
+        self.collection = collection
+        self.docs = docs
+
+    def sort(self, key, direction=pymongo.ASCENDING):
+        if isinstance(key, basestring):
+            key = [(key, direction)]
+        for field, direction in reversed(key):
+            self.docs.sort(key=lambda x: x.get(field),
+                reverse=direction == pymongo.DESCENDING)
+        return self
+
+    def skip(self, skip):
+        self.docs = self.docs[skip:]
+        return self
+
+    def limit(self, limit):
+        if limit:
+            self.docs = self.docs[:limit]
+        return self
+
+    def count(self):
+        return len(self.docs)
+
+    def __iter__(self):
+        return iter(self.docs)
+
+class LocalBulk(object):
+    def __init__(self, collection):
+        self.collection = collection
+        self.ops = []
+
+    def find(self, spec):
+        bulk = self
+
+        class BulkFind(object):
+            def update(self, doc):
+                bulk.ops.append((spec, doc))
+
+        return BulkFind()
+
+    def execute(self):
+        self.collection.round_trip()
+        with self.collection.lock:
+            for spec, doc in self.ops:
+                self.collection._update(spec, doc, False, False)
+
+class LocalCollection(object):
+    # In process stand-in for the collection operations used when creating
+    # users, each call sleeps for the configured round trip latency
+    def __init__(self, name, latency):
+        self.name_str = name
+        self.latency = latency
+        self.docs = []
+        self.lock = threading.RLock()
+        self.round_trips = 0
+
+    def round_trip(self):
+        with self.lock:
+            self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _match_value(self, value, cond):
+        if isinstance(cond, dict) and cond and \
+                all(x.startswith('$') for x in cond):
+            for op, arg in cond.items():
+                if op == '$in' and value not in arg:
+                    return False
+                elif op == '$nin' and value in arg:
+                    return False
+                elif op == '$gt' and not value > arg:
+                    return False
+                elif op == '$exists' and (value is not None) != arg:
+                    return False
+            return True
+        return value == cond
+
+    def _match(self, doc, spec):
+        for key, cond in (spec or {}).items():
+            if key == '$or':
+                if not any(self._match(doc, x) for x in cond):
+                    return False
+            elif not self._match_value(doc.get(key), cond):
+                return False
+        return True
+
+    def _update(self, spec, doc, upsert, multi):
+        matched = [x for x in self.docs if self._match(x, spec)]
+        if not multi:
+            matched = matched[:1]
+        if not matched and upsert:
+            new_doc = {x: y for x, y in spec.items()
+                if not isinstance(y, dict)}
+            new_doc.setdefault('_id', bson.ObjectId())
+            self.docs.append(new_doc)
+            matched = [new_doc]
+            updated_existing = False
+        else:
+            updated_existing = bool(matched)
+
+        for match in matched:
+            if not any(x.startswith('$') for x in doc):
+                match.clear()
+                match.update(spec)
+                match.update(copy.deepcopy(doc))
+                continue
+            for field, value in doc.get('$set', {}).items():
+                match[field] = copy.deepcopy(value)
+            for field in doc.get('$unset', {}):
+                match.pop(field, None)
+            for field, value in doc.get('$inc', {}).items():
+                match[field] = match.get(field, 0) + value
+
+        return {
+            'n': len(matched),
+            'updatedExisting': updated_existing,
+        }
+
+    def find(self, spec=None, fields=None, **kwargs):
+        self.round_trip()
+        with self.lock:
+            docs = [copy.deepcopy(x) for x in self.docs
+                if self._match(x, spec)]
+        return LocalCursor(self, docs)
+
+    def find_one(self, spec=None, fields=None, **kwargs):
+        for doc in self.find(spec, fields).limit(1):
+            return doc
+
+    def find_and_modify(self, spec, doc, **kwargs):
+        self.round_trip()
+        with self.lock:
+            for match in self.docs:
+                if self._match(match, spec):
+                    orig = copy.deepcopy(match)
+                    self._update({'_id': match['_id']}, doc, False, False)
+                    return orig
+
+    def insert(self, docs, **kwargs):
+        self.round_trip()
+        if isinstance(docs, dict):
+            docs = [docs]
+        with self.lock:
+            for doc in docs:
+                doc = copy.deepcopy(doc)
+                doc.setdefault('_id', bson.ObjectId())
+                self.docs.append(doc)
+
+    def update(self, spec, doc, upsert=False, multi=False, **kwargs):
+        self.round_trip()
+        with self.lock:
+            return self._update(spec, doc, upsert, multi)
+
+    def remove(self, spec=None, **kwargs):
+        self.round_trip()
+        if not isinstance(spec, dict):
+            spec = {'_id': spec}
+        with self.lock:
+            self.docs = [x for x in self.docs if not self._match(x, spec)]
+
+    def initialize_unordered_bulk_op(self):
+        return LocalBulk(self)
+
+def setup(options):
+    for cls in module_classes:
+        if cls.type == GROUP_MONGO:
+            setattr(settings, cls.group, cls())
+    settings.local.mongo_time = datetime.datetime.utcnow()
+    settings.local.mongo_time_start = datetime.datetime.utcnow()
+    settings.user.bulk_batch_size = options.batch_size
+
+    logger.log_handler = logging.NullHandler()
+    logger.log_filter = logger.LogFilter()
+
+    names = ('users', 'organizations', 'queue', 'messages', 'counters')
+    if options.mongodb_url:
+        client = pymongo.MongoClient(options.mongodb_url)
+        database = client.get_default_database()
+        for name in names:
+            database.drop_collection('bench_' + name)
+            collection = getattr(database, 'bench_' + name)
+            collection.name_str = name
+            mongo.collections[name] = collection
+    else:
+        for name in names:
+            mongo.collections[name] = LocalCollection(name,
+                options.latency / 1000.)
+
+def get_round_trips():
+    return sum(getattr(x, 'round_trips', 0)
+        for x in mongo.collections.values())
+
+def get_org(pool_size):
+    from pritunl import organization
+
+    org_id = bson.ObjectId()
+    mongo.collections['organizations'].insert({
+        '_id': org_id,
+        'name': 'bench',
+        'type': ORG_DEFAULT,
+        'ca_private_key': 'ca_private_key',
+        'ca_certificate': 'ca_certificate',
+    })
+    mongo.collections['users'].insert([{
+        'org_id': str(org_id),
+        'type': CERT_CLIENT_POOL,
+        'otp_secret': 'OTPSECRET',
+        'private_key': 'private_key',
+        'certificate': 'certificate',
+    } for _ in xrange(pool_size)])
+
+    return organization.get_org(str(org_id))
+
+def bench_run(options, count, bulk):
+    from pritunl import pooler
+
+    fill_calls = []
+    fill_orig = pooler.fill
+    def fill(*args, **kwargs):
+        # Count pool refills without running the pooler, refills are the
+        # same for both paths and only the number of calls is measured
+        fill_calls.append(args)
+    pooler.fill = fill
+
+    threads = []
+    thread_start_orig = threading.Thread.start
+    def thread_start(thread):
+        # Background work is joined before the timer stops so both paths
+        # are measured until every user is queued
+        threads.append(thread)
+        thread_start_orig(thread)
+    threading.Thread.start = thread_start
+
+    org = get_org(int(count * options.pool_ratio))
+    users_data = [{
+        'name': 'user_%s' % i,
+        'email': 'user_%s@example.com' % i,
+    } for i in xrange(count)]
+
+    round_trips_start = get_round_trips()
+    start = time.time()
+
+    try:
+        if bulk:
+            created = 0
+            for users in org.new_users(users_data, type=CERT_CLIENT):
+                created += len(users)
+        else:
+            created = 0
+            for user_data in users_data:
+                org.new_user(type=CERT_CLIENT, block=False, **user_data)
+                created += 1
+        for thread in threads:
+            thread.join()
+    finally:
+        pooler.fill = fill_orig
+        threading.Thread.start = thread_start_orig
+
+    elapsed = time.time() - start
+    return {
+        'users': count,
+        'created': created,
+        'pooled': int(count * options.pool_ratio),
+        'seconds': elapsed,
+        'round_trips': get_round_trips() - round_trips_start,
+        'threads': len(threads),
+        'pool_fills': len(fill_calls),
+    }
+
+def get_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.PIPE).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--mongodb-url', type='string',
+        help='Run against mongodb instead of the in process stand-in')
+    parser.add_option('--users-list', type='string', default='1000,10000',
+        help='Comma separated user counts')
+    parser.add_option('--pool-ratio', type='float', default=0.5,
+        help='Pooled users available as a ratio of the user count')
+    parser.add_option('--batch-size', type='int', default=500,
+        help='Bulk batch size')
+    parser.add_option('--latency', type='float', default=0.5,
+        help='Stand-in round trip latency in milliseconds')
+    parser.add_option('--output', type='string',
+        help='Write JSON results to file')
+    (options, args) = parser.parse_args()
+
+    setup(options)
+
+    from pritunl import queues
+
+    results = {
+        'revision': get_revision(),
+        'timestamp': time.time(),
+        'backend': 'mongodb' if options.mongodb_url else 'local',
+        'options': options.__dict__,
+        'runs': [],
+    }
+
+    for count in options.users_list.split(','):
+        for bulk in (False, True):
+            name = 'bulk' if bulk else 'single'
+            print 'Create %s users %s...' % (count, name)
+            result = bench_run(options, int(count), bulk)
+            result['mode'] = name
+            results['runs'].append(result)
+
+    output = json.dumps(results, indent=4, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            output_file.write(output)
+    print output
+
+if __name__ == '__main__':
+    main()